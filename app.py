@@ -1,193 +1,526 @@
-import heapq
+import atexit
+import functools
+import hashlib
+import itertools
 import random
 import time
-import uuid
 import threading
+import uuid
+from collections import namedtuple
 from datetime import datetime, timedelta
+from urllib.parse import quote
 
-from sqlalchemy import Column, Integer, String, Enum, ForeignKey, DateTime, Float
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Enum, ForeignKey, Date, DateTime, Float, Index, UniqueConstraint, func, \
+    select, tuple_, create_engine, inspect, text, update, delete, exists
+from sqlalchemy.orm import Session, relationship
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 
 from utils.enums import Role, FanSpeed, AcMode, QueueState
+from utils.cache import TTLCache, VersionedCache, VersionFile
+from utils.clock import SYSTEM_CLOCK
+from utils.database import configure_sqlite
+from utils.events import EventHub
+from utils.journal import Journal
+from utils.leader import CommandClient, CommandServer, LeaderLock, shared_secret
+from utils.metrics import Histogram, Registry, family
+from utils.persistence import WriteBehind
+from utils.profiling import QueryProfiler
+from utils.provisioning import parse_rooms, validate_rooms
+from utils.retention import RetentionJob
+from utils.rollup import Rollup
+from utils.runtime import TickLoop
+from utils.scheduling import RoomRow, SchedulerShard, ShardPool, room_row
+from utils.thermal import ThermalEngine
 
 import os
 
-from flask import Flask, abort, request, jsonify
-from flask_jwt_extended import JWTManager, jwt_required, get_jwt_identity, create_access_token
+import click
+from flask import Flask, Response, abort, g, request, jsonify, stream_with_context
+from flask_jwt_extended import JWTManager, jwt_required, get_jwt, get_jwt_identity, create_access_token
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
 
 
 TIME_EXPIRES = 7  # 7days
+RECORD_RETENTION_DAYS = 3 * 365  # 详单保留3年
+DEFAULT_ZONE = 'default'  # 未指定分区的房间
 
 
-app = Flask(__name__)
+app = Flask(__name__, instance_path=os.environ.get('HOTEL_INSTANCE_PATH'))  # 数据库、leader锁等文件所在的目录
 CORS(app)
 
 app.config['JWT_SECRET_KEY'] = os.urandom(24)  # 配置 JWT
 jwt = JWTManager(app)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///hotel.db'
+# 请求线程使用的连接池，调度器写库使用下面单独的writer_engine
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(pool_size=10, max_overflow=20, pool_timeout=10)
+app.config['SCHEDULER_ZONES'] = {DEFAULT_ZONE: 3}  # 调度分区（楼栋或楼层）-> 同时送风的房间数
+app.config['SCHEDULER_PROCESSES'] = 0  # 运行调度分区的子进程数，0表示在本进程中运行
+app.config['SCHEDULER_BOOST'] = 6.  # 模拟时间相对真实时间的倍数
+app.config['SCHEDULER_TIME_SLICE'] = 120  # 每次送风的时间片（模拟时间，秒）
+app.config['SCHEDULER_JOURNAL'] = True  # 记录队列事件日志，重启后恢复等待队列的顺序和时间片进度
+app.config['SQL_SLOW_QUERY_MS'] = 100  # 单条SQL超过这个耗时写入日志
+app.config['SQL_SLOW_SCOPE_MS'] = 500  # 一次请求或一个调度节拍的SQL总耗时超过这个值写入日志
+app.config['SQL_REPEAT_THRESHOLD'] = 5  # 同一种SQL在一次请求中执行这么多次视为N+1
+app.config['ROOM_IMPORT_CHUNK'] = 500  # 批量导入房间时每次插入的行数
+app.config.from_prefixed_env()  # 如 FLASK_SCHEDULER_ZONES='{"A": 3, "B": 5}' FLASK_SCHEDULER_PROCESSES=2
 db = SQLAlchemy(app)
+with app.app_context():
+    reader_engine = configure_sqlite(db.engine)
+    # 调度器（写回）、清理任务专用的写连接：只有一个连接，进程内的写事务在连接池排队，不占用请求线程的连接
+    writer_engine = configure_sqlite(create_engine(db.engine.url, pool_size=1, max_overflow=0, pool_timeout=30),
+                                     immediate=True)
+# 按请求和调度节拍统计SQL，慢查询和N+1写入日志，调试模式下附加在响应头中
+sql_profiler = QueryProfiler(app.logger, slow_query=app.config['SQL_SLOW_QUERY_MS'] / 1e3,
+                             slow_scope=app.config['SQL_SLOW_SCOPE_MS'] / 1e3,
+                             repeat_threshold=app.config['SQL_REPEAT_THRESHOLD'])
+sql_profiler.instrument(reader_engine)
+sql_profiler.instrument(writer_engine)
+os.makedirs(app.instance_path, exist_ok=True)
+
+EVENT_FIELDS = ('roomTemperature', 'acTemperature', 'fanSpeed', 'queueState', 'consumption', 'timeLeft', 'occupied')
+# 每个调度节拍后发布的房间状态变化，/room/events 和 /rooms/events 的数据来源
+room_events = EventHub()
+# /metrics导出的指标；请求指标按进程统计，调度器的指标由leader进程提供
+metrics = Registry()
+request_seconds = metrics.histogram('hotel_http_request_seconds', '请求处理耗时，流式响应只计到开始输出',
+                                    ['method', 'route'])
+requests_total = metrics.counter('hotel_http_requests_total', '请求数', ['method', 'route', 'status'])
+
+
+def live_fields(state, boost, now):
+    """
+    推送给前端的实时字段，字段名与room_info一致；浮点数取整，避免微小变化也被推送
+    """
+    firstRuntime = state['firstRuntime']
+    timeLeft = max((now - firstRuntime) / timedelta(minutes=2) * boost, 0.) if firstRuntime is not None else None
+    return dict(roomTemperature=round(state['roomTemperature'], 2), acTemperature=state['acTemperature'],
+                fanSpeed=state['fanSpeed'].value, queueState=state['queueState'].value,
+                consumption=round(state['consumption'], 4),
+                timeLeft=None if timeLeft is None else round(timeLeft, 2),
+                occupied=state['customerSessionID'] is not None)
+
+
+def default_zone(zones):
+    """
+    未指定分区（或分区已从配置中删除）的房间所在的分区：配置了DEFAULT_ZONE时为它，否则为第一个分区
+    """
+    return DEFAULT_ZONE if DEFAULT_ZONE in zones else next(iter(zones))
 
 
 class ACScheduler:
-    def __init__(self, db, interval=1):
+    """
+    房间按分区（楼栋或楼层）分给各自的SchedulerShard，每个分区有自己的服务容量、等待队列和节拍
+    processes为0时分区在本进程的线程中运行，否则分到processes个子进程中运行
+    本对象把房间操作转给房间所属的分区，并按节拍取出各分区的改动和详单写回数据库
+    调度用到的时间都来自clock，写回的时机仍按真实时间
+    journal_dir不为空时每个分区在其中记录队列事件日志，重启时按日志恢复队列顺序和时间片进度
+    """
+
+    def __init__(self, db, interval=1, flush_interval=1., record_batch=1000, record_delay=1.,
+                 overrun_policy=TickLoop.SKIP, zones=None, processes=0, boost=6., events=None, time_slice=120,
+                 clock=SYSTEM_CLOCK, journal_dir=None):
         self.db = db
         self.interval = interval
-        self.max_num = 3
-        self.running_list = []
-        self.waiting_queue = []
-        self.last_update = time.time()
-        self.cooling_rate = 0.5/60
-        self.rate = 1.  # 空调费率
-
-        self.boost = 6.
-
-    def minimum(self, a1, a2):
-        return (a1, 0) if a1 < a2 else (a2, 1)
-
-    def get_speed(self, fanSpeed):
-        # 每分钟改变：
-        if fanSpeed == FanSpeed.HIGH:
-            return 1.
-        elif fanSpeed == FanSpeed.MEDIUM:
-            return 0.5
-        else:
-            return 1/3
+        self.flush_interval = flush_interval  # 数据库最多落后内存状态的秒数
+        self.record_batch = record_batch  # 积压这么多条详单时立即写入
+        self.record_delay = record_delay  # 详单最多等待的秒数
+        self.zones = zones or {DEFAULT_ZONE: 3}  # 分区名 -> 同时服务的房间数
+        self.boost = boost
+        self.clock = clock
+        self.journal_dir = journal_dir
+
+        shards = [SchedulerShard(zone, capacity, interval, overrun_policy, boost=self.boost, time_slice=time_slice,
+                                 clock=clock, journal=self.journal(zone))
+                  for zone, capacity in self.zones.items()]
+        self.pool = ShardPool(shards, processes) if processes else None
+        self.shards = self.pool.shards if self.pool else {shard.name: shard for shard in shards}
+        self.owner = {}  # roomID -> 所属分区
+        self.unknown_zones = set()  # 已经警告过的未配置的分区
+        self.epoch = uuid.uuid4().hex[:8]  # 版本号只在本次运行内有效，ETag中带上它，重启后不会误判为未修改
+        self.events = EventHub() if events is None else events
+        self.published = {}  # roomID -> 上一次推送的实时字段
+        self.writer = None  # 在initialize中创建，负责把内存状态写回数据库
+        self.closed = False
+        self.loop = TickLoop(self.update, interval, policy=overrun_policy, name='ac-scheduler-writer')
+        self.collect_seconds = Histogram('hotel_scheduler_collect_seconds', '取出各分区的改动、推送和写回一次的耗时')
+
+    def journal(self, zone):
+        if self.journal_dir is None:
+            return None
+        return Journal(os.path.join(self.journal_dir, quote(zone, safe='')))  # 分区名可能含有/等字符
+
+    def shard_for(self, zone):
+        shard = self.shards.get(zone)
+        if shard is None:  # 配置中已删除的分区，归入默认分区；每个分区只警告一次
+            shard = self.shards[default_zone(self.shards)]
+            if zone not in self.unknown_zones:
+                self.unknown_zones.add(zone)
+                app.logger.warning('zone %r is not configured, scheduled in %r', zone, shard.name)
+        return shard
+
+    def initialize(self, bind):
+        """
+        根据房间的状态恢复各分区的队列状态：重启前正在送风的房间用一条UPDATE改为等待，
+        再用一次只取温控列的查询载入全部房间，不需要逐个房间写回
+        有事件日志的分区再按日志把送风中的房间（不超过服务容量）改回RUNNING，并恢复等待队列的顺序
+        bind为调度器专用的写连接，调度器不使用请求线程的db.session
+        """
+        with Session(bind) as session, session.begin():
+            session.execute(update(Room.__table__).where(Room.queueState == QueueState.RUNNING)
+                            .values(queueState=QueueState.PENDING))
+            rooms = session.execute(select(Room.zone, Room.roomID,
+                                           *[getattr(Room, name) for name in ThermalEngine.FIELDS])).all()
+        groups = self.assign([(zone, RoomRow(*values)) for zone, *values in rooms])
+        for name, shard in self.shards.items():
+            shard.recover(groups.get(name, []))  # 没有房间的分区也要恢复，以便写入新的快照
+        self.writer = WriteBehind(bind, Room, RoomRecord, interval=self.flush_interval, max_records=self.record_batch,
+                                  max_record_delay=self.record_delay, rollups=[consumption_rollup])
+        self.update()
+        self.writer.flush()
+
+    def add_room(self, room):
+        self.load_room(room.zone, room_row(room))
+
+    def add_rooms(self, rooms):
+        self.load_rooms([(room.zone, room_row(room)) for room in rooms])
+
+    def load_room(self, zone, row):
+        shard = self.shard_for(zone)
+        shard.load([row])
+        self.owner[row.roomID] = shard
+
+    def load_rooms(self, items):
+        """
+        批量载入 [(分区, RoomRow)]，每个分区只调用一次
+        """
+        for name, rows in self.assign(items).items():
+            self.shards[name].load(rows)
+
+    def assign(self, items):
+        """
+        记录 [(分区, RoomRow)] 中各房间所属的分区，返回 分区名 -> [RoomRow]
+        """
+        groups = {}
+        for zone, row in items:
+            shard = self.shard_for(zone)
+            self.owner[row.roomID] = shard
+            groups.setdefault(shard.name, []).append(row)
+        return groups
+
+    def remove_room(self, roomID):
+        shard = self.owner.pop(roomID, None)
+        if shard is not None:
+            shard.remove_room(roomID)
+        self.writer.discard(roomID)
+        self.published.pop(roomID, None)
+
+    def set_state(self, roomID, **fields):
+        """
+        修改房间的温控状态，字段名与Room列名一致，由下一次调度写回数据库
+        """
+        self.owner[roomID].set_state(roomID, **fields)
 
-    def remove_from_lists(self, room):
-        if room.roomID in self.running_list:
-            self.running_list.remove(room.roomID)
-        self.waiting_queue = [(priority, t,  roomID) for priority, t, roomID in self.waiting_queue if roomID != room.roomID]
+    def group(self, roomIDs):
+        """
+        按所属分区分组：分区名 -> [roomID]，批量操作对每个分区只调用一次
+        """
+        groups = {}
+        for roomID in roomIDs:
+            groups.setdefault(self.owner[roomID].name, []).append(roomID)
+        return groups
 
-    def initialize(self):
+    def set_states(self, states):
         """
-        根据房间的状态恢复内存中的队列状态
+        一次修改多个房间：{roomID: {字段: 值}}
         """
-        with app.app_context():
-            rooms = self.db.session.query(Room).all()
-            for room in rooms:
-                if room.queueState == QueueState.PENDING:
-                    self.add_to_waiting(room)  # 初始化队列状态
-                elif room.queueState == QueueState.IDLE:
-                    self.remove_from_lists(room)
-                else:  # RUNNING
-                    self.add_to_waiting(room)  # 初始化队列状态
-                    room.queueState = QueueState.PENDING
-                    db.session.commit()
-
-    def get_priority(self, acSpeed):
-        return {'high': 1, 'medium': 2, 'low': 3}.get(acSpeed.value, 3)
-
-    def add_to_waiting(self, room):
-        room.queueState = QueueState.PENDING
-        db.session.commit()
-        # self.waiting_queue = [(priority, t, room_id) for priority, t, room_id in self.waiting_queue]
-        heapq.heappush(self.waiting_queue, (self.get_priority(room.fanSpeed), time.time(), room.roomID))
-        if room.roomID in self.running_list:
-            self.running_list.remove(room.roomID)
-        # 在这里产生详单记录
+        for name, roomIDs in self.group(states).items():
+            self.shards[name].set_states({roomID: states[roomID] for roomID in roomIDs})
 
-    def update(self):
-        with app.app_context():
-            t = time.time()
-
-            # records = db.session.query(RoomRecord).all()
-            # print("records: ", len(records))
-
-            rooms = self.db.session.query(Room).all()
-            for room in rooms:
-                if room.queueState == QueueState.RUNNING:  # 空调开启时
-                    if room.roomTemperature > room.acTemperature:  # cooling
-                        delta, argmin = self.minimum(room.roomTemperature - room.acTemperature, self.get_speed(room.fanSpeed) * (t - self.last_update) / 60 * self.boost)
-                        if argmin == 0:
-                            self.add_to_waiting(room)  # 到达目标温度而暂停
-                            self.generate_record(room)  # 因到达目标温度产生详单记录
-                        room.roomTemperature -= delta
-                        room.consumption += delta * self.rate
-                        db.session.commit()
-                    elif room.roomTemperature < room.acTemperature:  # heating
-                        delta, argmin = self.minimum(room.acTemperature - room.roomTemperature, self.get_speed(room.fanSpeed) * (t - self.last_update) / 60 * self.boost)
-                        if argmin == 0:
-                            self.add_to_waiting(room)  # 到达目标温度而暂停
-                            self.generate_record(room)  # 因到达目标温度产生详单记录
-                        room.roomTemperature += delta
-                        room.consumption += delta * self.rate
-                        db.session.commit()
-                    else:
-                        self.add_to_waiting(room)  # 到达目标温度而暂停
-                        self.generate_record(room)  # 因到达目标温度产生详单记录
-            # print(self.running_list, self.waiting_queue)
-
-            for roomID in self.running_list:
-                room = db.session.query(Room).filter_by(roomID=roomID).one()
-                # print(datetime.now() - room.firstRuntime)
-                if datetime.now() - room.firstRuntime > timedelta(minutes=2) / self.boost:  # 2min / 6
-                    print('over time!')
-                    self.add_to_waiting(room)  # 超时而暂停
-                    self.generate_record(room)  # 因超时暂停产生详单记录
-
-            for room in rooms:
-                if room.queueState != QueueState.RUNNING:  # 空调关闭时
-                    if room.roomTemperature > room.initialTemperature:  # 房间的回温逻辑
-                        room.roomTemperature = max(room.roomTemperature - self.cooling_rate * (t - self.last_update) * self.boost, room.initialTemperature)
-                    else:
-                        room.roomTemperature = min(room.roomTemperature + self.cooling_rate * (t - self.last_update) * self.boost, room.initialTemperature)
-                    db.session.commit()
-
-            while self.waiting_queue and len(self.running_list) < self.max_num:
-                _, _, roomID = heapq.heappop(self.waiting_queue)
-                room = self.db.session.query(Room).filter_by(roomID=roomID).one()
-                room.queueState = QueueState.RUNNING
-                room.firstRuntime = datetime.now()
-                room.startTimePoint = datetime.now()
-                db.session.commit()
-                self.running_list.append(roomID)
-
-            self.last_update = t
-            print(self.running_list, self.waiting_queue)
-
-    def generate_record(self, room):
-        latest_settings = db.session.query(Setting).order_by(Setting.createTime.desc()).first()
-        record = RoomRecord(room.roomID, room.customerSessionID, room.requestTime, room.startTimePoint, datetime.now(), room.fanSpeed, room.acMode, latest_settings.rate, room.consumption - room.lastConsumption, room.consumption)
-        room.lastConsumption = room.consumption
-        db.session.add(record)
-        db.session.commit()
+    def release(self, roomIDs, **fields):
+        """
+        批量退房：关闭这些房间的空调并移出运行和等待队列，再写入fields
+        """
+        for name, ids in self.group(roomIDs).items():
+            self.shards[name].release(ids, **fields)
 
-    def turn_off(self, room):
-        # PENDING/RUNNING -> IDLE
-        room.queueState = QueueState.IDLE
-        db.session.commit()
-        self.remove_from_lists(room)
-        self.generate_record(room)  # 因用户操作关闭空调产生详单记录
-        print('turn off!', room.queueState, self.running_list, self.waiting_queue)
-
-    def turn_on(self, room):
-        # IDLE -> PENDING
-        in_waiting = False
-        for p, t, id, in self.waiting_queue:
-            if id == room.roomID:
-                in_waiting = True
-        room.requestTime = datetime.now()  # 添加请求时间
-        db.session.commit()
-        if room.roomID not in self.running_list and not in_waiting:
-            self.add_to_waiting(room)  # 开启空调而加入等待队列
-        print('turn on!', room.queueState, self.running_list, self.waiting_queue)
+    def reset(self, states):
+        """
+        关闭这些房间的空调并移出运行和等待队列，再写入各房间的字段：{roomID: {字段: 值}}
+        """
+        for name, roomIDs in self.group(states).items():
+            self.shards[name].reset({roomID: states[roomID] for roomID in roomIDs})
+
+    def touch(self, roomID):
+        """
+        房间的非温控字段（如房间名）修改后调用，使其版本号增加
+        """
+        self.owner[roomID].touch(roomID)
 
-    def schedule_wrapper(self):
+    def room_state(self, roomID):
+        shard = self.owner.get(roomID)
+        return None if shard is None else shard.room_state(roomID)
+
+    def room_version(self, roomID):
+        shard = self.owner.get(roomID)
+        version = None if shard is None else shard.room_version(roomID)
+        return None if version is None else (self.epoch, version)
+
+    def versions(self):
+        """
+        全部房间的版本：任何房间改动或房间增删后都会变化
+        """
+        return self.epoch, tuple(shard.generation() for shard in self.shards.values())
+
+    def room_states(self, roomIDs):
+        """
+        按分区分组读取，每个分区一次调用
+        """
+        groups = {}
+        for roomID in roomIDs:
+            shard = self.owner.get(roomID)
+            if shard is not None:
+                groups.setdefault(shard.name, []).append(roomID)
+        states = {}
+        for name, ids in groups.items():
+            states.update(zip(ids, self.shards[name].room_states(ids)))
+        return [states.get(roomID) for roomID in roomIDs]
+
+    def turn_off(self, roomID):
+        self.owner[roomID].turn_off(roomID)
+
+    def turn_on(self, roomID):
+        self.owner[roomID].turn_on(roomID)
+
+    def change_fan_speed(self, roomID, fanSpeed):
+        self.owner[roomID].change_fan_speed(roomID, fanSpeed)
+
+    def update(self):
+        """
+        取出各分区的状态改动和详单交给写回层，到期时写库；同时把实时字段的变化推送给订阅者
+        """
+        with sql_profiler.profile('scheduler.update'):
+            started = time.perf_counter()
+            rate = None
+            changes = {}
+            now = self.clock.now()
+            for shard in self.shards.values():
+                rows, records = shard.drain()
+                self.writer.add_rooms(rows)
+                if records and rate is None:
+                    rate = get_latest_settings().rate  # 详单按取出时的费率计费
+                for record in records:
+                    self.writer.add_record(rate=rate, **record)
+                for row in rows:
+                    fields = live_fields(row, self.boost, now)
+                    last = self.published.get(row['roomID'], {})
+                    changed = {name: value for name, value in fields.items()
+                               if name not in last or last[name] != value}
+                    if changed:
+                        self.published[row['roomID']] = fields
+                        changes[row['roomID']] = changed
+            self.events.publish(changes)
+            if self.writer.due():
+                self.writer.flush(rooms=self.writer.rooms_due())
+            self.collect_seconds.observe(time.perf_counter() - started)
+
+    def room_events(self):
+        """
+        供其他进程转发的状态变化流，每个节拍一批；空闲时定期发送空的一批，以便及时发现对方已断开
+        """
+        subscription = self.events.subscribe(raw=True)
         try:
-            self.update()
+            while True:
+                yield subscription.get(timeout=15) or {}
         finally:
-            # 安排下一次执行
-            threading.Timer(self.interval, self.schedule_wrapper).start()
+            self.events.unsubscribe(subscription)
+
+    def report(self):
+        shards = [shard.report() for shard in self.shards.values()]
+        return dict(leader=os.getpid(), shards=shards, writer=self.writer.report(), collector=self.loop.report(),
+                    events=dict(self.events.stats, subscribers=len(self.events)),
+                    runningNum=sum(shard['runningNum'] for shard in shards),
+                    waitingNum=sum(shard['waitingNum'] for shard in shards))
+
+    def metrics(self):
+        """
+        各分区和写回层的指标（Family列表）
+        """
+        families = [self.collect_seconds.collect()]
+        for shard in self.shards.values():
+            families.extend(shard.metrics())
+        writer = self.writer.report()
+        for name, documentation in (('flushes', '写回事务数'), ('failures', '失败的写回事务数'),
+                                    ('rooms', '写回的房间行数'), ('records', '写入的详单数')):
+            families.append(family(f'hotel_writeback_{name}_total', 'counter', documentation, {(): writer[name]}))
+        families.append(family('hotel_writeback_pending', 'gauge', '等待写回的房间和详单数',
+                               {(('kind', 'rooms'),): writer['pendingRooms'],
+                                (('kind', 'records'),): writer['pendingRecords']}))
+        families.append(family('hotel_events_subscribers', 'gauge', '实时推送的订阅者数', {(): len(self.events)}))
+        return families
 
     def start(self):
-        threading.Timer(self.interval, self.schedule_wrapper).start()
+        for shard in self.shards.values():
+            shard.start()
+        self.loop.start()
+
+    def shutdown(self):
+        """
+        退出前把各分区中尚未写回的状态和详单全部落盘
+        """
+        if self.writer is not None:
+            self.update()
+            self.writer.flush()
+
+    def stop(self):
+        for shard in self.shards.values():
+            shard.stop()
+        self.loop.stop()
+        self.shutdown()
+
+    def close(self):
+        """
+        进程退出前调用，之后不能再启动；可以重复调用（如显式关闭后atexit再次调用），
+        分区子进程已退出后不再向它们发送命令
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.stop()
+        if self.pool is not None:
+            self.pool.close()
+
+    def pause(self):
+        for shard in self.shards.values():
+            shard.pause()
+
+    def resume(self):
+        for shard in self.shards.values():
+            shard.resume()
+
+
+# 其他进程可以转发给leader的调度器方法
+LEADER_METHODS = ('load_room', 'load_rooms', 'remove_room', 'set_state', 'set_states', 'touch', 'room_state',
+                  'room_states', 'room_version', 'versions', 'turn_on', 'turn_off', 'release', 'reset',
+                  'change_fan_speed', 'report', 'metrics', 'start', 'stop', 'pause', 'resume')
+
+
+class RemoteScheduler:
+    """
+    非leader进程中的调度器：房间操作和状态查询都转发给leader进程，本进程不保存任何调度状态
+    leader推送的状态变化由一个线程接收，再发布给本进程的订阅者，每个进程只占用一个连接
+    """
+
+    def __init__(self, client, zones, boost, events):
+        self.client = client
+        self.zones = zones
+        self.boost = boost
+        self.events = events
+        self.closed = threading.Event()
+        threading.Thread(target=self.relay, name='room-events-relay', daemon=True).start()
 
+    def relay(self):
+        while not self.closed.is_set():
+            try:
+                for changes in self.client.stream('room_events'):
+                    if self.closed.is_set():
+                        break
+                    self.events.publish(changes)
+            except ConnectionError:
+                pass
+            self.closed.wait(1.)  # leader更换期间稍后重连
 
-scheduler = ACScheduler(db)
+    def close(self):
+        self.closed.set()
 
-scheduler.start()
+    def add_room(self, room):
+        self.client.call('load_room', room.zone, room_row(room))
+
+    def add_rooms(self, rooms):
+        self.client.call('load_rooms', [(room.zone, room_row(room)) for room in rooms])
+
+    def __getattr__(self, method):
+        if method not in LEADER_METHODS:
+            raise AttributeError(method)
+        return functools.partial(self.client.call, method)
+
+
+def create_scheduler():
+    journal_dir = os.path.join(app.instance_path, 'journal') if app.config['SCHEDULER_JOURNAL'] else None
+    return ACScheduler(db, zones=app.config['SCHEDULER_ZONES'], processes=app.config['SCHEDULER_PROCESSES'],
+                       boost=app.config['SCHEDULER_BOOST'], time_slice=app.config['SCHEDULER_TIME_SLICE'],
+                       events=room_events, journal_dir=journal_dir)
+
+
+# 多个进程（如gunicorn的多个worker）中只有取得文件锁的leader运行调度，其余进程通过Unix socket把命令转发给leader
+scheduler_lock = LeaderLock(os.path.join(app.instance_path, 'scheduler.lock'))
+SCHEDULER_ADDRESS = os.path.join(app.instance_path, 'scheduler.sock')
+
+
+class SchedulerHandle:
+    """
+    本进程的调度器，在create_app中或第一次用到时才参与选举：
+    取得leader锁的进程从数据库恢复状态并运行调度，其余进程把命令转发给leader，并在leader退出后接替
+    导入app、收集测试和运行不需要调度器的命令都不会启动调度器和任何线程
+    """
+
+    def __init__(self):
+        self.target = None  # ACScheduler或RemoteScheduler
+        self.key = None
+        self.lock = threading.RLock()
+
+    @property
+    def started(self):
+        return self.target is not None
+
+    def elect(self):
+        """
+        参与选举，返回本进程的调度器；start、stop等调度器命令不在这里，经__getattr__转给调度器
+        """
+        with self.lock:
+            if self.target is None:
+                self.key = shared_secret(os.path.join(app.instance_path, 'scheduler.key'))
+                if scheduler_lock.acquire():
+                    self.lead(create_scheduler())  # 在create_app中启动时，分区子进程在此fork，早于任何线程
+                else:  # leader退出后由等待中的进程接替；接替时分区子进程在已有线程的进程中fork
+                    self.follow()
+                    scheduler_lock.wait(lambda: self.lead(create_scheduler()))
+            return self.target
+
+    def attach(self):
+        """
+        只在已有leader时连接leader，不参与选举（用于命令行工具），返回能否执行调度器命令
+        """
+        with self.lock:
+            if self.target is None and scheduler_lock.locked():
+                self.key = shared_secret(os.path.join(app.instance_path, 'scheduler.key'))
+                self.follow()
+            return self.target is not None
+
+    def follow(self):
+        self.target = RemoteScheduler(CommandClient(SCHEDULER_ADDRESS, self.key), app.config['SCHEDULER_ZONES'],
+                                      app.config['SCHEDULER_BOOST'], room_events)
+
+    def lead(self, leader):
+        """
+        本进程成为leader：从数据库恢复调度状态，开始调度和清理，并接收其他进程转发的命令
+        """
+        with self.lock:
+            if isinstance(self.target, RemoteScheduler):
+                self.target.close()  # 不再转发旧leader的推送
+            leader.initialize(writer_engine)
+            leader.start()
+            self.target = leader
+            CommandServer(SCHEDULER_ADDRESS, self.key, leader, LEADER_METHODS, streams=('room_events',)).start()
+            retention_loop.start()
+            atexit.register(leader.close)
+
+    def __getattr__(self, name):
+        return getattr(self.target or self.elect(), name)
+
+
+scheduler = SchedulerHandle()
 
 
 class Account(db.Model):
@@ -241,6 +574,8 @@ class Room(db.Model):
     startTimePoint = Column(DateTime, nullable=True)  # 在空调调度为RUNNING态和空调风速改变时必须指定
     requestTime = Column(DateTime, nullable=True)  # 在初次请求turn on时指定
     lastConsumption = Column(Float)
+    zone = Column(String, nullable=False, default=DEFAULT_ZONE)  # 所属调度分区，创建后不能修改
+    version = Column(Integer, nullable=False)  # 乐观锁，请求线程修改房间时检查；调度器写回温控状态不改变版本号
 
     customerSessionID = Column(String, nullable=True)  # 在用户入住时必须指定
     checkInTime = Column(DateTime, nullable=True)  # 在用户入住时必须指定
@@ -249,8 +584,10 @@ class Room(db.Model):
     # 也可以通过与身份证号相同的部分查看历史记录
     records = relationship('RoomRecord', backref='room')
 
+    __mapper_args__ = {'version_id_col': version}
+
     def __init__(self, roomName: str, roomDescription: str, unitPrice: float, acTemperature: int, fanSpeed: FanSpeed,
-                 acMode: AcMode, initialTemperature: float = None):
+                 acMode: AcMode, initialTemperature: float = None, zone: str = DEFAULT_ZONE):
         """
         创建房间
                 >> room = Room('243', '大床房', acTemperature=30, fanSpeed=FanSpeed.MEDIUM, acMode=AcMode.HEAT)
@@ -260,6 +597,7 @@ class Room(db.Model):
         self.roomName = roomName
         self.roomDescription = roomDescription
         self.unitPrice = unitPrice
+        self.zone = zone
 
         self.acTemperature = acTemperature  # 指定为管理员默认设置
         self.fanSpeed = fanSpeed  # 指定为管理员默认设置
@@ -278,6 +616,11 @@ class Room(db.Model):
 
 class RoomRecord(db.Model):
     __tablename__ = 'room_records'
+    __table_args__ = (
+        Index('ix_room_records_serveEndTime', 'serveEndTime'),  # 按时间清理过期记录
+        Index('ix_room_records_roomID_serveEndTime', 'roomID', 'serveEndTime', 'id'),  # 管理员查看房间详单
+        Index('ix_room_records_customerSessionID_serveEndTime', 'customerSessionID', 'serveEndTime', 'id'),  # 客户查看本次入住的详单
+    )
     id = Column(Integer, primary_key=True)
     roomID = Column(Integer, ForeignKey('room.roomID'))
     customerSessionID = Column(String)
@@ -305,6 +648,35 @@ class RoomRecord(db.Model):
         self.accumulatedConsumption = accumulatedConsumption
 
 
+class ConsumptionRollup(db.Model):
+    """
+    按房间、入住、日期、风速汇总的详单，由详单写入时增量维护，可用 flask rebuild-rollups 重新生成
+    """
+    __tablename__ = 'consumption_rollups'
+    __table_args__ = (UniqueConstraint('roomID', 'customerSessionID', 'day', 'fanSpeed'),)
+    id = Column(Integer, primary_key=True)
+    roomID = Column(Integer, nullable=False)
+    customerSessionID = Column(String, nullable=False)  # 无人入住时为空字符串，保证唯一约束生效
+    day = Column(Date, nullable=False)  # serveEndTime所在日期
+    fanSpeed = Column(Enum(FanSpeed), nullable=False)
+    records = Column(Integer, nullable=False)
+    duration = Column(Float, nullable=False)  # 秒
+    consumption = Column(Float, nullable=False)
+    cost = Column(Float, nullable=False)  # consumption * rate
+
+
+def rollup_record(record):
+    end, start = record['serveEndTime'], record['serveStartTime']
+    consumption = record['consumption'] or 0.
+    # 房间删除后其详单的roomID会被置空，汇总时记为0
+    return ((record['roomID'] or 0, record['customerSessionID'] or '', end.date(), record['fanSpeed']),
+            (1, (end - start).total_seconds(), consumption, consumption * (record['rate'] or 0.)))
+
+
+consumption_rollup = Rollup(ConsumptionRollup.__table__, ('roomID', 'customerSessionID', 'day', 'fanSpeed'),
+                            ('records', 'duration', 'consumption', 'cost'), rollup_record)
+
+
 class Setting(db.Model):
     __tablename__ = 'settings'
     settingID = Column(Integer, primary_key=True)
@@ -328,8 +700,90 @@ class Setting(db.Model):
         self.createTime = datetime.now()
 
 
-with app.app_context():
-    db.create_all()
+SettingSnapshot = namedtuple('SettingSnapshot', [column.name for column in Setting.__table__.columns])
+
+
+def load_latest_settings():
+    with Session(reader_engine) as session:  # 独立的会话，调度线程中也可以调用
+        setting = session.query(Setting).order_by(Setting.createTime.desc()).first()
+        if setting is None:
+            return None
+        return SettingSnapshot(**{name: getattr(setting, name) for name in SettingSnapshot._fields})
+
+
+# 设置修改后更新版本文件，各个进程通过版本号判断缓存是否失效
+settings_cache = VersionedCache(load_latest_settings, VersionFile(os.path.join(app.instance_path, 'settings.version')))
+
+
+def get_latest_settings():
+    """
+    最新的空调设置（只读快照），不访问数据库
+    """
+    return settings_cache.get()
+
+
+AccountSnapshot = namedtuple('AccountSnapshot', ['accountID', 'username', 'role', 'roomID'])
+# 退房、删除帐号、修改密码后失效，版本文件通知其他进程一并清空
+account_cache = TTLCache(maxsize=10000, ttl=60., version=VersionFile(os.path.join(app.instance_path, 'accounts.version')))
+
+
+def current_account():
+    """
+    当前请求的帐号（只读快照）
+    角色和房间来自token中的claims，帐号是否仍然存在由缓存确认，缓存未命中时才查询数据库
+    """
+    accountID = get_jwt_identity()
+    account = account_cache.get(accountID)
+    if account is None:
+        result = db.session.query(Account.accountID, Account.username, Account.role, Account.roomID).filter_by(
+            accountID=accountID).one_or_none()
+        if result is None:
+            abort(401, "account not found")
+        account = AccountSnapshot(*result)
+        account_cache.put(accountID, account)
+    claims = get_jwt()
+    if 'role' in claims and (claims['role'] != account.role.value or claims.get('roomID') != account.roomID):
+        abort(401, "token outdated")
+    return account
+
+
+def commit():
+    """
+    提交请求中对房间的修改，房间已被其他请求修改（版本号不一致）时回滚并返回409，由客户端重试
+    """
+    try:
+        db.session.commit()
+    except StaleDataError:
+        db.session.rollback()
+        abort(409, "room was modified by another request, please retry")
+
+
+schema_lock = threading.Lock()
+schema_ready = False
+
+
+def init_db():
+    """
+    建表，给已有的表补建索引和补列；每个进程只执行一次
+    """
+    global schema_ready
+    if schema_ready:  # 建表后每个请求都会调用，不再排队等锁
+        return
+    with schema_lock:
+        if schema_ready:
+            return
+        with app.app_context():
+            db.create_all()
+            for index in RoomRecord.__table__.indexes:  # create_all不会给已有的表补建索引
+                index.create(db.engine, checkfirst=True)
+            columns = {column['name'] for column in inspect(db.engine).get_columns('room')}
+            with db.engine.begin() as connection:  # 也不会补列
+                if 'version' not in columns:
+                    connection.execute(text('ALTER TABLE room ADD COLUMN version INTEGER NOT NULL DEFAULT 1'))
+                if 'zone' not in columns:
+                    connection.execute(text(f"ALTER TABLE room ADD COLUMN zone VARCHAR NOT NULL "
+                                            f"DEFAULT '{DEFAULT_ZONE}'"))
+        schema_ready = True
     # account = Account('222', '222', Role.manager)
     # room = Room('211', '大床房', 300, 25, FanSpeed.MEDIUM, AcMode.HEAT)
     # db.session.add(room)
@@ -341,7 +795,72 @@ with app.app_context():
     # db.session.commit()
 
 
-scheduler.initialize()
+retention = RetentionJob(writer_engine, RoomRecord.__table__, RoomRecord.__table__.c.serveEndTime,
+                         keep=timedelta(days=RECORD_RETENTION_DAYS))
+# 每小时清理一次，在单独的线程中分批删除，不占用调度线程
+retention_loop = TickLoop(retention.run, 3600, name='record-retention')
+
+
+def create_app(start_scheduler=True):
+    """
+    应用工厂：建表，start_scheduler为True时立即参与选举并启动调度器，否则在第一次用到调度器时才启动
+    导入本模块不访问数据库、不启动线程，配置来自环境变量（FLASK_前缀）和HOTEL_INSTANCE_PATH
+        gunicorn -w 4 'app:create_app()'
+    """
+    init_db()
+    if start_scheduler:
+        scheduler.elect()
+    return app
+
+
+@app.errorhandler(ConnectionError)
+def scheduler_unavailable(error):
+    """
+    leader正在更换，命令没有执行
+    """
+    return jsonify(msg=f"scheduler unavailable, please retry: {error}"), 503
+
+
+@app.before_request
+def prepare():
+    init_db()  # 不经过create_app直接使用app时（如 flask --app app run），在第一个请求前建表
+
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+    g.sql_stats = sql_profiler.start(f'{request.method} {request.path}')
+
+
+@app.after_request
+def record_request(response):
+    """
+    按路由规则（而不是实际路径）统计，房间名等参数不会产生新的标签
+    """
+    start = g.pop('request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        request_seconds.labels(request.method, route).observe(time.perf_counter() - start)
+        requests_total.labels(request.method, route, str(response.status_code)).inc()
+    stats = g.pop('sql_stats', None)
+    if stats is not None:
+        if response.is_streamed:  # 输出时还会查询，输出结束后再统计，此时响应头已经发出
+            response.call_on_close(functools.partial(sql_profiler.finish, stats))
+        else:
+            sql_profiler.finish(stats)
+            if app.debug:
+                response.headers.update(sql_profiler.headers(stats))
+    return response
+
+
+@metrics.register_collector
+def scheduler_metrics():
+    try:
+        families = scheduler.metrics()
+    except ConnectionError:  # leader正在更换
+        families = []
+    return families + [family('hotel_scheduler_up', 'gauge', '能否取得调度器的指标', {(): 1 if families else 0})]
+
 
 @app.route('/check-in', methods=['POST'])
 @app.route('/account/create', methods=['POST'])
@@ -361,8 +880,7 @@ def create_account():
         # roomName (前台必选，管理员可选)
     :return:
     """
-    account_id = get_jwt_identity()  # 查询来自的帐号id
-    origin_account = db.session.query(Account).filter_by(accountID=account_id).one()
+    origin_account = current_account()  # 查询来自的帐号
     if origin_account.role == Role.customer:
         abort(401, "Unauthorized")  # 客户无权限访问该api
 
@@ -381,32 +899,119 @@ def create_account():
         room = db.session.query(Room).filter_by(roomName=data['roomName']).one_or_none()
         if room is None:
             abort(404, "room not found")
-        if len(room.accounts) == 0:
-            latest_settings = db.session.query(Setting).order_by(Setting.createTime.desc()).first()
-            room.queueState = QueueState.IDLE
-            room.fanSpeed = latest_settings.defaultFanSpeed
-            room.acMode = latest_settings.acMode
-            room.consumption = 0.0
-            room.acTemperature = latest_settings.defaultTemperature
-            room.customerSessionID = str(uuid.uuid4())
-            room.checkInTime = datetime.now()
+        check_in = len(room.accounts) == 0
+        if check_in:
+            room.checkInTime = datetime.now()  # 修改房间使版本号检查生效，同一房间并发的入住只有一个能提交
         elif 'check-in' in request.path:
             abort(403, "room is occupied")
         room_id = room.roomID
     else:
-        room_id = None
+        check_in, room_id = False, None
 
     try:
         new_account = Account(data['username'], data['password'], role, room_id, data.get('idCard'),
                               data.get('phoneNumber'))
         db.session.add(new_account)
-        db.session.commit()
+        commit()
     except KeyError as error:
         abort(400, f'Bad request: {error}')
 
+    if check_in:  # 提交成功后才修改调度器中的状态
+        scheduler.reset({room_id: check_in_state(get_latest_settings())})  # 空调仍开着时先关闭并移出队列
+
     return jsonify({"msg": "创建成功"}), 201
 
 
+def check_in_state(latest_settings):
+    """
+    入住时房间的温控状态：按当前设置重置空调，开始新的客户会话；空调由scheduler.reset关闭
+    """
+    return dict(fanSpeed=latest_settings.defaultFanSpeed, acMode=latest_settings.acMode,
+                consumption=0.0, lastConsumption=0.0, acTemperature=latest_settings.defaultTemperature,
+                customerSessionID=str(uuid.uuid4()))
+
+
+def batch_failed(errors):
+    """
+    批量操作中有任何一行无效时整批不执行，返回各行（从0开始）的错误
+    """
+    return jsonify(msg="batch rejected, nothing was changed", errors=errors), 400
+
+
+@app.route('/check-in/batch', methods=['POST'])
+@jwt_required()
+def batch_check_in():
+    """
+    [管理员，前台]
+    团体入住：一次为多个房间创建客户帐号，全部成功或全部不执行
+    同一房间可以有多位客人，但房间在入住前必须为空
+
+    # data
+        # guests [{roomName, username, password, idCard, phoneNumber}]
+    """
+    if current_account().role == Role.customer:
+        abort(401, "Unauthorized")
+    guests = (request.json or {}).get('guests')
+    if not isinstance(guests, list) or not guests:
+        abort(400, "guests required")
+
+    errors, complete = [], []
+    for index, guest in enumerate(guests):
+        missing = [key for key in ('roomName', 'username', 'password')
+                   if not isinstance(guest, dict) or not guest.get(key)]
+        invalid = [key for key in ('roomName', 'username', 'password', 'idCard', 'phoneNumber')
+                   if not missing and guest.get(key) is not None and not isinstance(guest[key], str)]
+        if missing:
+            errors.append(dict(row=index, msg=f"{', '.join(missing)} required"))
+        elif invalid:  # 列表、字典等不能用于查询和比较
+            errors.append(dict(row=index, msg=f"{', '.join(invalid)}: expected a string"))
+        else:
+            complete.append((index, guest))
+
+    # 房间、已入住的房间和已存在的用户名各查询一次
+    names = {guest['roomName'] for _, guest in complete}
+    rooms = dict(db.session.execute(select(Room.roomName, Room.roomID).where(Room.roomName.in_(names))).all())
+    occupied = set(db.session.scalars(select(Account.roomID).distinct().where(Account.roomID.in_(rooms.values()))))
+    usernames = [guest['username'] for _, guest in complete]
+    taken = set(db.session.scalars(select(Account.username).where(Account.username.in_(usernames))))
+    seen = set()
+    for index, guest in complete:
+        if guest['roomName'] not in rooms:
+            errors.append(dict(row=index, roomName=guest['roomName'], msg='room not found'))
+        elif rooms[guest['roomName']] in occupied:
+            errors.append(dict(row=index, roomName=guest['roomName'], msg='room is occupied'))
+        if guest['username'] in taken or guest['username'] in seen:
+            errors.append(dict(row=index, username=guest['username'], msg='username already exists'))
+        seen.add(guest['username'])
+    if errors:
+        return batch_failed(sorted(errors, key=lambda error: error['row']))
+
+    roomIDs = sorted({rooms[name] for name in names})
+    now = datetime.now()
+    # 只更新仍然没有帐号的房间，并增加版本号：与并发的入住或对这些房间的修改冲突时整批回滚
+    result = db.session.execute(update(Room).where(Room.roomID.in_(roomIDs),
+                                                   ~exists().where(Account.roomID == Room.roomID))
+                                .values(checkInTime=now, version=Room.version + 1)
+                                .execution_options(synchronize_session=False))
+    if result.rowcount != len(roomIDs):
+        db.session.rollback()
+        abort(409, "rooms were modified by another request, please retry")
+    try:
+        db.session.execute(Account.__table__.insert(), [
+            dict(username=guest['username'], password=guest['password'], role=Role.customer,
+                 roomID=rooms[guest['roomName']], idCard=guest.get('idCard'), phoneNumber=guest.get('phoneNumber'),
+                 createTime=now) for guest in guests])
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        abort(409, "some usernames were taken by another request, please retry")
+
+    latest_settings = get_latest_settings()
+    # 与batch_check_out一样先关闭空调并移出队列，再写入入住状态
+    scheduler.reset({roomID: check_in_state(latest_settings) for roomID in roomIDs})
+    return jsonify(msg="入住成功", rooms=len(roomIDs), accounts=len(guests)), 201
+
+
 @app.route('/accounts', methods=['GET'])
 @jwt_required()
 def get_accounts():
@@ -417,8 +1022,7 @@ def get_accounts():
     前台可以查看所有客户的
     :return:
     """
-    account_id = get_jwt_identity()
-    origin_role = db.session.query(Account).filter_by(accountID=account_id).one().role
+    origin_role = current_account().role
     if origin_role == Role.customer:
         abort(401, "Unauthorized")
     query = db.session.query(Account)
@@ -459,13 +1063,13 @@ def account(username=None):
     前台修改客户和自己的帐号和密码，不需要旧的密码
     管理员需要修改所有人的帐号和密码，不需要旧的密码
     """
-    account_request = db.session.query(Account).filter_by(accountID=get_jwt_identity()).one()
+    account_request = current_account()
     role_request = account_request.role
     if role_request == Role.customer and username is not None:
         abort(403, "customers should not visit other accounts")
 
-    account = account_request if username is None else db.session.query(Account).filter_by(
-        username=username).one_or_none()
+    account = db.session.get(Account, account_request.accountID) if username is None else db.session.query(
+        Account).filter_by(username=username).one_or_none()
     if account is None:
         abort(404, "account not found")
 
@@ -494,6 +1098,9 @@ def account(username=None):
                 account.username = data['username']
             if data.get('password'):
                 account.password = data['password']
+        db.session.commit()
+        account_cache.invalidate(account.accountID)
+        return jsonify({"msg": "修改成功"}), 201
 
 
 @app.route('/check-out', methods=['POST'])
@@ -508,7 +1115,7 @@ def account_delete():
         # username 帐号删除, 管理员，只能删非客户帐号
     :return:
     """
-    origin_role = db.session.query(Account).filter_by(accountID=get_jwt_identity()).one().role
+    origin_role = current_account().role
     if origin_role == Role.customer:
         abort(401, "Unauthorized")  # 客户无权访问
 
@@ -517,16 +1124,18 @@ def account_delete():
         room = db.session.query(Room).filter_by(roomName=data['roomName']).one_or_none()
         if room is None:
             abort(404, "room is already not in use")
-        room.customerSessionID = None  # 退房流程
-        room.checkInTime = None
-        room.queueState = QueueState.IDLE
-        room.consumption = 0.0
+        room.checkInTime = None  # 退房流程
         accounts = room.accounts
         if len(accounts) == 0:
             abort(404, 'room has not been checked-in yet')
+        accountIDs = [account.accountID for account in accounts]
         for account in accounts:  # 删除所有关联帐号
             db.session.delete(account)
-        db.session.commit()
+        commit()
+        account_cache.invalidate(*accountIDs)
+        if scheduler.room_state(room.roomID)['queueState'] != QueueState.IDLE:
+            scheduler.turn_off(room.roomID)  # 退房时关闭空调并产生详单记录
+        scheduler.set_state(room.roomID, customerSessionID=None, consumption=0.0, lastConsumption=0.0)
 
     elif data.get('username'):  # 提供帐号，删除帐号，只有管理员能删除非客户帐号
         account = db.session.query(Account).filter_by(username=data['username']).one_or_none()
@@ -539,10 +1148,58 @@ def account_delete():
 
         db.session.delete(account)
         db.session.commit()
+        account_cache.invalidate(account.accountID)
 
     return jsonify({"msg": "退房成功"}), 201
 
 
+@app.route('/check-out/batch', methods=['POST'])
+@jwt_required()
+def batch_check_out():
+    """
+    [管理员，前台]
+    团体退房：删除这些房间的全部客户帐号，关闭空调并产生详单，全部成功或全部不执行
+
+    # data
+        # roomNames [房间名]
+    """
+    if current_account().role == Role.customer:
+        abort(401, "Unauthorized")
+    names = (request.json or {}).get('roomNames')
+    if not isinstance(names, list) or not names:
+        abort(400, "roomNames required")
+
+    errors = [dict(row=index, msg="roomName: expected a string")
+              for index, name in enumerate(names) if not isinstance(name, str)]  # 列表、字典等不能用于查询和比较
+    if errors:
+        return batch_failed(errors)
+
+    rooms = dict(db.session.execute(select(Room.roomName, Room.roomID).where(Room.roomName.in_(names))).all())
+    occupied = set(db.session.scalars(select(Account.roomID).distinct().where(Account.roomID.in_(rooms.values()))))
+    for index, name in enumerate(names):
+        if name not in rooms:
+            errors.append(dict(row=index, roomName=name, msg='room not found'))
+        elif rooms[name] not in occupied:
+            errors.append(dict(row=index, roomName=name, msg='room has not been checked-in yet'))
+    if errors:
+        return batch_failed(errors)
+
+    roomIDs = sorted(set(rooms.values()))
+    result = db.session.execute(update(Room).where(Room.roomID.in_(roomIDs),
+                                                   exists().where(Account.roomID == Room.roomID))
+                                .values(checkInTime=None, version=Room.version + 1)
+                                .execution_options(synchronize_session=False))
+    if result.rowcount != len(roomIDs):  # 其中有房间已被并发的请求退房
+        db.session.rollback()
+        abort(409, "rooms were modified by another request, please retry")
+    accountIDs = db.session.scalars(delete(Account).where(Account.roomID.in_(roomIDs)).returning(Account.accountID)
+                                    .execution_options(synchronize_session=False)).all()
+    db.session.commit()
+    account_cache.invalidate(*accountIDs)
+    scheduler.release(roomIDs, customerSessionID=None, consumption=0.0, lastConsumption=0.0)
+    return jsonify(msg="退房成功", rooms=len(roomIDs), accounts=len(accountIDs)), 201
+
+
 @app.route('/login', methods=['POST'])
 def login():
     """
@@ -567,7 +1224,8 @@ def login():
     if result is None:
         abort(404, "wrong username or password")
     # 创建 JWT token
-    access_token = create_access_token(identity=result.accountID, expires_delta=timedelta(days=TIME_EXPIRES))
+    access_token = create_access_token(identity=result.accountID, expires_delta=timedelta(days=TIME_EXPIRES),
+                                       additional_claims=dict(role=result.role.value, roomID=result.roomID))
     return jsonify(token=access_token), 200
 
 
@@ -582,46 +1240,169 @@ def room_create():
         # roomName 房间名称
         # roomDescription 房间描述
         # unitPrice 房间单价
+        # zone 调度分区（可选）
 
     :return:
     """
-    origin_role = db.session.query(Account).filter_by(accountID=get_jwt_identity()).one().role
+    origin_role = current_account().role
     if origin_role != Role.manager:
         abort(401, "Unauthorized")
 
     data = request.json
-    latest_settings = db.session.query(Setting).order_by(Setting.createTime.desc()).first()
+    zone = data.get('zone') or default_zone(scheduler.zones)
+    if not isinstance(zone, str) or zone not in scheduler.zones:
+        abort(400, "unknown zone")
+    latest_settings = get_latest_settings()
     new_room = Room(roomName=data['roomName'],
                     roomDescription=data['roomDescription'],
                     unitPrice=data['unitPrice'],
                     acTemperature=latest_settings.defaultTemperature,
                     fanSpeed=latest_settings.defaultFanSpeed,
-                    acMode=latest_settings.acMode)
+                    acMode=latest_settings.acMode,
+                    zone=zone)
     db.session.add(new_room)
     db.session.commit()
+    scheduler.add_room(new_room)
 
     return jsonify({"msg": "创建成功"}), 201
 
 
+def existing_room_names(names, chunk=500):
+    """
+    names中已经存在的房间名，IN参数分批，不超过SQLite的参数个数限制
+    """
+    taken = set()
+    for i in range(0, len(names), chunk):
+        taken.update(db.session.scalars(select(Room.roomName).where(Room.roomName.in_(names[i:i + chunk]))))
+    return taken
+
+
+def import_rooms(rows, chunk):
+    """
+    校验后在一个事务中分批插入，返回 (创建的房间, 各行的错误)，由调用方交给调度器
+    有效的行全部创建，无效的行不影响其他行；并发导入了同名房间时整个事务回滚并返回409
+    """
+    valid, errors = validate_rooms(rows, app.config['SCHEDULER_ZONES'], default_zone(app.config['SCHEDULER_ZONES']),
+                                   existing_room_names)
+    if not valid:
+        return [], errors
+    latest_settings = get_latest_settings()
+    # 不加入会话的Room只用来生成初始状态；逐个add再flush时ORM每行一条INSERT，提交后还会逐个重新加载
+    rooms = [Room(acTemperature=latest_settings.defaultTemperature, fanSpeed=latest_settings.defaultFanSpeed,
+                  acMode=latest_settings.acMode, **fields) for _, fields in valid]
+    table = Room.__table__
+    columns = [column.name for column in table.columns if column.name not in ('roomID', 'version')]
+    # 要求RETURNING按参数顺序返回时SQLite只能逐行插入，因此按房间名对应房间ID
+    statement = table.insert().returning(table.c.roomName, table.c.roomID)
+    ids = {}
+    try:
+        for i in range(0, len(rooms), chunk):
+            ids.update(db.session.execute(statement, [dict({name: getattr(room, name) for name in columns}, version=1)
+                                                      for room in rooms[i:i + chunk]]).all())
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        abort(409, "some rooms were created by another request, please retry")
+    for room in rooms:
+        room.roomID = ids[room.roomName]
+    return rooms, errors
+
+
+@app.route('/room/import', methods=['POST'])
+@jwt_required()
+def room_import():
+    """
+    [管理员]
+    批量创建房间，请求体为JSON数组（或 {"rooms": [...]}），或Content-Type为text/csv的表格
+    每个房间：roomName, roomDescription, unitPrice, initialTemperature（可选）, zone（可选）
+    返回创建的房间数和各行（从0开始）的错误，有错误的行不会创建，其余行照常创建
+    """
+    if current_account().role != Role.manager:
+        abort(401, "Unauthorized")
+    try:
+        if request.mimetype == 'text/csv':
+            rows = parse_rooms(request.get_data(as_text=True), 'csv')
+        else:
+            rows = parse_rooms(request.get_json(), 'json')
+    except ValueError as error:
+        abort(400, f'Bad request: {error}')
+    rooms, errors = import_rooms(rows, app.config['ROOM_IMPORT_CHUNK'])
+    if rooms:
+        scheduler.add_rooms(rooms)
+    return jsonify(created=len(rooms), errors=errors), 201 if rooms or not errors else 400
+
+
+@app.cli.command('import-rooms')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--chunk', default=None, type=int, help='每次插入的行数')
+def import_rooms_command(path, chunk):
+    """
+    从CSV或JSON文件批量创建房间
+    """
+    init_db()
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        rows = parse_rooms(f.read(), 'csv' if path.endswith('.csv') else 'json')
+    rooms, errors = import_rooms(rows, chunk or app.config['ROOM_IMPORT_CHUNK'])
+    for error in errors:
+        click.echo(f"row {error['row']} {error['roomName']}: {error['msg']}")
+    click.echo(f'created {len(rooms)} rooms, {len(errors)} errors')
+    if rooms and scheduler.attach():  # 没有运行中的leader时，房间在调度器启动时从数据库载入
+        scheduler.add_rooms(rooms)
+
+
 def format(s):
     return str(s).replace(',', '.')
 
 
-def room_info(room: Room, require_details=False, for_manager=True):
+def make_etag(*parts):
+    """
+    由状态版本号等计算ETag；响应中含有currentTime等随时间变化的字段，因此作为弱ETag使用
+    """
+    return hashlib.blake2b(repr(parts).encode(), digest_size=12).hexdigest()
+
+
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag, weak=True)
+    return response
+
+
+class LiveRoom:
+    """
+    以调度器内存中的温控状态覆盖数据库中的房间字段，数据库只会在调度周期内被写回
+    """
+    def __init__(self, room, state):
+        self.room = room
+        self.state = state or {}
+
+    def __getattr__(self, name):
+        if name in self.state:
+            return self.state[name]
+        return getattr(self.room, name)
+
+
+ROOM_COLUMNS = [column for column in Room.__table__.columns]
+ROOM_INFO_FIELDS = {'roomID', 'roomName', 'roomDescription', 'roomTemperature', 'timeLeft', 'unitPrice',
+                    'acTemperature', 'fanSpeed', 'acMode', 'initialTemperature', 'queueState', 'minTemperature',
+                    'maxTemperature', 'firstRunTime', 'customerSessionID', 'consumption', 'checkInTime', 'occupied',
+                    'currentTime', 'days', 'zone', 'roomDetails'}
+ROOMS_CHUNK = 500  # /rooms每次从数据库取出和输出的房间数
+MAX_ROOMS_LIMIT = 5000  # /rooms每页房间数的上限
+
+
+def room_info(room: Room, require_details=False, for_manager=True, state=None, fields=None, details_args=None):
+    """
+    room可以是ORM对象，也可以是包含ROOM_COLUMNS各列的查询结果行
+    state为调度器中的温控状态，不传时自动读取
+    fields指定只返回的字段
+    details_args为详单的分页和过滤参数，见room_details
+    """
     if room is None:
         abort(404, "room not found")
-    if require_details and room.records is None:
-        abort(404, "record not found")
-    latest_settings = db.session.query(Setting).order_by(Setting.createTime.desc()).first()
-    if require_details:
-        if not for_manager:
-            records = db.session.query(RoomRecord).filter_by(customerSessionID=room.customerSessionID).all()
-        else:
-            records = db.session.query(RoomRecord).filter_by(roomID=room.roomID).all()
-    else:
-        records = None
+    room = LiveRoom(room, scheduler.room_state(room.roomID) if state is None else state)
+    latest_settings = get_latest_settings()
     timeLeft = (datetime.now() - room.firstRuntime) / timedelta(minutes=2) * scheduler.boost if room.firstRuntime is not None else None
-    return dict(roomID=room.roomID, roomName=room.roomName, roomDescription=room.roomDescription,
+    info = dict(roomID=room.roomID, roomName=room.roomName, roomDescription=room.roomDescription,
                 roomTemperature=room.roomTemperature, timeLeft=timeLeft, unitPrice=room.unitPrice,
                 acTemperature=max(min(room.acTemperature, latest_settings.maxTemperature), latest_settings.minTemperature),
                 fanSpeed=room.fanSpeed.value, acMode=latest_settings.acMode.value,
@@ -629,8 +1410,82 @@ def room_info(room: Room, require_details=False, for_manager=True):
                 minTemperature=latest_settings.minTemperature, maxTemperature=latest_settings.maxTemperature,
                 firstRunTime=room.firstRuntime, customerSessionID=room.customerSessionID, consumption=room.consumption,
                 checkInTime=format(room.checkInTime), occupied=room.customerSessionID is not None,
-                currentTime=format(datetime.now()), days=(datetime.now() - room.checkInTime).days + 1,
-                roomDetails=[record_info(record) for record in records] if records is not None else None)
+                currentTime=format(datetime.now()),
+                days=(datetime.now() - room.checkInTime).days + 1 if room.checkInTime is not None else None,
+                zone=room.zone, roomDetails=None)
+    if require_details:
+        info.update(room_details(room, for_manager, details_args or {}))
+    return info if fields is None else {name: info[name] for name in fields}
+
+
+def parse_time(args, name):
+    try:
+        return datetime.fromisoformat(args[name]) if args.get(name) else None
+    except ValueError:
+        abort(400, f"invalid {name}")
+
+
+MAX_DETAILS_LIMIT = 1000  # 详单每页条数的上限
+
+
+def parse_limit(args, maximum):
+    """
+    每页条数：不填时为None（返回全部），不是正整数时返回400，超过maximum时取maximum
+    """
+    if not args.get('limit'):
+        return None
+    try:
+        limit = int(args['limit'])
+    except (TypeError, ValueError):
+        abort(400, "invalid limit")
+    if limit <= 0:
+        abort(400, "limit must be positive")
+    return min(limit, maximum)
+
+
+def room_details(room, for_manager, args):
+    """
+    按 (serveEndTime, id) 分页的详单
+    # args
+        # limit 每页条数（最多MAX_DETAILS_LIMIT），不填返回全部
+        # cursor 上一页返回的nextCursor
+        # since, until 按serveEndTime过滤的时间范围（ISO格式）
+        # summary 为true时只返回汇总，不返回详单
+    """
+    if not for_manager:
+        query = db.session.query(RoomRecord).filter_by(customerSessionID=room.customerSessionID)
+    else:
+        query = db.session.query(RoomRecord).filter_by(roomID=room.roomID)
+    since, until = parse_time(args, 'since'), parse_time(args, 'until')
+    if since is not None:
+        query = query.filter(RoomRecord.serveEndTime >= since)
+    if until is not None:
+        query = query.filter(RoomRecord.serveEndTime < until)
+
+    if str(args.get('summary', '')).lower() in ('1', 'true', 'yes'):
+        count, consumption, start, end = query.with_entities(
+            func.count(RoomRecord.id), func.coalesce(func.sum(RoomRecord.consumption), 0.),
+            func.min(RoomRecord.serveStartTime), func.max(RoomRecord.serveEndTime)).one()
+        return dict(roomDetails=None, nextCursor=None,
+                    summary=dict(count=count, consumption=consumption,
+                                 firstServeStartTime=format(start), lastServeEndTime=format(end)))
+
+    if args.get('cursor'):
+        try:
+            serveEndTime, id = args['cursor'].rsplit('_', 1)
+            query = query.filter(tuple_(RoomRecord.serveEndTime, RoomRecord.id) >
+                                 tuple_(datetime.fromisoformat(serveEndTime), int(id)))
+        except ValueError:
+            abort(400, "invalid cursor")
+    query = query.order_by(RoomRecord.serveEndTime, RoomRecord.id)
+    limit = parse_limit(args, MAX_DETAILS_LIMIT)
+    if limit is not None:
+        query = query.limit(limit)
+    records = query.all()
+    nextCursor = None
+    if limit is not None and len(records) == limit and records:
+        nextCursor = f'{records[-1].serveEndTime.isoformat()}_{records[-1].id}'
+    return dict(roomDetails=[record_info(record) for record in records], nextCursor=nextCursor)
 
 
 def record_info(record: RoomRecord):
@@ -666,44 +1521,59 @@ def room(roomName=None):
             # initialTemperature, queueState, firstRunTime, customerSessionID, checkInTime, occupied
             # roomDetails
                 # id, requestTime, serveStartTime, serveEndTime, fanSpeed, acMode, rate, consumption, accumulatedConsumption
+        # 响应带有弱ETag，If-None-Match一致（房间状态和设置都没有变化）时返回304，/details除外
     :param roomName: 房间号 (不填则根据客户信息自动导航)
     :return:
     """
-    account_request = db.session.query(Account).filter_by(accountID=get_jwt_identity()).one()
-    room, role_request = account_request.room, account_request.role
+    account_request = current_account()
+    role_request = account_request.role
 
     if role_request != Role.manager and roomName is not None:
         abort(404, "only manager can visit other rooms")
     if role_request != Role.customer and roomName is None:
         abort(404, f"{role_request.value} need param roomName")
 
-    room = room if role_request == Role.customer else db.session.query(Room).filter_by(roomName=roomName).one_or_none()
+    etag = None
+    if request.method == 'GET' and 'details' not in request.path:  # 详单由写回层延迟写入，不能用状态版本号判断
+        roomID = account_request.roomID if role_request == Role.customer else db.session.query(
+            Room.roomID).filter_by(roomName=roomName).scalar()
+        version = None if roomID is None else scheduler.room_version(roomID)
+        if version is not None:  # 先取版本号再读数据，读取期间的修改最多导致下次多返回一次完整数据
+            etag = make_etag(roomID, version, settings_cache.version.current())
+            if request.if_none_match.contains_weak(etag):
+                return not_modified(etag)
+
+    room = db.session.get(Room, account_request.roomID) if role_request == Role.customer else db.session.query(
+        Room).filter_by(roomName=roomName).one_or_none()
     if room is None:
         abort(404, f"room {roomName} not found")
 
     if request.method == 'GET':
         require_details = 'details' in request.path
-        roomInfo = room_info(room, require_details=require_details, for_manager=role_request == Role.manager)
-        return jsonify(roomInfo=roomInfo), 200
+        roomInfo = room_info(room, require_details=require_details, for_manager=role_request == Role.manager,
+                             details_args=request.args)
+        response = jsonify(roomInfo=roomInfo)
+        if etag is not None:
+            response.set_etag(etag, weak=True)
+        return response, 200
 
     elif request.method == 'POST':
         data = request.json
         if role_request == Role.frontDesk:
             abort(403, "front-desk should not edit room states")
-        latest_settings = db.session.query(Setting).order_by(Setting.createTime.desc()).first()
+        latest_settings = get_latest_settings()
         if isinstance(data, dict) and len({'acTemperature', 'fanSpeed', 'state'} - set(data.keys())) > 0:  # 检测到空调状态修改请求
+            state = scheduler.room_state(room.roomID)
             if data.get('acTemperature') and latest_settings.minTemperature < int(data['acTemperature']) < latest_settings.maxTemperature:
-                room.acTemperature = int(data['acTemperature'])
+                scheduler.set_state(room.roomID, acTemperature=int(data['acTemperature']))
             if data.get('fanSpeed'):
-                if data['fanSpeed'] in FanSpeed.__dict__.keys() and data['fanSpeed'] != room.fanSpeed.value:  # 风速发生变化
-                    room.startTimePoint = datetime.now()
-                    scheduler.generate_record(room)  # 因用户操作改变风速产生详单记录
-                    room.fanSpeed = FanSpeed[data['fanSpeed']]  # 更新风速信息，并产生详单
+                if data['fanSpeed'] in FanSpeed.__dict__.keys() and data['fanSpeed'] != state['fanSpeed'].value:  # 风速发生变化
+                    scheduler.change_fan_speed(room.roomID, FanSpeed[data['fanSpeed']])  # 更新风速信息，并产生详单
             # 检测到空调开关机请求
-            if data['acState'] and room.queueState == QueueState.IDLE:
-                scheduler.turn_on(room)  # 记录requestTime
-            elif not data['acState'] and room.queueState != QueueState.IDLE:
-                scheduler.turn_off(room)  # 产生详单
+            if data['acState'] and state['queueState'] == QueueState.IDLE:
+                scheduler.turn_on(room.roomID)  # 记录requestTime
+            elif not data['acState'] and state['queueState'] != QueueState.IDLE:
+                scheduler.turn_off(room.roomID)  # 产生详单
 
         if role_request != Role.manager and (data.get('roomName') or data.get('roomDescription')):
             abort(401, "Unauthorized")
@@ -711,7 +1581,9 @@ def room(roomName=None):
             room.roomName = data['roomName']
         if data.get('roomDescription'):
             room.roomDescription = data['roomDescription']
-        db.session.commit()
+        commit()
+        if data.get('roomName') or data.get('roomDescription'):
+            scheduler.touch(room.roomID)  # 使GET的ETag失效
         return jsonify({"msg": "状态更新成功"}), 201
 
 
@@ -721,14 +1593,203 @@ def get_rooms():
     """
     [管理员，前台]
     查看所房间状态
+    # args
+        # cursor 上一页返回的nextCursor
+        # limit 每页扫描的房间数（最多MAX_ROOMS_LIMIT），按状态筛选时返回的房间可能更少，不填返回全部
+        # fields 逗号分隔的字段名，如 roomName,roomTemperature,queueState
+        # queueState IDLE/PENDING/RUNNING
+        # occupied true/false
+    响应带有弱ETag，If-None-Match一致（所有房间和设置都没有变化）时返回304
     :return:
     """
-    role_request = db.session.query(Account).filter_by(accountID=get_jwt_identity()).one().role
+    role_request = current_account().role
     if role_request == Role.customer:
         abort(401, "Unauthorized")
-    rooms = db.session.query(Room).all()
-    rooms_info = [room_info(room) for room in rooms]
-    return jsonify(roomsInfo=rooms_info), 200
+
+    etag = make_etag(scheduler.versions(), settings_cache.version.current(), request.query_string)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+
+    args = request.args
+    fields = args['fields'].split(',') if args.get('fields') else None
+    if fields is not None and not set(fields) <= ROOM_INFO_FIELDS:
+        abort(400, f"unknown fields: {','.join(set(fields) - ROOM_INFO_FIELDS)}")
+    limit = parse_limit(args, MAX_ROOMS_LIMIT)
+    try:
+        cursor = int(args['cursor']) if args.get('cursor') else None
+    except ValueError:
+        abort(400, "invalid cursor")
+    queueState = args.get('queueState')
+    if queueState is not None and queueState not in QueueState.__members__:
+        abort(400, "invalid queueState")
+    occupied = args.get('occupied')
+    occupied = None if occupied is None else occupied.lower() in ('1', 'true', 'yes')
+
+    query = db.session.query(*ROOM_COLUMNS).order_by(Room.roomID)  # 只取列，不构造ORM对象
+    if cursor is not None:
+        query = query.filter(Room.roomID > cursor)
+    # 数据库中的队列状态和入住状态落后于内存（写回有延迟），只按内存中的状态过滤，limit是扫描的房间数
+    if limit is not None:
+        query = query.limit(limit)
+
+    def generate():
+        rows = iter(query.yield_per(ROOMS_CHUNK))
+        yield '{"roomsInfo": ['
+        scanned, last, first = 0, None, True
+        while True:
+            chunk = list(itertools.islice(rows, ROOMS_CHUNK))
+            if not chunk:
+                break
+            states = scheduler.room_states([row.roomID for row in chunk])
+            for row, state in zip(chunk, states):
+                scanned, last = scanned + 1, row.roomID
+                current = state if state is not None else row._mapping  # 尚未载入调度器的房间用数据库中的状态
+                if queueState is not None and current['queueState'].value != queueState:
+                    continue
+                if occupied is not None and (current['customerSessionID'] is not None) != occupied:
+                    continue
+                yield ('' if first else ', ') + app.json.dumps(room_info(row, state=state, fields=fields))
+                first = False
+        nextCursor = last if limit is not None and scanned == limit else None
+        yield '], "nextCursor": ' + app.json.dumps(nextCursor) + '}'
+
+    response = Response(stream_with_context(generate()), mimetype='application/json')
+    response.set_etag(etag, weak=True)
+    return response, 200
+
+
+def event_stream(subscription, snapshot):
+    """
+    Server-Sent Events：先发送一次完整的实时字段（snapshot），之后每个调度节拍发送一次有变化的字段（update）
+    """
+    try:
+        yield f'event: snapshot\ndata: {app.json.dumps(snapshot)}\n\n'
+        while True:
+            data = subscription.get(timeout=15)
+            yield ': keep-alive\n\n' if data is None else f'event: update\ndata: {data}\n\n'
+    finally:
+        room_events.unsubscribe(subscription)
+
+
+def event_response(stream):
+    return Response(stream, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/room/events', methods=['GET'])
+@jwt_required(locations=['headers', 'query_string'])  # EventSource不能设置请求头，可以用 ?jwt=<token>
+def room_event_stream():
+    """
+    [客户]
+    推送自己房间的实时状态，代替轮询 /room
+    update事件: roomID 以及 roomTemperature, acTemperature, fanSpeed, queueState, consumption, timeLeft, occupied 中有变化的字段
+    """
+    account = current_account()
+    if account.role != Role.customer:
+        abort(404, f"{account.role.value} should use /rooms/events")
+    subscription = room_events.subscribe(account.roomID)
+    state = scheduler.room_state(account.roomID)
+    if state is None:
+        room_events.unsubscribe(subscription)
+        abort(404, "room not found")
+    snapshot = dict(roomID=account.roomID, **live_fields(state, scheduler.boost, datetime.now()))
+    return event_response(event_stream(subscription, snapshot))
+
+
+@app.route('/rooms/events', methods=['GET'])
+@jwt_required(locations=['headers', 'query_string'])
+def rooms_event_stream():
+    """
+    [管理员，前台]
+    推送全部房间的实时状态，代替轮询 /rooms
+    snapshot事件: rooms {roomID: 房间名和全部实时字段}
+    update事件: rooms {roomID: 有变化的字段}，每个调度节拍一次
+    """
+    if current_account().role == Role.customer:
+        abort(401, "Unauthorized")
+    subscription = room_events.subscribe()  # 先订阅再读取快照，快照之后的变化不会丢失
+    rooms = db.session.query(Room.roomID, Room.roomName).order_by(Room.roomID).all()
+    now = datetime.now()
+    snapshot = {}
+    for (roomID, roomName), state in zip(rooms, scheduler.room_states([room.roomID for room in rooms])):
+        if state is not None:
+            snapshot[roomID] = dict(roomName=roomName, **live_fields(state, scheduler.boost, now))
+    db.session.close()  # 推送期间不占用数据库连接
+    return event_response(event_stream(subscription, dict(rooms=snapshot)))
+
+
+@app.route('/reports/consumption', methods=['GET'])
+@jwt_required()
+def consumption_report():
+    """
+    [管理员]
+    用量和费用报表，直接读取汇总表
+    # args
+        # groupBy 逗号分隔的分组方式：room, session, day, fanSpeed，默认room,day
+        # roomName
+        # since, until 日期范围（包含since，不包含until）
+    :return:
+    """
+    if current_account().role != Role.manager:
+        abort(401, "Unauthorized")
+
+    groups = {'room': [ConsumptionRollup.roomID, Room.roomName], 'session': [ConsumptionRollup.customerSessionID],
+              'day': [ConsumptionRollup.day], 'fanSpeed': [ConsumptionRollup.fanSpeed]}
+    groupBy = request.args.get('groupBy', 'room,day').split(',')
+    if not set(groupBy) <= set(groups):
+        abort(400, "invalid groupBy")
+    columns = [column for name in groups if name in groupBy for column in groups[name]]
+
+    query = db.session.query(*columns, func.sum(ConsumptionRollup.records), func.sum(ConsumptionRollup.duration),
+                             func.sum(ConsumptionRollup.consumption), func.sum(ConsumptionRollup.cost))
+    query = query.select_from(ConsumptionRollup).outerjoin(Room, Room.roomID == ConsumptionRollup.roomID)
+    if request.args.get('roomName'):
+        query = query.filter(Room.roomName == request.args['roomName'])
+    since, until = parse_time(request.args, 'since'), parse_time(request.args, 'until')
+    if since is not None:
+        query = query.filter(ConsumptionRollup.day >= since.date())
+    if until is not None:
+        query = query.filter(ConsumptionRollup.day < until.date())
+    rows = query.group_by(*columns).order_by(*columns).all()
+
+    report = []
+    for row in rows:
+        *keys, records, duration, consumption, cost = row
+        item = dict(zip([column.key for column in columns], keys))
+        if 'day' in item:
+            item['day'] = item['day'].isoformat()
+        if 'fanSpeed' in item:
+            item['fanSpeed'] = item['fanSpeed'].value
+        item.update(records=records, duration=duration, consumption=consumption, cost=cost)
+        report.append(item)
+    return jsonify(report=report), 200
+
+
+@app.cli.command('rebuild-rollups')
+@click.option('--chunk', default=10000, help='每个事务处理的详单数')
+def rebuild_rollups(chunk):
+    """
+    从room_records重新生成consumption_rollups
+    """
+    init_db()
+    table = RoomRecord.__table__
+
+    def max_id(connection):
+        return connection.execute(select(func.max(table.c.id))).scalar() or 0
+
+    def chunks(last):
+        after = 0
+        while True:
+            with db.engine.connect() as connection:
+                rows = connection.execute(select(table).where(table.c.id > after, table.c.id <= last)
+                                          .order_by(table.c.id).limit(chunk)).all()
+            if not rows:
+                return
+            after = rows[-1].id
+            yield [row._mapping for row in rows]
+
+    total = consumption_rollup.rebuild(writer_engine, max_id, chunks)
+    click.echo(f'rebuilt rollups from {total} records')
 
 
 @app.route('/room/delete', methods=['POST'])
@@ -741,7 +1802,7 @@ def delete_room():
         # roomName
     :return:
     """
-    role_request = db.session.query(Account).filter_by(accountID=get_jwt_identity()).one().role
+    role_request = current_account().role
     if role_request != Role.manager:
         abort(401, "Unauthorized")
 
@@ -753,7 +1814,8 @@ def delete_room():
         abort(401, "room occupied, please check-out first")
 
     db.session.delete(room_to_delete)
-    db.session.commit()
+    commit()
+    scheduler.remove_room(room_to_delete.roomID)
     return jsonify({"msg": "注销成功"}), 201
 
 
@@ -772,8 +1834,7 @@ def change_settings():
         # rate
     :return:
     """
-    account_request = db.session.query(Account).filter_by(accountID=get_jwt_identity()).one()
-    if account_request.role != Role.manager:
+    if current_account().role != Role.manager:
         abort(401, "Unauthorized")
 
     if request.method == 'POST':
@@ -783,8 +1844,9 @@ def change_settings():
                           minTemperature=data['minTemperature'], maxTemperature=data['maxTemperature'])
         db.session.add(setting)
         db.session.commit()
+        settings_cache.invalidate()
     else:
-        setting = db.session.query(Setting).order_by(Setting.createTime.desc()).first()
+        setting = get_latest_settings()
 
     return jsonify(settingID=setting.settingID, lastEditTime=str(setting.createTime), rate=setting.rate,
                    defaultFanSpeed=setting.defaultFanSpeed.value,
@@ -793,5 +1855,37 @@ def change_settings():
                    acMode=setting.acMode.value), 201 if request.method == 'POST' else 200
 
 
+@app.route('/scheduler', methods=['GET', 'POST'])
+@jwt_required()
+def scheduler_state():
+    """
+    [管理员]
+    查看各调度分区的运行状态和节拍耗时统计，或启动、停止、暂停、恢复调度器
+    # data
+        # action (start, stop, pause, resume)
+    :return:
+    """
+    if current_account().role != Role.manager:
+        abort(401, "Unauthorized")
+
+    if request.method == 'POST':
+        action = request.json.get('action')
+        if action not in ('start', 'stop', 'pause', 'resume'):
+            abort(400, "invalid action")
+        getattr(scheduler, action)()
+
+    return jsonify(worker=os.getpid(), **scheduler.report()), 201 if request.method == 'POST' else 200
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Prometheus文本格式的指标，供监控系统抓取，不需要登录
+    多进程部署时请求指标只包含处理本次抓取的进程，调度器指标总是来自leader
+    :return:
+    """
+    return Response(metrics.exposition(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
+    create_app().run(host='0.0.0.0', port=5000)
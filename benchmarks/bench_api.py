@@ -0,0 +1,110 @@
+"""
+接口基准：在临时SQLite库中建好房间、入住的客户和详单，用Flask测试客户端逐个请求，统计耗时和每个请求的SQL条数
+测试客户端不经过网络和WSGI服务器，结果反映的是视图、数据库和调度器本身的开销；并发下的表现见HTTP压测
+调度节拍在测量期间暂停，每次请求看到的数据量相同
+    python benchmarks/bench_api.py [--rooms 200] [--records 100] [--save]
+"""
+import random
+import time
+from datetime import datetime, timedelta
+
+from common import QueryCounter, finish, parser, summarize, use_scratch_instance
+
+use_scratch_instance()
+
+from sqlalchemy import insert  # noqa: E402
+
+import app as hotel  # noqa: E402
+from utils.enums import AcMode, FanSpeed, Role  # noqa: E402
+
+
+def seed(client, rooms, records_per_room, rng):
+    """
+    通过接口创建房间并办理入住，详单直接批量插入；返回管理员的请求头和各客户的登录信息
+    """
+    with hotel.app.app_context():
+        hotel.db.session.add(hotel.Account('bench-manager', 'bench', Role.manager))
+        hotel.db.session.add(hotel.Setting(1., FanSpeed.MEDIUM, 25, 16, 30, AcMode.HEAT))
+        hotel.db.session.commit()
+    token = client.post('/login', json=dict(username='bench-manager', password='bench', role='manager')).json['token']
+    manager = {'Authorization': 'Bearer ' + token}
+
+    customers = []
+    for i in range(rooms):
+        response = client.post('/room/create', json=dict(roomName=f'bench-{i}', roomDescription='', unitPrice=100),
+                               headers=manager)
+        assert response.status_code == 201, response.data
+        login = dict(username=f'guest-{i}', password='bench', role='customer')
+        response = client.post('/check-in', json=dict(login, roomName=f'bench-{i}', idCard=str(i), phoneNumber=str(i)),
+                               headers=manager)
+        assert response.status_code == 201, response.data
+        customers.append(login)
+
+    with hotel.app.app_context():
+        roomIDs = [roomID for roomID, in hotel.db.session.query(hotel.Room.roomID)]
+        now = datetime.now()
+        rows = []
+        for roomID in roomIDs:
+            session = hotel.scheduler.room_state(roomID)['customerSessionID']
+            for k in range(records_per_room):
+                end = now - timedelta(minutes=k)
+                rows.append(dict(roomID=roomID, customerSessionID=session, requestTime=end, serveStartTime=end,
+                                 serveEndTime=end, fanSpeed=rng.choice(list(FanSpeed)), acMode=AcMode.HEAT, rate=1.,
+                                 consumption=0.5, accumulatedConsumption=0.5 * (k + 1)))
+        if rows:
+            hotel.db.session.execute(insert(hotel.RoomRecord), rows)
+        hotel.db.session.commit()
+    return manager, customers
+
+
+def bench(client, queries, request, repeat):
+    """
+    request(i) 发出第i个请求并返回响应；读完响应体才算结束（/rooms是流式输出）
+    """
+    samples = []
+    before = queries.count
+    for i in range(repeat):
+        t = time.perf_counter()
+        response = request(i)
+        response.get_data()
+        samples.append(time.perf_counter() - t)
+        assert response.status_code < 400, (response.status_code, response.data)
+        response.close()
+    return summarize(samples, queries=(queries.count - before) / repeat)
+
+
+def main():
+    argument_parser = parser(__doc__.strip().splitlines()[0])
+    argument_parser.add_argument('--rooms', type=int, default=200, help='房间数（每个房间一位入住的客户）')
+    argument_parser.add_argument('--records', type=int, default=100, help='每个房间本次入住的详单数')
+    argument_parser.add_argument('--repeat', type=int, default=300, help='每个接口请求的次数')
+    args = argument_parser.parse_args()
+
+    client = hotel.create_app().test_client()
+    manager, customers = seed(client, args.rooms, args.records, random.Random(0))
+    hotel.scheduler.pause()
+    tokens = [{'Authorization': 'Bearer ' + client.post('/login', json=login).json['token']} for login in customers]
+    etags = [client.get('/room', headers=headers).headers['ETag'] for headers in tokens]
+    queries = QueryCounter(hotel.reader_engine)
+    n = len(customers)
+
+    cases = {
+        'POST /login': lambda i: client.post('/login', json=customers[i % n]),
+        'GET /room': lambda i: client.get('/room', headers=tokens[i % n]),
+        'GET /room (If-None-Match)': lambda i: client.get('/room', headers=dict(tokens[i % n],
+                                                                                **{'If-None-Match': etags[i % n]})),
+        'GET /room/details': lambda i: client.get('/room/details', headers=tokens[i % n]),
+        'GET /rooms': lambda i: client.get('/rooms', headers=manager),
+        'GET /rooms?limit=50': lambda i: client.get('/rooms?limit=50&fields=roomName,roomTemperature,queueState',
+                                                    headers=manager),
+    }
+    results = {}
+    for name, request in cases.items():
+        bench(client, queries, request, min(args.repeat, 10))  # 预热连接池和缓存
+        results[name] = bench(client, queries, request, args.repeat)
+    params = dict(rooms=args.rooms, records=args.records, repeat=args.repeat)
+    finish('api', results, args, params)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+room_records索引与过期清理的基准：在临时SQLite库中生成大量详单，对比建索引前后的详单查询耗时，并测量分批清理
+    python benchmarks/bench_room_records.py [--records 3000000] [--rooms 1000] [--repeat 20] [--save]
+"""
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from common import finish, parser, summarize
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import Column, DateTime, Float, Integer, MetaData, String, Table, create_engine  # noqa: E402
+
+from utils.retention import RetentionJob  # noqa: E402
+
+INDEXES = [  # 与app.py中RoomRecord.__table_args__一致
+    'CREATE INDEX ix_room_records_serveEndTime ON room_records (serveEndTime)',
+    'CREATE INDEX ix_room_records_roomID_serveEndTime ON room_records (roomID, serveEndTime, id)',
+    'CREATE INDEX ix_room_records_customerSessionID_serveEndTime ON room_records (customerSessionID, serveEndTime, id)',
+]
+
+
+def seed(path, n, rooms):
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE room_records (id INTEGER PRIMARY KEY, roomID INTEGER, customerSessionID VARCHAR, '
+                       'requestTime DATETIME, serveStartTime DATETIME, serveEndTime DATETIME, fanSpeed VARCHAR(6), '
+                       'acMode VARCHAR(4), rate FLOAT, consumption FLOAT, accumulatedConsumption FLOAT)')
+    rng = random.Random(0)
+    start = datetime.now() - timedelta(days=4 * 365)  # 约四分之一的记录超过3年
+    span = 4 * 365 * 24 * 3600
+
+    def rows():
+        for i in range(n):
+            end = start + timedelta(seconds=span * i / n)
+            roomID = rng.randrange(rooms)
+            session = f'{roomID}-{i * 50 // n}'  # 每个房间约50次入住
+            yield roomID, session, end, end, end, 'MEDIUM', 'HEAT', 1., 0.5, 0.5
+
+    connection.executemany('INSERT INTO room_records (roomID, customerSessionID, requestTime, serveStartTime, '
+                           'serveEndTime, fanSpeed, acMode, rate, consumption, accumulatedConsumption) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows())
+    connection.commit()
+    return connection
+
+
+def lookups(connection, rooms, repeat, label):
+    rng = random.Random(1)
+    result = {}
+    for name, sql, param in (
+            ('by roomID', 'SELECT * FROM room_records WHERE roomID = ? ORDER BY serveEndTime, id',
+             lambda: rng.randrange(rooms)),
+            ('by customerSessionID', 'SELECT * FROM room_records WHERE customerSessionID = ? ORDER BY serveEndTime, id',
+             lambda: f'{rng.randrange(rooms)}-{rng.randrange(50)}')):
+        samples = []
+        for _ in range(repeat):
+            t = time.perf_counter()
+            connection.execute(sql, (param(),)).fetchall()
+            samples.append(time.perf_counter() - t)
+        result[f'{name} {label}'] = summarize(samples)
+    return result
+
+
+def main():
+    argument_parser = parser(__doc__.strip().splitlines()[0])
+    argument_parser.add_argument('--records', type=int, default=3000000, help='生成的详单数')
+    argument_parser.add_argument('--rooms', type=int, default=1000, help='房间数')
+    argument_parser.add_argument('--repeat', type=int, default=20, help='每种查询测量的次数')
+    args = argument_parser.parse_args()
+
+    n, rooms = args.records, args.rooms
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'records.db')
+        t = time.perf_counter()
+        connection = seed(path, n, rooms)
+        print(f'seeded {n} records for {rooms} rooms in {time.perf_counter() - t:.1f}s')
+
+        results = lookups(connection, rooms, args.repeat, 'without index')
+        t = time.perf_counter()
+        for sql in INDEXES:
+            connection.execute(sql)
+        connection.commit()
+        print(f'created indexes in {time.perf_counter() - t:.1f}s')
+        results.update(lookups(connection, rooms, args.repeat, 'with index'))
+        connection.close()
+
+        table = Table('room_records', MetaData(), Column('id', Integer, primary_key=True), Column('roomID', Integer),
+                      Column('customerSessionID', String), Column('serveEndTime', DateTime),
+                      Column('consumption', Float))
+        job = RetentionJob(create_engine(f'sqlite:///{path}'), table, table.c.serveEndTime,
+                           keep=timedelta(days=3 * 365), batch_size=5000, pause=0)
+        job.run()
+        results['retention run'] = summarize([job.stats['lastDuration']])  # 一次清理，分批大小为batch_size
+        print(f"retention deleted {job.stats['deleted']} records in batches of {job.batch_size}")
+    finish('room_records', results, args, dict(records=n, rooms=rooms, repeat=args.repeat))
+
+
+if __name__ == '__main__':
+    main()
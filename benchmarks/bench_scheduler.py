@@ -0,0 +1,95 @@
+"""
+调度器基准：不同房间数和排队深度下一个调度节拍的耗时，以及开关空调的耗时
+一个节拍 = 各分区的update（温度推进、出队入队）+ ACScheduler.update（取出改动、推送、写回）
+写回间隔设为0，每个节拍都写库，与默认配置下每秒一个节拍、每秒写回一次一致
+    python benchmarks/bench_scheduler.py [--rooms 10,100,1000,10000] [--active 0,0.1,1] [--save]
+"""
+import random
+
+from common import QueryCounter, finish, measure, parser, summarize, use_scratch_instance
+
+use_scratch_instance()
+
+import app as hotel  # noqa: E402
+from utils.enums import AcMode, FanSpeed, QueueState  # noqa: E402
+
+
+def seed(n, active, rng):
+    """
+    重新生成n个房间，其中active个已开空调（PENDING），由initialize恢复到等待队列
+    其余房间处于室温，节拍中没有改动
+    """
+    with hotel.app.app_context():
+        hotel.db.session.query(hotel.RoomRecord).delete()
+        hotel.db.session.query(hotel.Room).delete()
+        if hotel.db.session.query(hotel.Setting).first() is None:
+            hotel.db.session.add(hotel.Setting(1., FanSpeed.MEDIUM, 25, 16, 30, AcMode.HEAT))
+        rooms = []
+        for i in range(n):
+            room = hotel.Room(f'bench-{i}', '', 100, 25, rng.choice(list(FanSpeed)), AcMode.HEAT,
+                              initialTemperature=rng.uniform(15, 35))
+            if i < active:
+                room.queueState = QueueState.PENDING
+                room.requestTime = hotel.datetime.now()
+                room.roomTemperature += rng.uniform(-5, 5)  # 开过空调的房间等待期间回温，每个节拍都有改动
+            rooms.append(room)
+        hotel.db.session.add_all(rooms)
+        hotel.db.session.commit()
+        return [room.roomID for room in rooms[:active]]
+
+
+def bench_size(n, fraction, capacity, repeat, rng, queries):
+    active = int(n * fraction)
+    active_ids = seed(n, active, rng)
+    scheduler = hotel.ACScheduler(hotel.db, flush_interval=0, record_delay=0, zones={hotel.DEFAULT_ZONE: capacity})
+    scheduler.initialize(hotel.writer_engine)
+    shards = list(scheduler.shards.values())
+    results = {}
+    try:
+        def tick():
+            for shard in shards:
+                shard.update()
+            scheduler.update()
+
+        measure(tick, 3)  # 预热：第一批入队房间开始运行
+        before = queries.count
+        samples = measure(tick, repeat)
+        results[f'tick rooms={n} active={active}'] = summarize(samples, queries=(queries.count - before) / repeat)
+        results[f'shard.update rooms={n} active={active}'] = summarize(
+            measure(lambda: [shard.update() for shard in shards], repeat))
+
+        if active_ids:
+            ids = [rng.choice(active_ids) for _ in range(repeat)]
+            it = iter(ids)
+            off = measure(lambda: scheduler.turn_off(next(it)), repeat)
+            it = iter(ids)
+            on = measure(lambda: scheduler.turn_on(next(it)), repeat)
+            results[f'turn_off rooms={n} active={active}'] = summarize(off)
+            results[f'turn_on rooms={n} active={active}'] = summarize(on)
+    finally:
+        scheduler.close()
+    return results
+
+
+def main():
+    argument_parser = parser(__doc__.strip().splitlines()[0])
+    argument_parser.add_argument('--rooms', default='10,100,1000,10000', help='逗号分隔的房间数')
+    argument_parser.add_argument('--active', default='0,0.1,1', help='逗号分隔的开空调房间比例（排队深度）')
+    argument_parser.add_argument('--capacity', type=int, default=3, help='同时送风的房间数')
+    argument_parser.add_argument('--repeat', type=int, default=100, help='每种情况测量的次数')
+    args = argument_parser.parse_args()
+
+    hotel.create_app(start_scheduler=False)  # 只建表，测量用的调度器各自创建
+    queries = QueryCounter(hotel.writer_engine)
+    rng = random.Random(0)
+    results = {}
+    for n in map(int, args.rooms.split(',')):
+        for fraction in map(float, args.active.split(',')):
+            results.update(bench_size(n, fraction, args.capacity, args.repeat, rng, queries))
+            print(f'rooms={n} active={fraction:g} done')
+    params = dict(rooms=args.rooms, active=args.active, capacity=args.capacity, repeat=args.repeat)
+    finish('scheduler', results, args, params)
+
+
+if __name__ == '__main__':
+    main()
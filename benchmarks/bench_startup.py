@@ -0,0 +1,102 @@
+"""
+冷启动基准：每次在新进程中分别测量导入app、create_app（建表检查）和调度器启动（选举、从数据库恢复队列、开始调度）的耗时
+每次启动前把开空调的房间恢复为RUNNING，与服务在送风期间退出后重启的状态一致
+journal=no 每次启动前删除队列事件日志（首次启动或关闭了日志），journal=yes 从上一次启动写下的快照恢复
+    python benchmarks/bench_startup.py [--rooms 1000,10000] [--active 0.3] [--repeat 5] [--save]
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+from common import ROOT, QueryCounter, finish, parser, summarize, use_scratch_instance
+
+PHASES = ('import', 'create_app', 'scheduler.start')
+
+
+def child():
+    """
+    在子进程中运行：导入app之前不能有任何app的模块被导入
+    """
+    sys.path.insert(0, ROOT)
+    started = time.perf_counter()
+    import app as hotel
+    imported = time.perf_counter()
+    hotel.create_app(start_scheduler=False)
+    created = time.perf_counter()
+    queries = QueryCounter(hotel.writer_engine)
+    hotel.scheduler.elect()
+    ready = time.perf_counter()
+    print(json.dumps({'import': imported - started, 'create_app': created - imported,
+                      'scheduler.start': ready - created, 'queries': queries.count}))
+    sys.stdout.flush()
+    os._exit(0)  # 不等待写回和清理线程
+
+
+def seed(hotel, n, active):
+    """
+    重新生成n个房间，返回其中active个开空调的房间ID
+    """
+    with hotel.app.app_context():
+        hotel.db.session.query(hotel.Account).delete()
+        hotel.db.session.query(hotel.Room).delete()
+        if hotel.db.session.query(hotel.Setting).first() is None:
+            hotel.db.session.add(hotel.Setting(1., hotel.FanSpeed.MEDIUM, 25, 16, 30, hotel.AcMode.HEAT))
+        hotel.db.session.commit()
+        rooms, errors = hotel.import_rooms([dict(roomName=f'bench-{i}', roomDescription='', unitPrice=100)
+                                            for i in range(n)], 1000)
+        assert not errors, errors[:3]
+        return [room.roomID for room in rooms[:active]]
+
+
+def reset(hotel, active_ids, journal):
+    if not journal:
+        shutil.rmtree(os.path.join(hotel.app.instance_path, 'journal'), ignore_errors=True)
+    now = datetime.now()
+    with hotel.writer_engine.begin() as connection:
+        connection.execute(hotel.update(hotel.Room.__table__).where(hotel.Room.roomID.in_(active_ids))
+                           .values(queueState=hotel.QueueState.RUNNING, requestTime=now, firstRuntime=now,
+                                   startTimePoint=now))
+
+
+def main():
+    argument_parser = parser(__doc__.strip().splitlines()[0])
+    argument_parser.add_argument('--rooms', default='1000,10000', help='逗号分隔的房间数')
+    argument_parser.add_argument('--active', type=float, default=0.3, help='重启前开空调的房间比例')
+    argument_parser.add_argument('--repeat', type=int, default=5, help='每种房间数启动的次数')
+    args = argument_parser.parse_args()
+
+    use_scratch_instance()
+    import app as hotel
+    hotel.create_app(start_scheduler=False)  # 本进程只准备数据，不参与选举
+    results = {}
+    for n in map(int, args.rooms.split(',')):
+        active_ids = seed(hotel, n, int(n * args.active))
+        for journal in (False, True):
+            samples = {phase: [] for phase in PHASES}
+            queries = []
+            for _ in range(args.repeat):
+                reset(hotel, active_ids, journal)
+                output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child'], check=True,
+                                        capture_output=True, text=True).stdout
+                timings = json.loads(output.strip().splitlines()[-1])
+                for phase in PHASES:
+                    samples[phase].append(timings[phase])
+                queries.append(timings['queries'])
+            for phase in PHASES:
+                extra = dict(queries=sum(queries) / len(queries)) if phase == 'scheduler.start' else {}
+                name = f'{phase} rooms={n} active={len(active_ids)} journal={"yes" if journal else "no"}'
+                results[name] = summarize(samples[phase], **extra)
+        print(f'rooms={n} done')
+    params = dict(rooms=args.rooms, active=args.active, repeat=args.repeat)
+    finish('startup', results, args, params)
+
+
+if __name__ == '__main__':
+    if '--child' in sys.argv:
+        child()
+    else:
+        main()
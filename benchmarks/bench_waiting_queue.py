@@ -0,0 +1,74 @@
+"""
+等待队列微基准：对比原先基于heapq列表的实现与IndexedHeap
+    python benchmarks/bench_waiting_queue.py [--rooms 10000] [--ops 200] [--save]
+"""
+import heapq
+import os
+import random
+import sys
+
+from common import finish, measure, parser, summarize
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.pqueue import IndexedHeap  # noqa: E402
+
+
+class ListQueue:
+    """
+    原ACScheduler中的做法：heapq列表 + 线性扫描
+    """
+    def __init__(self):
+        self.queue = []
+
+    def push(self, roomID, priority):
+        heapq.heappush(self.queue, (*priority, roomID))
+
+    def __contains__(self, roomID):
+        for p, t, id, in self.queue:
+            if id == roomID:
+                return True
+        return False
+
+    def remove(self, roomID):
+        self.queue = [(priority, t, id) for priority, t, id in self.queue if id != roomID]
+        heapq.heapify(self.queue)
+
+    def update(self, roomID, priority):  # 原实现不支持，用删除再插入模拟
+        self.remove(roomID)
+        self.push(roomID, priority)
+
+    def pop(self):
+        return heapq.heappop(self.queue)
+
+
+def bench(name, queue_cls, n, ops):
+    rng = random.Random(0)
+    queue = queue_cls()
+    for roomID in range(n):
+        queue.push(roomID, (rng.randint(1, 3), float(roomID)))
+    ids = [rng.randrange(n) for _ in range(ops)]
+    it = iter(ids)
+    results = {f'{name} contains': measure(lambda: next(it) in queue, ops)}
+    it = iter(ids)
+    results[f'{name} update'] = measure(lambda: queue.update(next(it), (rng.randint(1, 3), rng.random())), ops)
+    it = iter(ids)
+    results[f'{name} remove'] = measure(lambda: queue.remove(next(it)), ops)
+    results[f'{name} pop'] = measure(queue.pop, ops)
+    return {case: summarize(samples) for case, samples in results.items()}
+
+
+def main():
+    argument_parser = parser(__doc__.strip().splitlines()[0])
+    argument_parser.add_argument('--rooms', type=int, default=10000, help='队列中的房间数')
+    argument_parser.add_argument('--ops', type=int, default=200, help='每种操作测量的次数')
+    args = argument_parser.parse_args()
+
+    results = {}
+    for name, cls in (('heapq list', ListQueue), ('IndexedHeap', IndexedHeap)):
+        results.update(bench(name, cls, args.rooms, args.ops))
+    finish('waiting_queue', results, args, dict(rooms=args.rooms, ops=args.ops))
+
+
+if __name__ == '__main__':
+    main()
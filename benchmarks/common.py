@@ -0,0 +1,146 @@
+"""
+基准脚本共用的计时、SQL计数和基线比较
+基线保存在 benchmarks/baselines/<基准名>.json，与运行机器相关，换机器后应重新保存
+"""
+import argparse
+import atexit
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINES = os.path.join(ROOT, 'benchmarks', 'baselines')
+
+
+def use_scratch_instance():
+    """
+    在导入app之前调用：数据库、leader锁等放在临时目录中，不影响本机正在运行的服务
+    """
+    directory = tempfile.mkdtemp(prefix='hotel-bench-')
+    os.environ['HOTEL_INSTANCE_PATH'] = directory
+    atexit.register(shutil.rmtree, directory, ignore_errors=True)  # 先注册的后执行，在app退出时写回之后删除
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    return directory
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    index = min(int(round(q / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def summarize(samples, **extra):
+    """
+    耗时样本（秒）-> 毫秒为单位的统计，extra中的指标（如每次请求的SQL条数）原样保留
+    """
+    total = sum(samples)
+    result = dict(n=len(samples), mean=total / len(samples) * 1e3, p50=percentile(samples, 50) * 1e3,
+                  p99=percentile(samples, 99) * 1e3, throughput=len(samples) / total if total else None)
+    result.update(extra)
+    return result
+
+
+def measure(fn, repeat, warmup=0):
+    """
+    逐次调用fn，返回每次的耗时（秒）
+    """
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t)
+    return samples
+
+
+class QueryCounter:
+    """
+    统计engine上执行的SQL条数
+    """
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self.on_execute)
+
+    def on_execute(self, *args):
+        self.count += 1
+
+
+def parser(description):
+    argument_parser = argparse.ArgumentParser(description=description)
+    argument_parser.add_argument('--save', action='store_true', help='把本次结果保存为基线')
+    argument_parser.add_argument('--threshold', type=float, default=1.25,
+                                 help='p50或p99超过基线的这个倍数时视为退化，默认1.25')
+    argument_parser.add_argument('--output', help='另外把本次结果写入这个JSON文件')
+    return argument_parser
+
+
+def print_table(results):
+    print(f"{'case':<40}{'n':>7}{'p50 ms':>11}{'p99 ms':>11}{'ops/s':>11}{'queries':>9}")
+    for name, result in results.items():
+        queries = result.get('queries')
+        print(f"{name:<40}{result['n']:>7}{result['p50']:>11.3f}{result['p99']:>11.3f}"
+              f"{result['throughput'] or 0:>11.0f}{'' if queries is None else f'{queries:.1f}':>9}")
+
+
+def compare(results, baseline, threshold):
+    """
+    与基线逐项比较p50、p99和SQL条数，返回退化的项
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for key in ('p50', 'p99'):
+            if base[key] and result[key] > base[key] * threshold:
+                regressions.append(f'{name} {key}: {base[key]:.3f} -> {result[key]:.3f} ms '
+                                   f'(x{result[key] / base[key]:.2f})')
+        if base.get('queries') is not None and result.get('queries', 0) > base['queries']:
+            regressions.append(f"{name} queries: {base['queries']:.1f} -> {result['queries']:.1f}")
+    return regressions
+
+
+def finish(name, results, args, params):
+    """
+    打印结果，保存或与基线比较；有退化时以状态码1退出，便于在CI中使用
+    """
+    print_table(results)
+    document = dict(benchmark=name, time=datetime.now().isoformat(timespec='seconds'),
+                    python=platform.python_version(), machine=platform.platform(), params=params, results=results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=2)
+
+    path = os.path.join(BASELINES, f'{name}.json')
+    if args.save:
+        os.makedirs(BASELINES, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(document, f, indent=2)
+        print(f'baseline saved to {path}')
+        return
+    if not os.path.exists(path):
+        print(f'no baseline at {path}, run with --save to create one')
+        return
+    with open(path) as f:
+        baseline = json.load(f)
+    if baseline.get('params') != params:
+        print(f"baseline was recorded with different parameters {baseline.get('params')}, not compared")
+        return
+    regressions = compare(results, baseline['results'], args.threshold)
+    if regressions:
+        print(f"regressions against baseline of {baseline['time']}:")
+        for line in regressions:
+            print('  ' + line)
+        sys.exit(1)
+    print(f"no regressions against baseline of {baseline['time']} (threshold x{args.threshold})")
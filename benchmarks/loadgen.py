@@ -0,0 +1,359 @@
+"""
+HTTP压测：模拟客人的完整入住过程，逐级增加并发，记录每个接口的延迟直方图和错误率，找出饱和点
+每个并发的客人循环执行：前台办理入住 -> 客人登录 -> 轮询/room、开关空调、调风速和温度 -> 前台退房
+    python benchmarks/loadgen.py                               # 在本进程中启动服务（临时数据库），经localhost请求
+    python benchmarks/loadgen.py --target client               # 在本进程中用Flask测试客户端，不经过网络
+    python benchmarks/loadgen.py --target http://127.0.0.1:5000 --manager admin:password
+    python benchmarks/loadgen.py --ramp 1,2,4,8,16,32 --stage-seconds 10 --output load.json
+压测进程与服务在同一进程时共用GIL，结果偏保守；对外部服务压测时需要管理员帐号，房间用完后删除
+"""
+import argparse
+import bisect
+import http.client
+import json
+import logging
+import math
+import random
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+from common import use_scratch_instance
+
+# 一次入住中各操作的权重，轮询远多于操作
+ACTIONS = (('poll', 70), ('toggle', 12), ('fan', 10), ('temperature', 8))
+FAN_SPEEDS = ('LOW', 'MEDIUM', 'HIGH')
+
+
+class Histogram:
+    """
+    对数分桶的延迟直方图：10us到100s，每个2倍区间分8个桶，误差约9%；可合并，记录时不需要排序
+    """
+    BOUNDS = [1e-5 * 2 ** (i / 8) for i in range(int(8 * math.log2(1e7)) + 1)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.total = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.total += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        if not self.total:
+            return None
+        rank = q / 100 * self.total
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self.BOUNDS[min(i, len(self.BOUNDS) - 1)], self.max)
+        return self.max
+
+    def to_dict(self):
+        """
+        毫秒为单位的统计和非空的桶（上界毫秒 -> 次数）
+        """
+        ms = lambda value: None if value is None else round(value * 1e3, 3)  # noqa: E731
+        return dict(count=self.total, mean=ms(self.sum / self.total) if self.total else None,
+                    p50=ms(self.percentile(50)), p90=ms(self.percentile(90)), p99=ms(self.percentile(99)),
+                    max=ms(self.max),
+                    buckets={str(ms(self.BOUNDS[min(i, len(self.BOUNDS) - 1)])): count
+                             for i, count in enumerate(self.counts) if count})
+
+
+class RouteStats:
+    def __init__(self):
+        self.histogram = Histogram()
+        self.errors = {}  # 状态码（或异常类名）-> 次数
+
+    def merge(self, other):
+        self.histogram.merge(other.histogram)
+        for key, count in other.errors.items():
+            self.errors[key] = self.errors.get(key, 0) + count
+
+    @property
+    def error_count(self):
+        return sum(self.errors.values())
+
+    def to_dict(self):
+        total = self.histogram.total
+        return dict(self.histogram.to_dict(), errors=self.errors,
+                    errorRate=self.error_count / total if total else 0.)
+
+
+class HTTPTarget:
+    """
+    通过HTTP访问服务，每个线程一个keep-alive连接（服务端关闭时http.client自动重连）
+    """
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.local = threading.local()
+
+    def request(self, method, path, body=None, token=None):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        headers = {'Content-Type': 'application/json'}
+        if token:
+            headers['Authorization'] = 'Bearer ' + token
+        try:
+            connection.request(method, path, body=None if body is None else json.dumps(body), headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            self.local.connection = None
+            raise
+        return response.status, data
+
+
+class ClientTarget:
+    """
+    在本进程中用Flask测试客户端访问，不经过网络和WSGI服务器
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def request(self, method, path, body=None, token=None):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        headers = {'Authorization': 'Bearer ' + token} if token else {}
+        response = client.open(path, method=method, json=body, headers=headers)
+        return response.status_code, response.get_data()
+
+
+def start_local_server(app):
+    """
+    在本进程的线程中启动多线程的werkzeug服务，端口由系统分配
+    """
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)  # 不逐条打印请求
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='loadgen-server', daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+def call(target, stats, route, method, path, body=None, token=None):
+    """
+    发出请求并记录到route下；返回解析后的JSON，失败时返回None
+    """
+    route_stats = stats.setdefault(route, RouteStats())
+    t = time.perf_counter()
+    try:
+        status, data = target.request(method, path, body, token)
+    except Exception as error:
+        route_stats.histogram.record(time.perf_counter() - t)
+        route_stats.errors[type(error).__name__] = route_stats.errors.get(type(error).__name__, 0) + 1
+        return None
+    route_stats.histogram.record(time.perf_counter() - t)
+    if status >= 400:
+        route_stats.errors[str(status)] = route_stats.errors.get(str(status), 0) + 1
+        return None
+    try:
+        return json.loads(data) if data else {}
+    except ValueError:
+        return {}
+
+
+def guest(target, manager_token, room_name, prefix, deadline, think, actions, rng, stats):
+    """
+    一个并发的客人：在deadline之前反复办理入住、操作、退房
+    """
+    names, weights = zip(*ACTIONS)
+    session = 0
+    while time.time() < deadline:
+        session += 1
+        username = f'{prefix}-{room_name}-{session}'
+        if call(target, stats, 'POST /check-in', 'POST', '/check-in',
+                dict(username=username, password='load', roomName=room_name, role='customer', idCard='0',
+                     phoneNumber='0'), manager_token) is None:
+            time.sleep(think)
+            continue
+        login = call(target, stats, 'POST /login', 'POST', '/login',
+                     dict(username=username, password='load', role='customer'))
+        token = login and login.get('token')
+        ac_on = False
+        for _ in range(actions if token else 0):
+            if time.time() >= deadline:
+                break
+            action = rng.choices(names, weights)[0]
+            if action == 'poll':
+                call(target, stats, 'GET /room', 'GET', '/room', token=token)
+            elif action == 'toggle':
+                ac_on = not ac_on
+                call(target, stats, 'POST /room (acState)', 'POST', '/room', dict(acState=ac_on), token)
+            elif action == 'fan':
+                call(target, stats, 'POST /room (fanSpeed)', 'POST', '/room',
+                     dict(acState=ac_on, fanSpeed=rng.choice(FAN_SPEEDS)), token)
+            else:
+                call(target, stats, 'POST /room (acTemperature)', 'POST', '/room',
+                     dict(acState=ac_on, acTemperature=rng.randint(18, 28)), token)
+            time.sleep(rng.expovariate(1 / think) if think else 0)
+        call(target, stats, 'POST /check-out', 'POST', '/check-out', dict(roomName=room_name), manager_token)
+
+
+def run_stage(target, manager_token, rooms, prefix, concurrency, seconds, think, actions, seed):
+    """
+    concurrency个客人同时运行seconds秒，各用一个房间；返回 (各接口的统计, 实际耗时)
+    """
+    deadline = time.time() + seconds
+    per_guest = [{} for _ in range(concurrency)]
+    threads = [threading.Thread(target=guest, args=(target, manager_token, rooms[i], prefix, deadline, think,
+                                                    actions, random.Random(seed * 1000 + i), per_guest[i]),
+                                name=f'loadgen-guest-{i}', daemon=True)
+               for i in range(concurrency)]
+    t = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - t
+    merged = {}
+    for stats in per_guest:
+        for route, route_stats in stats.items():
+            merged.setdefault(route, RouteStats()).merge(route_stats)
+    return merged, elapsed
+
+
+def summarize_stage(concurrency, stats, elapsed):
+    overall = RouteStats()
+    for route_stats in stats.values():
+        overall.merge(route_stats)
+    total = overall.histogram.total
+    return dict(concurrency=concurrency, seconds=round(elapsed, 2), requests=total,
+                throughput=(total - overall.error_count) / elapsed if elapsed else 0.,
+                errorRate=overall.error_count / total if total else 0., p50=overall.histogram.to_dict()['p50'],
+                p99=overall.histogram.to_dict()['p99'],
+                routes={route: route_stats.to_dict() for route, route_stats in sorted(stats.items())})
+
+
+def saturated(stage, previous, slo_ms, max_error_rate):
+    """
+    饱和的判断：错误率或p99超出限制，或者并发增加后吞吐量几乎不再增长而p99明显变长
+    """
+    if stage['errorRate'] > max_error_rate:
+        return f"error rate {stage['errorRate']:.1%} > {max_error_rate:.1%}"
+    if stage['p99'] is not None and stage['p99'] > slo_ms:
+        return f"p99 {stage['p99']:.0f} ms > {slo_ms:.0f} ms"
+    if previous is not None and previous['throughput'] and previous['p99']:
+        gain = stage['throughput'] / previous['throughput']
+        if gain < 1.1 and stage['p99'] > previous['p99'] * 2:
+            return f"throughput x{gain:.2f} while p99 x{stage['p99'] / previous['p99']:.1f}"
+    return None
+
+
+def seed_local(app_module, prefix):
+    """
+    本进程的临时数据库：直接建管理员帐号和设置，房间通过接口创建
+    """
+    from utils.enums import AcMode, FanSpeed, Role
+    with app_module.app.app_context():
+        app_module.db.session.add(app_module.Account(f'{prefix}-manager', 'load', Role.manager))
+        app_module.db.session.add(app_module.Setting(1., FanSpeed.MEDIUM, 25, 16, 30, AcMode.HEAT))
+        app_module.db.session.commit()
+    return f'{prefix}-manager', 'load'
+
+
+def print_stage(stage):
+    print(f"{stage['concurrency']:>6}{stage['requests']:>10}{stage['throughput']:>10.1f}{stage['errorRate']:>8.1%}"
+          f"{stage['p50'] or 0:>10.2f}{stage['p99'] or 0:>10.2f}")
+
+
+def print_routes(stage):
+    print(f"routes at concurrency {stage['concurrency']}:")
+    print(f"  {'route':<28}{'count':>8}{'err %':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for route, r in stage['routes'].items():
+        print(f"  {route:<28}{r['count']:>8}{r['errorRate']:>8.1%}{r['p50']:>10.2f}{r['p90']:>10.2f}"
+              f"{r['p99']:>10.2f}{r['max']:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--target', default='local',
+                        help='local（本进程启动服务）、client（测试客户端）或服务地址如 http://127.0.0.1:5000')
+    parser.add_argument('--manager', help='对外部服务压测时使用的管理员帐号 username:password')
+    parser.add_argument('--ramp', default='1,2,4,8,16,32,64', help='逗号分隔的各级并发客人数')
+    parser.add_argument('--stage-seconds', type=float, default=10, help='每级并发持续的秒数')
+    parser.add_argument('--think', type=float, default=0.2, help='客人两次操作之间的平均间隔（秒）')
+    parser.add_argument('--actions', type=int, default=30, help='每次入住期间的操作次数')
+    parser.add_argument('--slo-ms', type=float, default=500, help='p99超过这个值视为饱和')
+    parser.add_argument('--max-error-rate', type=float, default=0.01, help='错误率超过这个值视为饱和')
+    parser.add_argument('--keep-going', action='store_true', help='饱和后继续完成所有级别')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='把各级的统计和直方图写入这个JSON文件')
+    args = parser.parse_args()
+
+    ramp = [int(c) for c in args.ramp.split(',')]
+    prefix = f'load-{uuid.uuid4().hex[:6]}'
+    if args.target in ('local', 'client'):
+        use_scratch_instance()
+        import app as app_module
+        local_app = app_module.create_app()
+        username, password = seed_local(app_module, prefix)
+        target = ClientTarget(local_app) if args.target == 'client' else HTTPTarget(start_local_server(local_app))
+    else:
+        if not args.manager:
+            parser.error('--manager is required for an external target')
+        username, password = args.manager.split(':', 1)
+        target = HTTPTarget(args.target)
+
+    setup = {}
+    login = call(target, setup, 'login', 'POST', '/login', dict(username=username, password=password, role='manager'))
+    if login is None:
+        raise SystemExit(f"manager login failed: {setup['login'].errors}")
+    manager_token = login['token']
+    rooms = [f'{prefix}-{i}' for i in range(max(ramp))]
+    for name in rooms:
+        if call(target, setup, 'create', 'POST', '/room/create',
+                dict(roomName=name, roomDescription='load test', unitPrice=100), manager_token) is None:
+            raise SystemExit(f"room creation failed: {setup['create'].errors}")
+
+    stages, reason = [], None
+    print(f"{'guests':>6}{'requests':>10}{'req/s':>10}{'errors':>8}{'p50 ms':>10}{'p99 ms':>10}")
+    try:
+        for k, concurrency in enumerate(ramp):
+            stats, elapsed = run_stage(target, manager_token, rooms, f'{prefix}-{k}', concurrency,
+                                       args.stage_seconds, args.think, args.actions, args.seed + k)
+            stage = summarize_stage(concurrency, stats, elapsed)
+            stages.append(stage)
+            print_stage(stage)
+            reason = saturated(stage, stages[-2] if len(stages) > 1 else None, args.slo_ms, args.max_error_rate)
+            if reason and not args.keep_going:
+                break
+    finally:
+        for name in rooms:  # 外部服务上留下的房间删除掉
+            call(target, setup, 'delete', 'POST', '/room/delete', dict(roomName=name), manager_token)
+
+    best = max(stages, key=lambda stage: stage['throughput'])
+    print_routes(best)
+    if reason:
+        print(f"saturated at {stages[-1]['concurrency']} concurrent guests ({reason}); "
+              f"peak {best['throughput']:.1f} req/s at {best['concurrency']} guests")
+    else:
+        print(f"not saturated up to {ramp[-1]} concurrent guests; peak {best['throughput']:.1f} req/s")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(target=args.target, think=args.think, actions=args.actions, stages=stages,
+                           saturation=dict(concurrency=stages[-1]['concurrency'], reason=reason) if reason else None,
+                           peak=dict(concurrency=best['concurrency'], throughput=best['throughput'])), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,130 +1,19 @@
-
-class AirConditioner:
-    """
-    Air Conditioner class representing each room's air conditioner.
-    """
-
-    def __init__(self, scheduler, room_id, initial_temp, set_temp=22,):
-        self.scheduler = scheduler
-        self.room_id = room_id
-        self.initial_temp = initial_temp
-        self.current_temp = initial_temp
-        self.set_temp = set_temp
-        self.is_on = False
-        self.fan_speed = 'low'  # can be 'low', 'medium', or 'high'
-        self.time_on = 0  # Time for which the AC has been on in the current cycle
-
-    def update(self, dt):
-        """
-        更新房间温度
-        """
-        if self.is_on:
-            if self.fan_speed == 'high':
-                change = 1
-            elif self.fan_speed == 'medium':
-                change = 0.5
-            else:  # low speed
-                change = 1 / 3
-            # Adjust the temperature towards the set temperature
-            self.current_temp += change * dt if self.current_temp < self.set_temp else -change * dt
-        else:
-            # Adjust the temperature towards the initial temperature
-            self.current_temp -= 0.5 * dt if self.current_temp > self.initial_temp else 0.5 * dt
-
-    def switch(self, is_on=None, fan_speed=None, set_temp=None):
-        """
-        设置空调状态
-        """
-        if is_on is not None:
-            self.is_on = is_on
-
-        if fan_speed:
-            self.fan_speed = fan_speed
-
-        if set_temp is not None:
-            self.set_temp = set_temp
-
-    def reset_time_on(self):
-        """
-        累计开启时间归零
-        """
-        self.time_on = 0
-
-
-class Scheduler:
-    """
-    Scheduler class to manage air conditioners in service and waiting queues.
-    """
-
-    def __init__(self):
-        self.service_queue = []
-        self.waiting_queue = []
-        self.time_slice = 2  # 2 minutes
-
-    def add_to_service(self, ac):
-        if len(self.service_queue) < 3:
-            self.service_queue.append(ac)
-        else:
-            self.add_to_waiting(ac)
-
-    def add_to_waiting(self, ac):
-        """插入到等待队列的位置保证有序"""
-        # Priority: high > medium > low
-        index = 0
-        for i, waiting_ac in enumerate(self.waiting_queue):
-            if self._compare_priority(ac, waiting_ac):  # 如果优先级低，就往后排， 相等的越早越先
-                index = i + 1
-        self.waiting_queue.insert(index, ac)
-
-    def remove_from_service(self, ac):
-        self.waiting_queue.remove(ac)
-        self.service_queue.remove(ac)
-
-    @staticmethod
-    def _compare_priority(ac1, ac2):
-        """
-        比较优先级
-        """
-        priorities = {'high': 3, 'medium': 2, 'low': 1}
-        return priorities[ac1.fan_speed] <= priorities[ac2.fan_speed]
-
-    def update_queues(self, dt):
-        """
-        为使用中的客户计时，超出时间限制就被强行关闭，加入等待队列
-        """
-        #
-        for ac in self.service_queue:
-            ac.time_on += dt
-            if ac.time_on >= self.time_slice:
-                self.service_queue.remove(ac)
-                self.add_to_waiting(ac)  # 重新放进优先级队列等待
-                ac.reset_time_on()
-
-        # 超时的给等待队列的对头让位
-        while len(self.service_queue) < 3 and self.waiting_queue:
-            self.service_queue.append(self.waiting_queue.pop(0))
-
-    def step(self, dt):
-        """
-        时间片轮转，执行调度
-        """
-        for ac in acs:  # 处理动态逻辑
-            ac.update(dt)
-        self.update_queues(dt)  # 优先级＋时间片轮转
-
-
-scheduler = Scheduler()
-
-acs = [AirConditioner(scheduler, i, temp) for i, temp in enumerate([10, 15, 18, 12, 14], start=1)]
-
-
-# Add air conditioners to the service queue
-for ac in acs:
-    scheduler.add_to_service(ac)
-
+"""
+空调调度仿真：用虚拟时钟驱动app中实际使用的调度分区（SchedulerShard），不经过HTTP和数据库，远快于真实时间
+    python scheduler_demo.py                                    # 回放下面的演示表格，逐分钟打印各房间温度和状态
+    python scheduler_demo.py --trace actions.csv                # 回放记录下来的操作（time,roomID,action,value）
+    python scheduler_demo.py --synthetic 200 --hours 24 --capacity 3,5,10 --time-slice 60,120,300
+按同时送风的房间数和时间片的每种组合各仿真一次，输出等待时间、时间片抢占次数、耗电量和费用
+"""
+import argparse
+import json
+
+from utils.simulation import Simulation, load_trace, synthetic_trace, table_trace
+
+# 每行是一分钟，每列是一个房间
 table = [
-    ['开机',None, None, None, None],  # 1min -> 10s
-    ['24', '开机',None, None, None],
+    ['开机', None, None, None, None],
+    ['24', '开机', None, None, None],
     [None, None, '开机', None, None],
     [None, '25', None, '开机', '开机'],
     [None, None, '27', None, '高'],
@@ -151,38 +40,60 @@ table = [
     [None, '关机', None, '关机', None],
     [None, None, None, None, None]
 ]
-
-
-dt = 1
-# The main loop simulating the time steps
-for i, states in enumerate(table):  # Simulating 10 time steps
-    for state, ac in zip(states, acs):
-        ac_state = None
-        if state is None:
-            continue
-        if '开机' in state:
-            ac_state = True
-        elif '关机' in state:
-            ac_state = False
-
-        fan_speed = None
-        if '中' in state:
-            fan_speed = 'medium'
-        elif '低' in state:
-            fan_speed = 'low'
-        elif '高' in state:
-            fan_speed = 'high'
-
-        ac_temperature = None
-        if (str(state)[:2]).isdigit():
-            ac_temperature = int(str(state)[:2])
-
-        ac.switch(fan_speed=fan_speed, set_temp=ac_temperature)
-
-    scheduler.step(dt)
-    # Print the status of each AC
-    print([(f"{ac.current_temp:.2f}", ac.is_on) for ac in acs])
-
-
-    # Insert a pause or condition here to receive and process requests
-
+initial_temperatures = [10, 15, 18, 12, 14]
+
+
+def print_rooms(simulation):
+    minute = round(simulation.elapsed / 60)
+    print(f'{minute:>3}', [(f'{t:.2f}', state.value) for t, state in simulation.rooms().values()])
+
+
+def print_summary(results):
+    # 开机等待：客人开机到开始送风；重新排队等待：到达目标温度或时间片用尽后再次送风前的等待
+    print(f"{'capacity':>8}{'slice s':>9}{'requests':>10}{'on p50':>8}{'on p95':>8}{'on max':>8}"
+          f"{'requeue p95':>12}{'preempt':>9}{'util':>7}{'energy':>10}{'bill':>10}{'speedup':>10}")
+    for r in results:
+        print(f"{r['capacity']:>8}{r['timeSlice']:>9g}{r['requests']:>10}{r['requestWaitP50']:>8.0f}"
+              f"{r['requestWaitP95']:>8.0f}{r['requestWaitMax']:>8.0f}{r['waitP95']:>12.0f}{r['preemptions']:>9}"
+              f"{r['utilization']:>7.0%}{r['energy']:>10.1f}{r['bill']:>10.1f}{r['speedup']:>9.0f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--trace', help='操作记录文件，.csv或.jsonl')
+    parser.add_argument('--synthetic', type=int, metavar='ROOMS', help='随机生成这么多房间的操作')
+    parser.add_argument('--hours', type=float, default=24, help='随机操作的时长（小时）')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--capacity', default='3', help='逗号分隔的同时送风房间数')
+    parser.add_argument('--time-slice', default='120', help='逗号分隔的时间片（秒）')
+    parser.add_argument('--tick', type=float, default=1., help='调度节拍（秒，酒店时间）')
+    parser.add_argument('--rate', type=float, default=1., help='费率（元/度）')
+    parser.add_argument('--json', help='把各次仿真的完整结果写入这个文件')
+    args = parser.parse_args()
+
+    if args.trace:
+        events = load_trace(args.trace)
+    elif args.synthetic:
+        events = synthetic_trace(args.synthetic, args.hours, seed=args.seed)
+    else:
+        events = table_trace(table, initial=initial_temperatures)
+        simulation = Simulation(capacity=int(args.capacity.split(',')[0]),
+                                time_slice=float(args.time_slice.split(',')[0]), tick=args.tick, rate=args.rate,
+                                default_temperature=22)
+        result = simulation.run(events, until=len(table) * 60, callback=print_rooms, every=60)
+        print_summary([result])
+        return
+
+    results = []
+    for capacity in map(int, args.capacity.split(',')):
+        for time_slice in map(float, args.time_slice.split(',')):
+            simulation = Simulation(capacity=capacity, time_slice=time_slice, tick=args.tick, rate=args.rate)
+            results.append(simulation.run(events))
+    print_summary(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+from sqlalchemy import Column, Float, ForeignKey, Integer, create_engine, select
+from sqlalchemy.orm import declarative_base
+
+from utils.persistence import RecordBuffer, WriteBehind
+
+
+Base = declarative_base()
+
+
+class Room(Base):
+    __tablename__ = 'room'
+    roomID = Column(Integer, primary_key=True)
+    roomTemperature = Column(Float)
+
+
+class RoomRecord(Base):
+    __tablename__ = 'room_records'
+    id = Column(Integer, primary_key=True)
+    roomID = Column(Integer, ForeignKey('room.roomID'))
+    consumption = Column(Float)
+
+
+def make_writer(**kwargs):
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(Room.__table__.insert(), [dict(roomID=1, roomTemperature=25.),
+                                                     dict(roomID=2, roomTemperature=25.)])
+    return engine, WriteBehind(engine, Room, RoomRecord, **kwargs)
+
+
+def test_record_buffer_thresholds():
+    buffer = RecordBuffer(max_records=2, max_delay=60.)
+    assert not buffer.due()
+    buffer.append(dict(n=1))
+    assert not buffer.due()
+    buffer.append(dict(n=2))
+    assert buffer.due()
+    records, oldest = buffer.take()
+    assert [record['n'] for record in records] == [1, 2] and len(buffer) == 0
+    buffer.append(dict(n=3))
+    buffer.restore(records, oldest)  # 写库失败时放回队首
+    assert [record['n'] for record in buffer.records] == [1, 2, 3]
+    assert buffer.oldest == oldest
+
+
+def test_flush_keeps_latest_room_state_and_record_order():
+    engine, writer = make_writer(interval=60.)
+    writer.add_rooms([dict(roomID=1, roomTemperature=24.)])
+    writer.add_rooms([dict(roomID=1, roomTemperature=23.), dict(roomID=2, roomTemperature=22.)])
+    for consumption in (1., 2., 3.):
+        writer.add_record(roomID=1, consumption=consumption)
+    writer.discard(2)
+    assert writer.pending() == (1, 3)
+    writer.flush()
+    with engine.connect() as connection:
+        assert connection.execute(select(Room.roomID, Room.roomTemperature).order_by(Room.roomID)).all() == \
+               [(1, 23.), (2, 25.)]
+        assert connection.scalars(select(RoomRecord.consumption).order_by(RoomRecord.id)).all() == [1., 2., 3.]
+    assert writer.pending() == (0, 0)
+    assert writer.stats['flushes'] == 1
+
+
+def test_records_only_flush_keeps_room_changes():
+    engine, writer = make_writer(interval=60.)
+    writer.add_rooms([dict(roomID=1, roomTemperature=20.)])
+    writer.add_record(roomID=1, consumption=1.)
+    writer.flush(rooms=False)
+    assert writer.pending() == (1, 0)
+
+
+def test_failed_flush_is_retried():
+    engine, writer = make_writer(interval=60.)
+    writer.add_rooms([dict(roomID=1, roomTemperature=20.)])
+    writer.add_record(roomID=1, consumption=1.)
+    RoomRecord.__table__.drop(engine)
+    writer.flush()
+    assert writer.stats['failures'] == 1
+    assert writer.pending() == (1, 1)
+    writer.add_rooms([dict(roomID=1, roomTemperature=19.)])  # 失败期间的新改动覆盖旧值
+    RoomRecord.__table__.create(engine)
+    writer.flush()
+    assert writer.pending() == (0, 0)
+    with engine.connect() as connection:
+        assert connection.scalar(select(Room.roomTemperature).where(Room.roomID == 1)) == 19.
+        assert connection.scalars(select(RoomRecord.consumption)).all() == [1.]
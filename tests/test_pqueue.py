@@ -0,0 +1,34 @@
+from utils.pqueue import IndexedHeap
+
+
+def test_pop_order_follows_priority_then_arrival():
+    heap = IndexedHeap()
+    heap.push('low', (3, 0., 0))
+    heap.push('high', (1, 5., 1))
+    heap.push('medium-early', (2, 1., 2))
+    heap.push('medium-late', (2, 2., 3))
+    assert [heap.pop()[0] for _ in range(len(heap))] == ['high', 'medium-early', 'medium-late', 'low']
+
+
+def test_update_and_remove_keep_heap_order():
+    heap = IndexedHeap()
+    for i, key in enumerate('abcdef'):
+        heap.push(key, (3, i))
+    heap.update('f', (1, 5))  # 提高优先级
+    heap.update('a', (4, 0))  # 降低优先级
+    assert heap.remove('c')
+    assert not heap.remove('c')
+    assert 'c' not in heap and 'f' in heap
+    assert [key for _, key in heap] == ['f', 'b', 'd', 'e', 'a']  # 遍历不改变队列
+    assert [heap.pop()[0] for _ in range(len(heap))] == ['f', 'b', 'd', 'e', 'a']
+    assert not heap
+
+
+def test_push_existing_key_updates_priority():
+    heap = IndexedHeap()
+    heap.push('a', (2, 0))
+    heap.push('b', (2, 1))
+    heap.push('b', (1, 1))
+    assert len(heap) == 2
+    assert heap.get('b') == (1, 1)
+    assert heap.peek() == ('b', (1, 1))
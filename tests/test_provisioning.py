@@ -0,0 +1,46 @@
+from utils.provisioning import parse_rooms, validate_rooms
+
+
+ZONES = {'A': 3, 'B': 2}
+
+
+def validate(rows, existing=()):
+    return validate_rooms(rows, ZONES, 'A', lambda names: set(names) & set(existing))
+
+
+def test_valid_rows_get_default_zone():
+    valid, errors = validate([dict(roomName=' 101 ', unitPrice='300'),
+                              dict(roomName='102', unitPrice=200, initialTemperature=28, zone='B')])
+    assert errors == []
+    assert [(index, room['roomName'], room['unitPrice'], room['zone']) for index, room in valid] == \
+           [(0, '101', 300., 'A'), (1, '102', 200., 'B')]
+
+
+def test_row_errors():
+    valid, errors = validate([dict(unitPrice=1), 'not a room', dict(roomName='a'), dict(roomName='b', unitPrice=-1),
+                              dict(roomName='c', unitPrice='abc'), dict(roomName='d', unitPrice=float('nan')),
+                              dict(roomName='e', unitPrice='inf'), dict(roomName='f', unitPrice=1, zone='C'),
+                              dict(roomName='g', unitPrice=1, initialTemperature='nan'),
+                              dict(roomName='h', unitPrice=1, roomDescription={'x': 1}),
+                              dict(roomName='i', unitPrice=1, zone=['A'])])
+    assert valid == []
+    assert [(error['row'], error['msg']) for error in errors] == [
+        (0, 'roomName required'), (1, 'expected an object'), (2, 'unitPrice required'),
+        (3, 'unitPrice must be a non-negative number'), (4, "could not convert string to float: 'abc'"),
+        (5, 'unitPrice must be a non-negative number'), (6, 'unitPrice must be a non-negative number'),
+        (7, "unknown zone 'C'"), (8, 'initialTemperature must be a number'),
+        (9, 'roomDescription must be a string'), (10, 'zone must be a string')]
+
+
+def test_duplicates_refer_to_the_first_valid_row():
+    valid, errors = validate([dict(roomName='a'), dict(roomName='a', unitPrice=1), dict(roomName='a', unitPrice=2),
+                              dict(roomName='b', unitPrice=1)], existing=['b'])
+    assert [index for index, _ in valid] == [1]
+    assert errors == [dict(row=0, roomName='a', msg='unitPrice required'),
+                      dict(row=2, roomName='a', msg='duplicate roomName in batch (row 1)'),
+                      dict(row=3, roomName='b', msg='room already exists')]
+
+
+def test_parse_csv_ignores_blank_and_unknown_columns():
+    rows = parse_rooms('roomName,unitPrice,zone,extra\n101,300,,x\n', 'csv')
+    assert rows == [dict(roomName='101', unitPrice='300')]
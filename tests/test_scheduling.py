@@ -0,0 +1,172 @@
+import pytest
+
+from utils.clock import VirtualClock
+from utils.enums import AcMode, FanSpeed, QueueState
+from utils.journal import Journal
+from utils.scheduling import RoomRow, SchedulerShard
+
+
+def room(roomID, fanSpeed=FanSpeed.MEDIUM, queueState=QueueState.IDLE):
+    return RoomRow(roomID, roomTemperature=28., acTemperature=22, initialTemperature=28., consumption=0.,
+                   lastConsumption=0., firstRuntime=None, startTimePoint=None, requestTime=None, fanSpeed=fanSpeed,
+                   acMode=AcMode.COOL, queueState=queueState, customerSessionID=f'session-{roomID}')
+
+
+def waiting(shard):
+    return [roomID for _, roomID in shard.waiting_queue]
+
+
+@pytest.fixture
+def clock():
+    return VirtualClock(1_700_000_000)
+
+
+def make_shard(clock, capacity=1, journal=None, rooms=(1, 2, 3)):
+    shard = SchedulerShard('A', capacity, clock=clock, journal=journal)
+    rows = [room(roomID) for roomID in rooms]
+    if journal is None:
+        shard.load(rows)
+    else:
+        shard.recover(rows)
+    return shard
+
+
+def test_time_slice_expiry_preempts_to_the_back_of_the_queue(clock):
+    shard = make_shard(clock, capacity=1, rooms=(1, 2))
+    shard.turn_on(1)
+    shard.turn_on(2)
+    shard.update()
+    assert shard.running_pool == {1}
+    clock.advance(shard.time_slice / shard.boost + 1)  # 还没有到达目标温度
+    shard.update()
+    assert shard.running_pool == {2}
+    assert waiting(shard) == [1]
+    assert shard.stats['expired'] == 1
+    _, records = shard.drain()
+    assert [record['roomID'] for record in records] == [1]
+    assert records[0]['consumption'] > 0
+
+
+def test_reaching_the_target_pauses_the_room(clock):
+    shard = SchedulerShard('A', 1, clock=clock)
+    shard.load([room(1, FanSpeed.HIGH), room(2)])
+    shard.turn_on(1)
+    shard.turn_on(2)
+    shard.update()
+    shard.set_state(1, acTemperature=27)
+    clock.advance(15)  # 高风速每分钟1度，加速6倍，15秒可以变化1.5度
+    shard.update()
+    assert shard.stats['reached'] == 1
+    assert shard.running_pool == {1} and waiting(shard) == [2]  # 暂停后重新排队，高风速仍然优先
+    assert shard.room_state(1)['roomTemperature'] >= 27.  # 到达后开始回温
+    _, records = shard.drain()
+    assert [record['roomID'] for record in records] == [1]
+
+
+def test_promotion_follows_fan_speed_then_request_time(clock):
+    shard = make_shard(clock, capacity=1)
+    shard.turn_on(1)
+    clock.advance(1)
+    shard.turn_on(2)
+    shard.change_fan_speed(2, FanSpeed.HIGH)
+    shard.turn_on(3)
+    shard.update()
+    assert shard.running_pool == {2}
+    assert waiting(shard) == [1, 3]
+    assert shard.room_state(2)['queueState'] == QueueState.RUNNING
+    assert shard.room_state(1)['queueState'] == QueueState.PENDING
+
+
+def test_reset_removes_running_and_waiting_rooms(clock):
+    shard = make_shard(clock, capacity=1)
+    shard.turn_on(1)
+    shard.turn_on(2)
+    shard.update()
+    assert shard.running_pool == {1} and waiting(shard) == [2]
+    shard.reset({1: dict(customerSessionID='new-1'), 2: dict(customerSessionID='new-2')})
+    assert shard.running_pool == set()
+    assert waiting(shard) == []
+    assert [shard.room_state(roomID)['queueState'] for roomID in (1, 2)] == [QueueState.IDLE] * 2
+    assert shard.room_state(1)['customerSessionID'] == 'new-1'
+    _, records = shard.drain()
+    assert [(record['roomID'], record['customerSessionID']) for record in records] == \
+           [(1, 'session-1'), (2, 'session-2')]  # 详单属于上一位客人
+    shard.turn_on(3)
+    shard.update()
+    assert shard.running_pool == {3}  # 释放的容量可以继续使用
+
+
+def test_release_on_check_out(clock):
+    shard = make_shard(clock, capacity=1)
+    shard.turn_on(1)
+    shard.update()
+    shard.release([1, 3], customerSessionID=None)
+    assert shard.running_pool == set()
+    assert shard.room_state(1)['customerSessionID'] is None
+    _, records = shard.drain()
+    assert [record['roomID'] for record in records] == [1]  # 没有开空调的房间不产生详单
+
+
+def test_queue_state_cannot_be_set_directly(clock):
+    shard = make_shard(clock)
+    with pytest.raises(ValueError):
+        shard.set_state(1, queueState=QueueState.IDLE)
+    with pytest.raises(ValueError):
+        shard.set_states({1: dict(acTemperature=24), 2: dict(queueState=QueueState.IDLE)})
+    assert shard.room_state(1)['acTemperature'] == 22  # 整批都不修改
+
+
+def test_journal_replay_after_crash(tmp_path, clock):
+    path = str(tmp_path / 'A')
+    shard = make_shard(clock, capacity=1, journal=Journal(path))
+    shard.turn_on(1)
+    shard.turn_on(2)
+    shard.turn_on(3)
+    shard.change_fan_speed(3, FanSpeed.HIGH)
+    shard.update()
+    clock.advance(5)
+    shard.update()
+    shard.turn_off(2)
+    assert shard.running_pool == {3} and waiting(shard) == [1]
+
+    # 进程崩溃：没有调用stop，数据库中的状态也没有写回（仍全部为IDLE）
+    clock.advance(30)
+    recovered = make_shard(clock, capacity=1, journal=Journal(path))
+    assert recovered.running_pool == {3}
+    assert waiting(recovered) == [1]
+    assert recovered.room_state(2)['queueState'] == QueueState.IDLE
+    assert recovered.room_state(1)['queueState'] == QueueState.PENDING
+    assert recovered.room_state(3)['queueState'] == QueueState.RUNNING
+    # 停机的30秒不计入时间片
+    assert (recovered.room_state(3)['firstRuntime'] - shard.room_state(3)['firstRuntime']).total_seconds() == \
+           pytest.approx(30)
+
+    # 新的序号排在恢复的队列之后
+    recovered.turn_on(2)
+    assert waiting(recovered) == [1, 2]
+
+
+def test_replay_respects_a_lowered_capacity(tmp_path, clock):
+    path = str(tmp_path / 'A')
+    shard = make_shard(clock, capacity=2, journal=Journal(path))
+    shard.turn_on(1)
+    shard.update()
+    clock.advance(1)
+    shard.turn_on(2)
+    shard.update()
+    clock.advance(1)
+    shard.turn_on(3)
+    shard.update()
+    assert shard.running_pool == {1, 2} and waiting(shard) == [3]
+
+    clock.advance(5)
+    recovered = make_shard(clock, capacity=1, journal=Journal(path))
+    assert recovered.running_pool == {1}  # 最早开始运行的房间
+    assert waiting(recovered) == [2, 3]  # 按开始运行的时刻排在之后才开机的房间前面
+    assert recovered.room_state(2)['queueState'] == QueueState.PENDING
+    recovered.update()
+    assert recovered.running_pool == {1}
+
+    clock.advance(5)
+    again = make_shard(clock, capacity=1, journal=Journal(path))  # 超出容量的房间在日志中也已回到等待队列
+    assert again.running_pool == {1} and waiting(again) == [2, 3]
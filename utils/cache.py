@@ -0,0 +1,118 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class VersionFile:
+    """
+    跨进程共享的版本号，保存在一个小文件里
+    每次bump都用os.replace换上新文件，读取版本只需要一次os.stat，不需要访问数据库
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def current(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                return int(f.read() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def bump(self):
+        version = self.read() + 1
+        tmp = f'{self.path}.{os.getpid()}.{threading.get_ident()}'
+        with open(tmp, 'w') as f:
+            f.write(str(version))
+        os.replace(tmp, self.path)  # 原子替换，inode随之改变
+        return version
+
+
+class VersionedCache:
+    """
+    缓存loader的结果，版本号变化（包括其他进程修改）后才重新加载
+    """
+
+    def __init__(self, loader, version):
+        self.loader = loader
+        self.version = version
+        self.lock = threading.Lock()
+        self.token = None
+        self.value = None
+        self.loaded = False
+        self.stats = dict(hits=0, loads=0)
+
+    def get(self):
+        token = self.version.current()  # 先读版本再加载，加载期间的修改会在下次get时被发现
+        if self.loaded and token == self.token:
+            self.stats['hits'] += 1
+            return self.value
+        with self.lock:
+            value = self.loader()
+            self.value, self.token, self.loaded = value, token, True
+            self.stats['loads'] += 1
+        return value
+
+    def invalidate(self):
+        """
+        数据提交后调用，通知所有进程重新加载
+        """
+        with self.lock:
+            self.loaded = False
+        self.version.bump()
+
+
+class TTLCache:
+    """
+    带过期时间的LRU缓存
+    指定version时，版本号变化（其他进程调用了invalidate）后清空全部缓存
+    """
+
+    def __init__(self, maxsize=10000, ttl=60., version=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version = version
+        self.token = None if version is None else version.current()
+        self.lock = threading.Lock()
+        self.items = OrderedDict()  # key -> (过期时间, value)
+        self.stats = dict(hits=0, misses=0)
+
+    def get(self, key):
+        now = time.monotonic()
+        with self.lock:
+            if self.version is not None:
+                token = self.version.current()
+                if token != self.token:
+                    self.items.clear()
+                    self.token = token
+            item = self.items.get(key)
+            if item is None or item[0] < now:
+                self.items.pop(key, None)
+                self.stats['misses'] += 1
+                return None
+            self.items.move_to_end(key)
+            self.stats['hits'] += 1
+            return item[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = (time.monotonic() + self.ttl, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def invalidate(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.items.pop(key, None)
+            if self.version is not None:
+                self.version.bump()
+                self.token = self.version.current()
@@ -0,0 +1,39 @@
+import time
+from datetime import datetime
+
+
+class SystemClock:
+    """
+    真实时间，生产环境使用
+    """
+
+    def time(self):
+        return time.time()
+
+    def now(self):
+        return datetime.now()
+
+
+SYSTEM_CLOCK = SystemClock()
+
+
+class VirtualClock:
+    """
+    由调用方推进的时间，用于仿真和测试；time()与now()总是同一时刻
+    调度分区在子进程中运行时各进程的时钟互不相通，因此只能用于在本进程中运行的调度器
+    """
+
+    def __init__(self, start=None):
+        if start is None:
+            start = datetime.now()
+        self.t = start.timestamp() if isinstance(start, datetime) else float(start)
+
+    def time(self):
+        return self.t
+
+    def now(self):
+        return datetime.fromtimestamp(self.t)
+
+    def advance(self, seconds):
+        self.t += seconds
+        return self.t
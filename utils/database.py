@@ -0,0 +1,29 @@
+from sqlalchemy import event
+
+
+def configure_sqlite(engine, busy_timeout=5000, immediate=False):
+    """
+    SQLite连接的并发设置，对其他数据库不做处理
+    WAL模式下读不阻塞写、写不阻塞读；遇到写锁时最多等待busy_timeout毫秒，而不是立即报 database is locked
+    immediate为True时事务以BEGIN IMMEDIATE开始，一开始就取得写锁，
+    避免先读后写的事务在升级写锁时失败（busy_timeout对这种情况不起作用），用于专门写库的连接
+    """
+    if engine.dialect.name != 'sqlite':
+        return engine
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        if immediate:
+            dbapi_connection.isolation_level = None  # 由下面的begin事件发出BEGIN
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute(f'PRAGMA busy_timeout={int(busy_timeout)}')
+        cursor.execute('PRAGMA synchronous=NORMAL')  # WAL模式下只在检查点时fsync
+        cursor.close()
+
+    if immediate:
+        @event.listens_for(engine, 'begin')
+        def begin(connection):
+            connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+    return engine
@@ -0,0 +1,86 @@
+import json
+import threading
+from collections import deque
+
+
+class Subscription:
+    """
+    一个订阅者的有界队列，积压超过maxsize批时丢弃最旧的，慢的订阅者不会拖慢发布方
+    """
+
+    def __init__(self, roomID=None, raw=False, maxsize=16):
+        self.roomID = roomID  # None表示订阅全部房间
+        self.raw = raw  # 为True时收到未编码的变化字典
+        self.items = deque(maxlen=maxsize)
+        self.condition = threading.Condition()
+        self.dropped = 0
+
+    def put(self, item):
+        with self.condition:
+            if len(self.items) == self.items.maxlen:
+                self.dropped += 1
+            self.items.append(item)
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """
+        取出下一批，超时返回None
+        """
+        with self.condition:
+            if not self.items:
+                self.condition.wait(timeout)
+            return self.items.popleft() if self.items else None
+
+
+class EventHub:
+    """
+    每个调度节拍发布一批房间状态变化 {roomID: {字段: 新值}}，分发给订阅者
+    订阅全部房间的订阅者每批共用一次编码，订阅单个房间的按房间各编码一次
+    """
+
+    def __init__(self, encode=json.dumps, maxsize=16):
+        self.encode = encode
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.subscribers = {}  # roomID（None表示全部房间）-> 订阅集合
+        self.stats = dict(published=0, delivered=0)
+
+    def subscribe(self, roomID=None, raw=False):
+        subscription = Subscription(roomID, raw, self.maxsize)
+        with self.lock:
+            self.subscribers.setdefault(roomID, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscribers = self.subscribers.get(subscription.roomID)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self.subscribers[subscription.roomID]
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(subscribers) for subscribers in self.subscribers.values())
+
+    def publish(self, changes):
+        if not changes:
+            return
+        with self.lock:
+            everyone = list(self.subscribers.get(None, ()))
+            rooms = {roomID: list(self.subscribers[roomID]) for roomID in changes if roomID in self.subscribers}
+        self.stats['published'] += 1
+
+        encoded = None
+        for subscription in everyone:
+            if subscription.raw:
+                subscription.put(changes)
+            else:
+                if encoded is None:
+                    encoded = self.encode(dict(rooms=changes))
+                subscription.put(encoded)
+        for roomID, subscribers in rooms.items():
+            data = self.encode(dict(roomID=roomID, **changes[roomID]))
+            for subscription in subscribers:
+                subscription.put(data)
+        self.stats['delivered'] += len(everyone) + sum(len(subscribers) for subscribers in rooms.values())
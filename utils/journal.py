@@ -0,0 +1,110 @@
+import glob
+import json
+import os
+import time
+
+
+class Journal:
+    """
+    调度分区的事件日志：只追加的JSON行文件，加上定期写入的队列状态快照
+    每个快照有一个编号k，快照之后的事件写入 <path>.<k>.log，重启时读取快照并只重放这一个日志
+    快照用os.replace整体替换，之后才换用新日志、删除旧日志，任何时刻退出都不会重复或遗漏事件
+    每条事件写入后立即交给操作系统，进程崩溃不会丢失；不逐条fsync，机器断电时可能丢失最后几条
+    """
+
+    def __init__(self, path, snapshot_events=10000, snapshot_interval=300., heartbeat=5.):
+        self.path = path  # 不含扩展名，如 instance/journal/default
+        self.snapshot_events = snapshot_events  # 日志达到这么多条时写快照
+        self.snapshot_interval = snapshot_interval  # 或距上次快照这么多秒时
+        self.heartbeat_interval = heartbeat  # 没有事件时也每隔这么多秒记录时间，用于计算停机时长
+        self.generation = 0
+        self.file = None  # 第一次写入时才打开，分区子进程fork时不共享文件
+        self.events = 0
+        self.last_snapshot = time.time()
+        self.last_write = 0.
+        self.stats = dict(appended=0, snapshots=0, replayed=0)
+
+    @property
+    def snapshot_path(self):
+        return f'{self.path}.snapshot'
+
+    def log_path(self, generation):
+        return f'{self.path}.{generation}.log'
+
+    def append(self, event, t, *data):
+        """
+        一条事件：[事件名, 时间, 参数...]
+        """
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self.file = open(self.log_path(self.generation), 'a')
+        self.file.write(json.dumps([event, t, *data], separators=(',', ':')) + '\n')
+        self.file.flush()
+        self.events += 1
+        self.last_write = t
+        self.stats['appended'] += 1
+
+    def heartbeat(self, t):
+        if t - self.last_write >= self.heartbeat_interval:
+            self.append('tick', t)
+
+    def due(self):
+        return self.events >= self.snapshot_events or time.time() - self.last_snapshot >= self.snapshot_interval
+
+    def snapshot(self, t, state):
+        """
+        写入快照并换用新日志，state为可以JSON序列化的队列状态
+        """
+        generation = self.generation + 1
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp = f'{self.snapshot_path}.{os.getpid()}'
+        with open(tmp, 'w') as f:
+            json.dump(dict(generation=generation, time=t, state=state), f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        old = self.log_path(self.generation)
+        self.generation = generation
+        if os.path.exists(old):
+            os.unlink(old)
+        self.events = 0
+        self.last_snapshot = time.time()
+        self.last_write = t
+        self.stats['snapshots'] += 1
+
+    def recover(self):
+        """
+        读取快照和之后的事件：返回 (快照时间, 快照中的状态, [事件])，没有快照时返回None
+        最后一行不完整（写入时进程退出）时忽略；不属于当前快照的旧日志被删除
+        """
+        try:
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return None
+        self.generation = snapshot['generation']
+        events = []
+        current = self.log_path(self.generation)
+        if os.path.exists(current):
+            with open(current) as f:
+                for line in f:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        break
+        for path in glob.glob(glob.escape(self.path) + '.*.log'):
+            if path != current:
+                os.unlink(path)
+        self.stats['replayed'] += len(events)
+        return snapshot['time'], snapshot['state'], events
+
+    def report(self):
+        return dict(generation=self.generation, events=self.events, **self.stats)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,225 @@
+import fcntl
+import logging
+import os
+import secrets
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderLock:
+    """
+    用文件锁在同一台机器的多个进程（如gunicorn的多个worker）中选出唯一的leader
+    持有锁的进程退出（包括崩溃）时由系统释放锁，等待中的进程之一接替
+    注意锁会被fork出的子进程继承，因此不能在选举之后再fork出请求处理进程（如gunicorn --preload）
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    @property
+    def held(self):
+        return self.file is not None
+
+    def acquire(self, blocking=False):
+        file = open(self.path, 'a+')
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            file.close()
+            return False
+        file.seek(0)
+        file.truncate()
+        file.write(str(os.getpid()))
+        file.flush()
+        self.file = file
+        return True
+
+    def locked(self):
+        """
+        是否有进程（包括本进程）持有锁，不取得锁
+        """
+        if self.held:
+            return True
+        with open(self.path, 'a+') as file:
+            try:
+                fcntl.flock(file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(file, fcntl.LOCK_UN)
+            return False
+
+    def owner(self):
+        """
+        当前leader的进程号
+        """
+        try:
+            with open(self.path) as f:
+                return int(f.read() or 0) or None
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def wait(self, callback):
+        """
+        在后台线程中等待锁，取得后调用callback
+        """
+        def run():
+            self.acquire(blocking=True)
+            logger.info('process %d became the leader', os.getpid())
+            callback()
+
+        thread = threading.Thread(target=run, name='leader-election', daemon=True)
+        thread.start()
+        return thread
+
+
+def shared_secret(path):
+    """
+    同一instance目录下各进程共用的随机密钥，第一个进程创建，文件只有属主可读
+    """
+    if not os.path.exists(path):
+        tmp = f'{path}.{os.getpid()}'
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.link(tmp, path)  # 已存在时失败，以先创建的为准
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(tmp)
+    with open(path) as f:
+        return f.read().encode()
+
+
+class CommandServer:
+    """
+    leader进程中接收其他进程转发的命令 (方法名, 参数)，在target上执行后返回 (是否成功, 结果或异常)
+    streams中的方法返回迭代器，逐项发送给对方直到对方断开
+    使用Unix socket，每个连接一个线程
+    """
+
+    def __init__(self, address, authkey, target, methods, streams=()):
+        self.address = address
+        self.authkey = authkey
+        self.target = target
+        self.methods = set(methods)
+        self.streams = set(streams)
+        self.listener = None
+
+    def start(self):
+        if os.path.exists(self.address):
+            os.unlink(self.address)  # 上一个leader留下的socket文件
+        self.listener = Listener(self.address, family='AF_UNIX', authkey=self.authkey)
+        threading.Thread(target=self.accept, name='command-server', daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                connection = self.listener.accept()
+            except AuthenticationError:
+                logger.warning('rejected a connection with a wrong key')
+                continue
+            except OSError:  # 已关闭
+                break
+            threading.Thread(target=self.handle, args=(connection,), name='command-connection', daemon=True).start()
+
+    def handle(self, connection):
+        with connection:
+            while True:
+                try:
+                    method, args, kwargs = connection.recv()
+                except (EOFError, OSError):
+                    break
+                if method in self.streams:
+                    self.stream(connection, getattr(self.target, method)(*args, **kwargs))
+                    break
+                try:
+                    if method not in self.methods:
+                        raise AttributeError(method)
+                    result = True, getattr(self.target, method)(*args, **kwargs)
+                except Exception as error:
+                    result = False, error
+                connection.send(result)
+
+    def stream(self, connection, items):
+        try:
+            for item in items:
+                connection.send((True, item))
+        except OSError:  # 对方已断开
+            pass
+        finally:
+            items.close()
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.close()
+
+
+class CommandClient:
+    """
+    向leader转发命令，每个线程一个连接
+    leader不可用时抛出ConnectionError；只有命令确定没有发出（发送失败）时才换新连接重试一次
+    """
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        self.local = threading.local()
+
+    def connect(self):
+        try:
+            self.local.connection = Client(self.address, family='AF_UNIX', authkey=self.authkey)
+        except OSError as error:
+            raise ConnectionError(f'scheduler leader unavailable: {error}') from error
+        return self.local.connection
+
+    def drop(self):
+        connection = getattr(self.local, 'connection', None)
+        self.local.connection = None
+        if connection is not None:
+            connection.close()
+
+    def call(self, method, *args, **kwargs):
+        message = method, args, kwargs
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            try:
+                connection.send(message)
+            except OSError:  # 旧的连接已断开（leader已更换），命令没有发出
+                self.drop()
+                connection = None
+        if connection is None:
+            connection = self.connect()
+            try:
+                connection.send(message)
+            except OSError as error:
+                self.drop()
+                raise ConnectionError(f'scheduler leader unavailable: {error}') from error
+        try:
+            ok, result = connection.recv()
+        except (EOFError, OSError) as error:
+            self.drop()
+            raise ConnectionError(f'scheduler leader lost while executing {method}: {error}') from error
+        if not ok:
+            raise result
+        return result
+
+    def stream(self, method, *args, **kwargs):
+        """
+        调用leader的流式方法，逐项返回；占用当前线程的连接直到结束
+        """
+        connection = self.connect()
+        try:
+            connection.send((method, args, kwargs))
+            while True:
+                _, item = connection.recv()
+                yield item
+        except (EOFError, OSError) as error:
+            raise ConnectionError(f'scheduler leader lost while streaming {method}: {error}') from error
+        finally:
+            self.drop()
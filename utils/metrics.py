@@ -0,0 +1,203 @@
+import abc
+import bisect
+import math
+import threading
+from collections import namedtuple
+
+
+# 一个指标在某一时刻的全部样本；samples为 (样本名, ((标签名, 值), ...), 数值)，可以在进程之间传递
+Family = namedtuple('Family', ['name', 'type', 'documentation', 'samples'])
+
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+
+
+class Metric(abc.ABC):
+    """
+    指标的基类：按标签值分出子项，没有标签时直接在指标上调用
+    记录只对子项加锁，导出时才遍历，热路径上的开销是一次字典查找和一次加锁
+    """
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children = {}
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    @abc.abstractmethod
+    def new_child(self):
+        """
+        一组标签值对应的子项，由子类决定类型
+        """
+
+    def collect(self, **extra):
+        """
+        extra为附加在所有样本上的标签，如分区名
+        """
+        samples = []
+        for values, child in list(self.children.items()):
+            labels = tuple(zip(self.labelnames, values)) + tuple(extra.items())
+            samples.extend(child.samples(self.name, labels))
+        return Family(self.name, self.TYPE, self.documentation, samples)
+
+
+class CounterChild:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0.
+
+    def inc(self, amount=1.):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def new_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1.):
+        self.labels().inc(amount)
+
+
+class GaugeChild(CounterChild):
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1.):
+        self.inc(-amount)
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def new_child(self):
+        return GaugeChild()
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class HistogramChild:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(bounds) + 1)  # 最后一个是+Inf
+        self.sum = 0.
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        samples, cumulative = [], 0
+        for bound, count in zip(self.bounds + (math.inf,), counts):
+            cumulative += count
+            samples.append((f'{name}_bucket', labels + (('le', format_value(bound)),), cumulative))
+        samples.append((f'{name}_sum', labels, total))
+        samples.append((f'{name}_count', labels, cumulative))
+        return samples
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.bounds = tuple(sorted(buckets))
+
+    def new_child(self):
+        return HistogramChild(self.bounds)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+def family(name, type, documentation, values):
+    """
+    从 {标签元组: 数值} 直接生成样本，用于导出时才计算的值（如队列长度）
+    """
+    return Family(name, type, documentation, [(name, labels, value) for labels, value in values.items()])
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+class Registry:
+    """
+    本进程的指标，以及导出时调用的收集函数（返回Family列表，用于其他进程中的指标）
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def register_collector(self, collector):
+        self.collectors.append(collector)
+        return collector
+
+    def collect(self):
+        families = [metric.collect() for metric in self.metrics]
+        for collector in self.collectors:
+            families.extend(collector())
+        return families
+
+    def exposition(self):
+        """
+        Prometheus文本格式（0.0.4），同名的指标（如各分区的）合并在一组HELP/TYPE下
+        """
+        merged = {}
+        for item in self.collect():
+            if item.name in merged:
+                merged[item.name].samples.extend(item.samples)
+            else:
+                merged[item.name] = Family(item.name, item.type, item.documentation, list(item.samples))
+        lines = []
+        for item in merged.values():
+            lines.append(f'# HELP {item.name} {escape(item.documentation)}')
+            lines.append(f'# TYPE {item.name} {item.type}')
+            for name, labels, value in item.samples:
+                label_text = ','.join(f'{key}="{escape(v)}"' for key, v in labels)
+                lines.append(f'{name}{{{label_text}}} {format_value(value)}' if labels else
+                             f'{name} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,171 @@
+import logging
+import threading
+import time
+
+from sqlalchemy import bindparam, insert, update
+from sqlalchemy.orm import Session
+
+
+logger = logging.getLogger(__name__)
+
+
+class RecordBuffer:
+    """
+    只追加的详单缓冲区：按产生顺序保存，写库时整体批量INSERT，因此同一房间的详单顺序不变
+    积压max_records条，或最早的一条等待超过max_delay秒时到期
+    """
+
+    def __init__(self, max_records=1000, max_delay=1.):
+        self.max_records = max_records
+        self.max_delay = max_delay
+        self.records = []
+        self.oldest = None  # 最早一条未写入详单的产生时间
+        self.stats = dict(appended=0, flushed=0, batches=0, maxBatch=0, lastLag=0., maxLag=0.)
+
+    def __len__(self):
+        return len(self.records)
+
+    def append(self, fields):
+        if not self.records:
+            self.oldest = time.time()
+        self.records.append(fields)
+        self.stats['appended'] += 1
+
+    def due(self):
+        return len(self.records) >= self.max_records or (
+                self.oldest is not None and time.time() - self.oldest >= self.max_delay)
+
+    def take(self):
+        records, oldest = self.records, self.oldest
+        self.records, self.oldest = [], None
+        return records, oldest
+
+    def restore(self, records, oldest):
+        """
+        写库失败时放回队首，保持原有顺序
+        """
+        if records:
+            self.records = records + self.records
+            self.oldest = oldest
+
+    def written(self, records, oldest):
+        lag = time.time() - oldest if oldest is not None else 0.
+        self.stats['flushed'] += len(records)
+        self.stats['batches'] += 1
+        self.stats['maxBatch'] = max(self.stats['maxBatch'], len(records))
+        self.stats['lastLag'] = lag
+        self.stats['maxLag'] = max(self.stats['maxLag'], lag)
+
+
+class WriteBehind:
+    """
+    内存中的房间状态为准，数据库只是它的延迟副本：
+    有改动的房间和新产生的详单被攒在内存里，到期后在一个事务内用批量UPDATE/INSERT写入
+    房间状态最多延迟interval秒，详单按RecordBuffer的数量或时间阈值写入
+    rollups中的汇总表随详单增量更新，与详单在同一个事务内写入
+    房间状态用Core的UPDATE按主键写入，不经过ORM的版本号检查，也不改变版本号：
+    这些列只由调度器修改，请求线程对房间其他列的乐观锁不会因为调度器写库而失败
+    """
+
+    def __init__(self, bind, room_model, record_model, interval=1., max_records=1000, max_record_delay=None,
+                 rollups=()):
+        self.bind = bind
+        self.room_model = room_model
+        self.record_model = record_model
+        self.lock = threading.Lock()
+        self.interval = interval
+        self.rollups = rollups
+        table = room_model.__table__
+        self.room_key = list(table.primary_key)[0].name
+        self.room_update = update(table).where(table.c[self.room_key] == bindparam('b_' + self.room_key))
+
+        self.rooms = {}  # roomID -> 待写入的字段，同一房间只保留最新值
+        self.records = RecordBuffer(max_records, interval if max_record_delay is None else max_record_delay)
+        self.flush_lock = threading.Lock()  # 保证同一时刻只有一个事务在写
+        self.last_flush = time.time()
+        self.stats = dict(flushes=0, failures=0, rooms=0, records=0, lastDuration=0., maxDuration=0.)
+
+    def add_rooms(self, rows):
+        """
+        rows为有改动的房间，每行是带主键的字典
+        """
+        with self.lock:
+            for row in rows:
+                self.rooms[row['roomID']] = row
+
+    def add_record(self, **fields):
+        with self.lock:
+            self.records.append(fields)
+            for rollup in self.rollups:
+                rollup.add(fields)
+
+    def discard(self, roomID):
+        """
+        房间被删除后不再写回
+        """
+        with self.lock:
+            self.rooms.pop(roomID, None)
+
+    def rooms_due(self):
+        return time.time() - self.last_flush >= self.interval
+
+    def due(self):
+        return self.rooms_due() or self.records.due()
+
+    def pending(self):
+        return len(self.rooms), len(self.records)
+
+    def report(self):
+        return dict(self.stats, pendingRooms=len(self.rooms), pendingRecords=len(self.records),
+                    recordBuffer=self.records.stats)
+
+    def _room_params(self, row):
+        params = dict(row)
+        params['b_' + self.room_key] = params.pop(self.room_key)  # 主键只用于WHERE
+        return params
+
+    def flush(self, rooms=True):
+        """
+        一个事务写入全部积压，失败时保留积压等待下次重试
+        rooms为False时只写详单（详单到期而房间状态未到期时）
+        """
+        with self.flush_lock:
+            with self.lock:
+                if rooms:
+                    rooms, self.rooms = self.rooms, {}
+                    self.last_flush = time.time()
+                else:
+                    rooms = {}
+                records, oldest = self.records.take()
+                deltas = [rollup.take() for rollup in self.rollups]
+            if not rooms and not records:
+                return
+
+            t = time.perf_counter()
+            try:
+                with Session(self.bind) as session, session.begin():
+                    if rooms:
+                        session.execute(self.room_update, [self._room_params(row) for row in rooms.values()])
+                    if records:
+                        session.execute(insert(self.record_model), records)
+                    for rollup, delta in zip(self.rollups, deltas):
+                        rollup.upsert(session, delta)
+            except Exception:
+                with self.lock:
+                    rooms.update(self.rooms)  # 失败期间产生的改动更新，覆盖旧值
+                    self.rooms = rooms
+                    self.records.restore(records, oldest)
+                    for rollup, delta in zip(self.rollups, deltas):
+                        rollup.merge(delta)
+                self.stats['failures'] += 1
+                logger.exception('write-behind flush failed, %d rooms and %d records kept', len(rooms), len(records))
+                return
+
+            duration = time.perf_counter() - t
+            if records:
+                self.records.written(records, oldest)
+            self.stats['flushes'] += 1
+            self.stats['rooms'] += len(rooms)
+            self.stats['records'] += len(records)
+            self.stats['lastDuration'] = duration
+            self.stats['maxDuration'] = max(self.stats['maxDuration'], duration)
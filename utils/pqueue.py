@@ -0,0 +1,110 @@
+class IndexedHeap:
+    """
+    按key索引的最小堆：O(1)判断key是否在队列中，O(log n)删除任意key和修改优先级
+    priority可以是任意可比较的值（通常为元组），越小越先出队
+    """
+
+    def __init__(self):
+        self.heap = []  # [priority, key]
+        self.position = {}  # key -> 在heap中的下标
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __bool__(self):
+        return bool(self.heap)
+
+    def __contains__(self, key):
+        return key in self.position
+
+    def __iter__(self):
+        """
+        按出队顺序遍历 (priority, key)，不修改队列
+        """
+        return iter(sorted((priority, key) for priority, key in self.heap))
+
+    def get(self, key):
+        i = self.position.get(key)
+        return None if i is None else self.heap[i][0]
+
+    def peek(self):
+        priority, key = self.heap[0]
+        return key, priority
+
+    def push(self, key, priority):
+        """
+        key已在队列中时等同于update
+        """
+        if key in self.position:
+            self.update(key, priority)
+            return
+        self.heap.append((priority, key))
+        self.position[key] = len(self.heap) - 1
+        self._sift_up(len(self.heap) - 1)
+
+    def pop(self):
+        priority, key = self.heap[0]
+        self._remove_at(0)
+        return key, priority
+
+    def remove(self, key):
+        """
+        删除key，不存在时返回False
+        """
+        i = self.position.get(key)
+        if i is None:
+            return False
+        self._remove_at(i)
+        return True
+
+    def update(self, key, priority):
+        i = self.position[key]
+        old = self.heap[i][0]
+        self.heap[i] = (priority, key)
+        if priority < old:
+            self._sift_up(i)
+        else:
+            self._sift_down(i)
+
+    def clear(self):
+        self.heap.clear()
+        self.position.clear()
+
+    def _remove_at(self, i):
+        key = self.heap[i][1]
+        last = self.heap.pop()
+        del self.position[key]
+        if i < len(self.heap):
+            self.heap[i] = last
+            self.position[last[1]] = i
+            self._sift_up(i)
+            self._sift_down(self.position[last[1]])
+
+    def _swap(self, i, j):
+        heap = self.heap
+        heap[i], heap[j] = heap[j], heap[i]
+        self.position[heap[i][1]] = i
+        self.position[heap[j][1]] = j
+
+    def _sift_up(self, i):
+        heap = self.heap
+        while i > 0:
+            parent = (i - 1) >> 1
+            if heap[i][0] < heap[parent][0]:
+                self._swap(i, parent)
+                i = parent
+            else:
+                break
+
+    def _sift_down(self, i):
+        heap = self.heap
+        n = len(heap)
+        while True:
+            smallest = i
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < n and heap[child][0] < heap[smallest][0]:
+                    smallest = child
+            if smallest == i:
+                break
+            self._swap(i, smallest)
+            i = smallest
@@ -0,0 +1,125 @@
+import heapq
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+
+IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')  # 展开的IN参数个数不同也视为同一种语句
+SPACES = re.compile(r'\s+')
+
+
+def statement_shape(statement):
+    return IN_LIST.sub('(?...)', SPACES.sub(' ', statement).strip())
+
+
+class QueryStats:
+    """
+    一个范围（一次请求或一个调度节拍）内的SQL统计：条数、总耗时、每种语句的次数和最慢的几条
+    """
+
+    def __init__(self, name, keep=3):
+        self.name = name
+        self.keep = keep
+        self.count = 0
+        self.time = 0.
+        self.shapes = {}  # 语句形状 -> 次数
+        self.slowest = []  # 最小堆 (耗时, 语句)
+
+    def add(self, statement, duration):
+        self.count += 1
+        self.time += duration
+        shape = statement_shape(statement)
+        self.shapes[shape] = self.shapes.get(shape, 0) + 1
+        if len(self.slowest) < self.keep:
+            heapq.heappush(self.slowest, (duration, shape))
+        elif duration > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (duration, shape))
+
+    def repeated(self, threshold):
+        """
+        同一种语句执行了至少threshold次，通常是在循环中逐个加载关联对象（N+1）
+        """
+        return sorted(((shape, n) for shape, n in self.shapes.items() if n >= threshold), key=lambda item: -item[1])
+
+
+class QueryProfiler:
+    """
+    通过SQLAlchemy事件记录每条SQL的耗时，归入当前线程正在进行的范围
+    单条语句超过slow_query秒、一个范围内SQL总耗时超过slow_scope秒或出现N+1时写入日志
+    """
+
+    def __init__(self, logger=None, slow_query=.1, slow_scope=.5, repeat_threshold=5):
+        self.logger = logger or logging.getLogger(__name__)
+        self.slow_query = slow_query
+        self.slow_scope = slow_scope
+        self.repeat_threshold = repeat_threshold
+        self.local = threading.local()
+
+    def instrument(self, engine):
+        event.listen(engine, 'before_cursor_execute', self.before_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_execute)
+        event.listen(engine, 'handle_error', self.handle_error)
+        return engine
+
+    def before_execute(self, connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def after_execute(self, connection, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - connection.info['query_start'].pop()
+        stats = getattr(self.local, 'stats', None)
+        if stats is not None:
+            stats.add(statement, duration)
+        if duration >= self.slow_query:
+            self.logger.warning('slow query %.1f ms in %s: %s', duration * 1e3,
+                                stats.name if stats is not None else 'background', statement_shape(statement))
+
+    def handle_error(self, context):
+        """
+        执行失败的语句不会触发after_cursor_execute，在这里丢弃它的开始时刻
+        """
+        connection = context.connection
+        if connection is not None and context.execution_context is not None and connection.info.get('query_start'):
+            connection.info['query_start'].pop()
+
+    def start(self, name):
+        """
+        开始一个范围；同一线程中上一个没有结束的范围被丢弃
+        """
+        self.local.stats = QueryStats(name)
+        return self.local.stats
+
+    def finish(self, stats):
+        if getattr(self.local, 'stats', None) is stats:
+            self.local.stats = None
+        repeated = stats.repeated(self.repeat_threshold)
+        if repeated:
+            self.logger.warning('possible N+1 in %s: %s', stats.name,
+                                '; '.join(f'{n}x {shape}' for shape, n in repeated[:3]))
+        if stats.time >= self.slow_scope:
+            self.logger.warning('%s spent %.1f ms in %d queries, slowest: %s', stats.name, stats.time * 1e3,
+                                stats.count, '; '.join(f'{duration * 1e3:.1f} ms {shape}'
+                                                       for duration, shape in sorted(stats.slowest, reverse=True)))
+        return stats
+
+    @contextmanager
+    def profile(self, name):
+        stats = self.start(name)
+        try:
+            yield stats
+        finally:
+            self.finish(stats)
+
+    def headers(self, stats):
+        """
+        调试模式下附加在响应上的头：Server-Timing可以直接在浏览器开发者工具中看到
+        """
+        headers = {'Server-Timing': f'db;dur={stats.time * 1e3:.2f};desc="{stats.count} queries"',
+                   'X-SQL-Queries': str(stats.count)}
+        repeated = stats.repeated(self.repeat_threshold)
+        if repeated:
+            headers['X-SQL-Repeated'] = ' | '.join(f'{n}x {shape[:120]}' for shape, n in repeated[:3])
+        return headers
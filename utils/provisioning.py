@@ -0,0 +1,75 @@
+import csv
+import io
+import json
+import math
+
+
+ROOM_FIELDS = ('roomName', 'roomDescription', 'unitPrice', 'initialTemperature', 'zone')
+
+
+def parse_rooms(text, format='json'):
+    """
+    批量导入的房间：JSON数组（或 {"rooms": [...]}），或表头为 roomName,roomDescription,unitPrice[,initialTemperature,zone] 的CSV
+    返回字典列表，CSV中的空格视为未填写
+    """
+    if format == 'csv':
+        return [{key: value for key, value in row.items() if key in ROOM_FIELDS and value not in (None, '')}
+                for row in csv.DictReader(io.StringIO(text))]
+    data = json.loads(text) if isinstance(text, str) else text
+    if isinstance(data, dict):
+        data = data.get('rooms')
+    if not isinstance(data, list):
+        raise ValueError('expected a list of rooms')
+    return data
+
+
+def validate_rooms(rows, zones, default_zone, existing):
+    """
+    一遍检查全部行：必填字段、数值、分区、批内和库中房间名是否重复
+    existing(names) 返回其中已存在的房间名，只调用一次
+    返回 (可以创建的 [(行号, 房间)], 错误 [{row, roomName, msg}])，行号从0开始
+    """
+    valid, errors = [], []
+    seen = {}
+    for index, row in enumerate(rows):
+        if not isinstance(row, dict):
+            errors.append(dict(row=index, roomName=None, msg='expected an object'))
+            continue
+        name = str(row.get('roomName') or '').strip()
+        try:
+            if not name:
+                raise ValueError('roomName required')
+            if name in seen:
+                raise ValueError(f'duplicate roomName in batch (row {seen[name]})')
+            unit_price = float(row['unitPrice'])
+            if not math.isfinite(unit_price) or unit_price < 0:
+                raise ValueError('unitPrice must be a non-negative number')
+            initial = row.get('initialTemperature')
+            initial = None if initial is None else float(initial)
+            if initial is not None and not math.isfinite(initial):
+                raise ValueError('initialTemperature must be a number')
+            description = row.get('roomDescription')
+            if description is not None and not isinstance(description, str):
+                raise ValueError('roomDescription must be a string')
+            zone = row.get('zone') or default_zone
+            if not isinstance(zone, str):
+                raise ValueError('zone must be a string')
+            if zone not in zones:
+                raise ValueError(f'unknown zone {zone!r}')
+        except KeyError as error:
+            errors.append(dict(row=index, roomName=name or None, msg=f'{error.args[0]} required'))
+            continue
+        except (TypeError, ValueError) as error:
+            errors.append(dict(row=index, roomName=name or None, msg=str(error)))
+            continue
+        seen[name] = index  # 只记录有效的行，之后同名的行报告为与它重复
+        valid.append((index, dict(roomName=name, roomDescription=description, unitPrice=unit_price,
+                                  initialTemperature=initial, zone=zone)))
+
+    taken = existing([room['roomName'] for _, room in valid]) if valid else set()
+    if taken:
+        errors.extend(dict(row=index, roomName=room['roomName'], msg='room already exists')
+                      for index, room in valid if room['roomName'] in taken)
+        valid = [(index, room) for index, room in valid if room['roomName'] not in taken]
+    errors.sort(key=lambda error: error['row'])
+    return valid, errors
@@ -0,0 +1,46 @@
+import logging
+import time
+from datetime import datetime
+
+from sqlalchemy import delete, select
+
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionJob:
+    """
+    分批删除过期的记录：每批一个短事务，批与批之间让出写锁，避免长时间阻塞调度器写库
+    """
+
+    def __init__(self, bind, table, column, keep, batch_size=5000, pause=0.05, max_batches=None):
+        self.bind = bind
+        self.table = table
+        self.column = column  # 判断过期的时间列
+        self.keep = keep  # 保留时长 timedelta
+        self.batch_size = batch_size
+        self.pause = pause
+        self.max_batches = max_batches  # 每次运行最多删除的批数，None表示删完为止
+        self.stats = dict(runs=0, deleted=0, lastDeleted=0, lastDuration=0.)
+
+    def run(self):
+        t = time.perf_counter()
+        cutoff = datetime.now() - self.keep
+        primary_key = list(self.table.primary_key)[0]
+        expired = select(primary_key).where(self.column < cutoff).limit(self.batch_size).scalar_subquery()
+        deleted, batches = 0, 0
+        while self.max_batches is None or batches < self.max_batches:
+            with self.bind.begin() as connection:
+                count = connection.execute(delete(self.table).where(primary_key.in_(expired))).rowcount
+            deleted += count
+            batches += 1
+            if count < self.batch_size:
+                break
+            time.sleep(self.pause)
+
+        self.stats['runs'] += 1
+        self.stats['deleted'] += deleted
+        self.stats['lastDeleted'] = deleted
+        self.stats['lastDuration'] = time.perf_counter() - t
+        if deleted:
+            logger.info('retention: deleted %d rows older than %s in %d batches', deleted, cutoff, batches)
@@ -0,0 +1,73 @@
+from sqlalchemy import delete
+
+
+class Rollup:
+    """
+    按keys分组累加sums的汇总表
+    新记录先在内存中按分组合并为增量，写库时每个分组一条upsert（已存在则累加）
+    extract把一条记录（字段字典）映射为 (分组键元组, 累加值元组)
+    """
+
+    def __init__(self, table, keys, sums, extract):
+        self.table = table
+        self.keys = keys
+        self.sums = sums
+        self.extract = extract
+        self.pending = {}  # 分组键 -> 累加值列表
+
+    def add(self, record):
+        key, values = self.extract(record)
+        totals = self.pending.get(key)
+        if totals is None:
+            self.pending[key] = list(values)
+        else:
+            for i, value in enumerate(values):
+                totals[i] += value
+
+    def take(self):
+        pending, self.pending = self.pending, {}
+        return pending
+
+    def merge(self, pending):
+        """
+        写库失败时把取出的增量放回
+        """
+        for key, values in pending.items():
+            totals = self.pending.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                totals[i] += value
+
+    def upsert(self, connection, pending):
+        if not pending:
+            return
+        dialect = connection.dialect if hasattr(connection, 'dialect') else connection.get_bind().dialect  # Connection或Session
+        if dialect.name == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        statement = insert(self.table)
+        statement = statement.on_conflict_do_update(
+            index_elements=list(self.keys),
+            set_={name: self.table.c[name] + statement.excluded[name] for name in self.sums})
+        rows = [dict(zip(self.keys, key), **dict(zip(self.sums, values))) for key, values in pending.items()]
+        connection.execute(statement, rows)
+
+    def rebuild(self, bind, max_id, chunks):
+        """
+        从原始记录重新生成汇总表
+        max_id(connection) 返回当前原始记录的最大主键
+        chunks(max_id) 按主键顺序分块返回不超过max_id的记录，每块在单独的事务中写入
+        清空汇总表和确定max_id在同一事务内完成，之后新写入的记录由增量路径负责，不会重复计入
+        """
+        with bind.begin() as connection:
+            connection.execute(delete(self.table))
+            last = max_id(connection)
+        total = 0
+        for records in chunks(last):
+            rollup = Rollup(self.table, self.keys, self.sums, self.extract)
+            for record in records:
+                rollup.add(record)
+            with bind.begin() as connection:
+                rollup.upsert(connection, rollup.pending)
+            total += len(records)
+        return total
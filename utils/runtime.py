@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+from collections import deque
+
+
+logger = logging.getLogger(__name__)
+
+
+class TickLoop:
+    """
+    以固定节拍反复执行task的常驻线程
+    下一次的开始时间按节拍累加而不是从本次结束时算起，因此不会随着task耗时漂移
+    task超过一个节拍（overrun）时按policy处理：
+        skip      丢弃错过的节拍，对齐到下一个节拍
+        catch_up  立即补跑错过的节拍，最多补max_catch_up次，其余丢弃
+    """
+    SKIP = 'skip'
+    CATCH_UP = 'catch_up'
+
+    def __init__(self, task, interval, policy=SKIP, max_catch_up=5, window=1000, name='tick-loop'):
+        assert policy in (self.SKIP, self.CATCH_UP), f"unknown overrun policy {policy}"
+        self.task = task
+        self.interval = interval
+        self.policy = policy
+        self.max_catch_up = max_catch_up
+        self.name = name
+
+        self.thread = None
+        self.stopping = threading.Event()
+        self.running = threading.Event()  # 未暂停时置位
+        self.running.set()
+        self.durations = deque(maxlen=window)  # 最近window次的耗时
+        self.stats = dict(ticks=0, failures=0, overruns=0, skipped=0, caughtUp=0,
+                          lastDuration=0., maxDuration=0., lastLateness=0., maxLateness=0.)
+
+    @property
+    def state(self):
+        if self.thread is None or not self.thread.is_alive():
+            return 'stopped'
+        return 'running' if self.running.is_set() else 'paused'
+
+    def start(self):
+        if self.state != 'stopped':
+            return
+        self.stopping.clear()
+        self.running.set()
+        self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """
+        等待正在执行的task结束后退出
+        """
+        self.stopping.set()
+        self.running.set()  # 唤醒暂停中的线程
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+
+    def pause(self):
+        self.running.clear()
+
+    def resume(self):
+        self.running.set()
+
+    def run(self):
+        deadline = time.monotonic() + self.interval
+        backlog = 0  # catch_up策略下待补跑的节拍数
+        while not self.stopping.is_set():
+            delay = deadline - time.monotonic()
+            if backlog == 0 and delay > 0 and self.stopping.wait(delay):
+                break
+            if not self.running.is_set():
+                self.running.wait()
+                deadline = time.monotonic() + self.interval  # 恢复后重新对齐节拍
+                backlog = 0
+                continue
+
+            started = time.monotonic()
+            self.record_lateness(max(started - deadline, 0.))
+            try:
+                self.task()
+            except Exception:
+                self.stats['failures'] += 1
+                logger.exception('%s: tick failed', self.name)
+            self.record_duration(time.monotonic() - started)
+
+            if backlog > 0:
+                backlog -= 1  # 补跑的节拍不推进deadline
+                continue
+            deadline += self.interval
+            now = time.monotonic()
+            if now > deadline:  # overrun
+                missed = int((now - deadline) // self.interval) + 1
+                self.stats['overruns'] += 1
+                if self.policy == self.CATCH_UP:
+                    backlog = min(missed, self.max_catch_up)
+                    self.stats['caughtUp'] += backlog
+                    self.stats['skipped'] += missed - backlog
+                else:
+                    self.stats['skipped'] += missed
+                deadline += missed * self.interval
+
+    def record_lateness(self, lateness):
+        self.stats['lastLateness'] = lateness
+        self.stats['maxLateness'] = max(self.stats['maxLateness'], lateness)
+
+    def record_duration(self, duration):
+        self.durations.append(duration)
+        self.stats['ticks'] += 1
+        self.stats['lastDuration'] = duration
+        self.stats['maxDuration'] = max(self.stats['maxDuration'], duration)
+
+    def percentile(self, q):
+        durations = sorted(self.durations)
+        if not durations:
+            return 0.
+        return durations[min(int(q / 100 * len(durations)), len(durations) - 1)]
+
+    def report(self):
+        """
+        节拍统计，时间单位为秒
+        """
+        durations = list(self.durations)
+        return dict(state=self.state, interval=self.interval, policy=self.policy, **self.stats,
+                    meanDuration=sum(durations) / len(durations) if durations else 0.,
+                    p50Duration=self.percentile(50), p99Duration=self.percentile(99))
@@ -0,0 +1,473 @@
+import functools
+import itertools
+import multiprocessing
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from utils.clock import SYSTEM_CLOCK
+from utils.enums import FanSpeed, QueueState
+from utils.metrics import Counter, Histogram, family
+from utils.pqueue import IndexedHeap
+from utils.runtime import TickLoop
+from utils.thermal import IDLE, PENDING, ThermalEngine
+
+
+RoomRow = namedtuple('RoomRow', ('roomID',) + ThermalEngine.FIELDS)  # 在进程之间传递的房间温控状态
+PRIORITIES = {FanSpeed.HIGH: 1, FanSpeed.MEDIUM: 2, FanSpeed.LOW: 3}  # 数值越小越先送风
+PRIORITY_FAN_SPEEDS = {priority: fanSpeed.value for fanSpeed, priority in PRIORITIES.items()}
+ENQUEUE_EVENTS = ('turn_on', 'reached', 'preempt', 'load')  # 日志中带有入队优先级 (优先级, 入队时间, 序号) 的事件
+
+
+def room_row(room):
+    """
+    从ORM实例或查询结果行中取出温控状态
+    """
+    return RoomRow(room.roomID, *[getattr(room, name) for name in ThermalEngine.FIELDS])
+
+
+def replay(snapshot_time, state, events):
+    """
+    在快照上依次重放事件，返回 (运行中的房间 {roomID: 开始运行的时刻}, 等待队列 {roomID: 优先级}, 最后记录的时刻)
+    """
+    running = {roomID: started for roomID, started in state['running']}
+    waiting = {roomID: tuple(key) for roomID, *key in state['waiting']}
+    last = snapshot_time
+    for event, t, *data in events:
+        last = t
+        if event in ENQUEUE_EVENTS:
+            roomID, *key = data
+            running.pop(roomID, None)
+            waiting[roomID] = tuple(key)
+        elif event == 'fan' and len(data) > 1:  # 等待中的房间改变风速，按新优先级排队
+            waiting[data[0]] = tuple(data[1:])
+        elif event == 'promote':
+            waiting.pop(data[0], None)
+            running[data[0]] = t
+        elif event in ('turn_off', 'remove'):
+            running.pop(data[0], None)
+            waiting.pop(data[0], None)
+    return running, waiting, last
+
+
+class SchedulerShard:
+    """
+    一个分区（楼栋或楼层）的空调调度：有自己的服务容量、等待队列、温控状态和节拍，不访问数据库
+    状态改动和新产生的详单由drain取出，交给写回层；详单的费率由取出方填写
+    时间都从clock读取，仿真时传入VirtualClock即可快于真实时间运行
+    """
+    REMOTE_METHODS = ('load', 'recover', 'remove_room', 'set_state', 'set_states', 'touch', 'room_state', 'room_states',
+                      'room_version', 'generation', 'turn_on', 'turn_off', 'release', 'reset', 'change_fan_speed',
+                      'drain', 'report', 'metrics', 'start', 'stop', 'pause', 'resume')
+
+    def __init__(self, name, capacity=3, interval=1, overrun_policy=TickLoop.SKIP, boost=6., time_slice=120,
+                 clock=SYSTEM_CLOCK, journal=None):
+        self.name = name
+        self.journal = journal  # Journal，记录队列的变化，重启时恢复队列顺序
+        self.clock = clock
+        self.max_num = capacity
+        self.running_pool = set()
+        self.waiting_queue = IndexedHeap()  # roomID -> (优先级, 请求时间, 序号)
+        self.sequence = itertools.count()  # 同一时刻入队时保证先来先服务
+        self.last_update = clock.time()
+        self.cooling_rate = 0.5/60
+        self.rate = 1.  # 空调费率
+        self.time_slice = time_slice  # 时间片，默认2min
+
+        self.boost = boost
+        self.engine = ThermalEngine()  # 分区内所有房间的温控状态
+        self.lock = threading.RLock()  # 调度线程与请求线程共享队列和温控状态
+        self.records = []  # 尚未取出的详单
+        self.stats = dict(dispatched=0, reached=0, expired=0)  # 调度运行、到达目标温度、时间片用尽的次数
+        self.tick_seconds = Histogram('hotel_scheduler_tick_seconds', '调度分区一个节拍的耗时',
+                                      buckets=(.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, 1.))
+        self.queue_wait = Histogram('hotel_scheduler_queue_wait_seconds', '房间从进入等待队列到开始送风的秒数',
+                                    ['fan_speed'], buckets=(1, 2, 5, 10, 20, 30, 60, 120, 300, 600, 1800))
+        self.enqueued = Counter('hotel_scheduler_enqueued_total', '进入等待队列的次数', ['fan_speed'])
+        self.records_generated = Counter('hotel_scheduler_records_total', '产生的详单数')
+        self.loop = TickLoop(self.update, interval, policy=overrun_policy, name=f'ac-scheduler-{name}')
+
+    def remove_from_lists(self, roomID):
+        self.running_pool.discard(roomID)
+        self.waiting_queue.remove(roomID)
+
+    def load(self, rows):
+        """
+        载入房间（RoomRow），并根据房间的状态恢复队列
+        PENDING的房间只入队，与数据库一致，不需要写回；RUNNING的房间改为PENDING重新排队
+        """
+        with self.lock:
+            self.engine.load(rows)
+            for row in rows:
+                if row.queueState == QueueState.PENDING:
+                    self.enqueue(row.roomID, row.fanSpeed, 'load')
+                elif row.queueState == QueueState.RUNNING:
+                    self.add_to_waiting(row.roomID, 'load')
+
+    def recover(self, rows):
+        """
+        启动时载入全部房间：有日志时按快照和之后的事件恢复运行中的房间、等待队列的顺序和时间片进度，
+        没有日志时与load相同，按房间的状态重新排队；恢复后立即写一个快照
+        """
+        with self.lock:
+            recovered = self.journal.recover() if self.journal is not None else None
+            if recovered is None:
+                self.load(rows)
+            else:
+                self.engine.load(rows)
+                running, waiting, last = replay(*recovered)
+                self.restore(running, waiting, max(0., self.clock.time() - last))
+            if self.journal is not None:
+                self.journal.snapshot(self.clock.time(), self.queue_state())
+
+    def restore(self, running, waiting, downtime):
+        """
+        按日志恢复队列，数据库中的队列状态可能落后于日志（写回有延迟），以日志为准
+        停机的时间不计入时间片：开始运行的时刻向后推移downtime秒
+        运行中的房间按开始运行的先后最多恢复max_num个（容量可能在两次运行之间调小），其余的回到等待队列
+        """
+        engine = self.engine
+        state = engine.columns['queueState']
+        for roomID in engine.ids(state[:len(engine)] != IDLE):
+            if roomID not in running and roomID not in waiting:
+                engine.set(roomID, queueState=QueueState.IDLE)  # 停机前已关机
+        self.sequence = itertools.count(max((key[2] for key in waiting.values()), default=-1) + 1)
+        for roomID, started in sorted(running.items(), key=lambda item: item[1]):
+            i = engine.index.get(roomID)
+            if i is None:  # 停机期间被删除的房间
+                continue
+            if len(self.running_pool) >= self.max_num:  # 超出容量的房间按开始运行的时刻排队
+                waiting[roomID] = (self.get_priority(engine.get(roomID, 'fanSpeed')['fanSpeed']), started,
+                                   next(self.sequence))
+                self.record('load', roomID, *waiting[roomID])
+                continue
+            fields = dict(queueState=QueueState.RUNNING, firstRuntime=datetime.fromtimestamp(started + downtime))
+            if not engine.columns['startTimePoint'][i] >= started:  # 本次运行的开始时刻尚未写回（或为nan）
+                fields['startTimePoint'] = datetime.fromtimestamp(started)
+            engine.set(roomID, **fields)
+            self.running_pool.add(roomID)
+        for roomID, key in waiting.items():
+            i = engine.index.get(roomID)
+            if i is None:
+                continue
+            if state[i] != PENDING:
+                engine.set(roomID, queueState=QueueState.PENDING)
+            self.waiting_queue.push(roomID, key)
+
+    def queue_state(self):
+        """
+        快照中的队列状态：运行中的房间及其开始运行的时刻，等待中的房间按出队顺序及其优先级
+        """
+        first = self.engine.columns['firstRuntime']
+        return dict(running=[[roomID, float(first[self.engine.index[roomID]])] for roomID in sorted(self.running_pool)],
+                    waiting=[[roomID, *key] for key, roomID in self.waiting_queue])
+
+    def record(self, event, *data, t=None):
+        if self.journal is not None:
+            self.journal.append(event, self.clock.time() if t is None else t, *data)
+
+    def remove_room(self, roomID):
+        with self.lock:
+            self.remove_from_lists(roomID)
+            self.engine.remove(roomID)
+            self.record('remove', roomID)
+
+    @staticmethod
+    def check_fields(fields):
+        if 'queueState' in fields:  # 直接修改会使房间与运行池、等待队列不一致
+            raise ValueError("queueState can only be changed by turn_on, turn_off, release or reset")
+
+    def set_state(self, roomID, **fields):
+        """
+        修改房间的温控状态，字段名与Room列名一致；队列状态不能直接修改
+        """
+        self.check_fields(fields)
+        with self.lock:
+            self.engine.set(roomID, **fields)
+
+    def set_states(self, states):
+        """
+        一次修改多个房间：{roomID: {字段: 值}}
+        """
+        for fields in states.values():
+            self.check_fields(fields)
+        with self.lock:
+            for roomID, fields in states.items():
+                self.engine.set(roomID, **fields)
+
+    def touch(self, roomID):
+        with self.lock:
+            self.engine.touch(roomID)
+
+    def room_state(self, roomID):
+        with self.lock:
+            return self.engine.get(roomID)
+
+    def room_version(self, roomID):
+        with self.lock:
+            return self.engine.version(roomID)
+
+    def generation(self):
+        """
+        分区内的改动次数，任何房间的状态改变或房间增删都会使其增加
+        """
+        with self.lock:
+            return self.engine.generation
+
+    def room_states(self, roomIDs):
+        with self.lock:
+            return [self.engine.get(roomID) for roomID in roomIDs]
+
+    def get_priority(self, acSpeed):
+        return PRIORITIES.get(acSpeed, 3)
+
+    def add_to_waiting(self, roomID, event):
+        self.engine.set(roomID, queueState=QueueState.PENDING)
+        self.enqueue(roomID, self.engine.get(roomID, 'fanSpeed')['fanSpeed'], event)
+
+    def enqueue(self, roomID, fanSpeed, event):
+        """
+        event为记入日志的原因，见ENQUEUE_EVENTS
+        """
+        key = (self.get_priority(fanSpeed), self.clock.time(), next(self.sequence))
+        self.waiting_queue.push(roomID, key)
+        self.running_pool.discard(roomID)
+        self.enqueued.labels(fanSpeed.value).inc()
+        self.record(event, roomID, *key)
+
+    def update(self):
+        started = time.perf_counter()
+        with self.lock:
+            t = self.clock.time()
+            reached, expired = self.engine.step(t - self.last_update, t, self.boost, self.rate, self.cooling_rate,
+                                                self.time_slice)
+            self.stats['reached'] += int(reached.sum())
+            self.stats['expired'] += int(expired.sum())
+            paused = reached | expired
+            for roomID, target in zip(self.engine.ids(paused), reached[paused].tolist()):
+                self.add_to_waiting(roomID, 'reached' if target else 'preempt')  # 到达目标温度或超时而暂停
+                self.generate_record(roomID)  # 因到达目标温度或超时暂停产生详单记录
+
+            now = self.clock.now()
+            while self.waiting_queue and len(self.running_pool) < self.max_num:
+                roomID, (priority, queued, _) = self.waiting_queue.pop()
+                self.engine.set(roomID, queueState=QueueState.RUNNING, firstRuntime=now, startTimePoint=now)
+                self.running_pool.add(roomID)
+                self.stats['dispatched'] += 1
+                self.queue_wait.labels(PRIORITY_FAN_SPEEDS[priority]).observe(t - queued)
+                self.record('promote', roomID, t=now.timestamp())  # 与firstRuntime一致
+
+            self.last_update = t
+            if self.journal is not None:
+                self.journal.heartbeat(t)
+                if self.journal.due():
+                    self.journal.snapshot(t, self.queue_state())
+        self.tick_seconds.observe(time.perf_counter() - started)
+
+    def generate_record(self, roomID):
+        room = self.engine.get(roomID)
+        now = self.clock.now()
+        serveStartTime = room['startTimePoint'] or now  # 从未被调度运行过的房间记为零时长
+        self.records.append(dict(roomID=roomID, customerSessionID=room['customerSessionID'],
+                                 requestTime=room['requestTime'], serveStartTime=serveStartTime, serveEndTime=now,
+                                 fanSpeed=room['fanSpeed'], acMode=room['acMode'],
+                                 consumption=room['consumption'] - room['lastConsumption'],
+                                 accumulatedConsumption=room['consumption']))
+        self.engine.set(roomID, lastConsumption=room['consumption'])
+        self.records_generated.inc()
+
+    def turn_off(self, roomID):
+        # PENDING/RUNNING -> IDLE
+        with self.lock:
+            self.engine.set(roomID, queueState=QueueState.IDLE)
+            self.remove_from_lists(roomID)
+            self.generate_record(roomID)  # 因用户操作关闭空调产生详单记录
+            self.record('turn_off', roomID)
+
+    def release(self, roomIDs, **fields):
+        """
+        批量退房：关闭仍在等待或送风的房间的空调（产生详单），移出队列，再把fields写入这些房间
+        """
+        self.reset({roomID: fields for roomID in roomIDs})
+
+    def reset(self, states):
+        """
+        关闭这些房间的空调（仍在等待或送风时产生详单）并移出队列，再写入各房间的字段：{roomID: {字段: 值}}
+        """
+        for fields in states.values():
+            self.check_fields(fields)
+        with self.lock:
+            for roomID, fields in states.items():
+                if self.engine.get(roomID, 'queueState')['queueState'] != QueueState.IDLE:
+                    self.turn_off(roomID)
+                self.engine.set(roomID, **fields)
+
+    def turn_on(self, roomID):
+        # IDLE -> PENDING
+        with self.lock:
+            self.engine.set(roomID, requestTime=self.clock.now())  # 添加请求时间
+            if roomID not in self.running_pool and roomID not in self.waiting_queue:
+                self.add_to_waiting(roomID, 'turn_on')  # 开启空调而加入等待队列
+
+    def change_fan_speed(self, roomID, fanSpeed):
+        with self.lock:
+            self.generate_record(roomID)  # 因用户操作改变风速产生详单记录
+            self.engine.set(roomID, fanSpeed=fanSpeed, startTimePoint=self.clock.now())
+            if roomID in self.waiting_queue:  # 等待中的房间按新风速调整优先级，保留原来的排队时间
+                _, t, seq = self.waiting_queue.get(roomID)
+                key = (self.get_priority(fanSpeed), t, seq)
+                self.waiting_queue.update(roomID, key)
+                self.record('fan', roomID, *key)
+            else:
+                self.record('fan', roomID)
+
+    def drain(self, rooms=True):
+        """
+        取出有改动的房间（可直接用于批量UPDATE的字典）和新产生的详单
+        rooms为False时只取出详单，房间的改动标记保留（仿真时不写库）
+        """
+        with self.lock:
+            records, self.records = self.records, []
+            return self.engine.export_dirty() if rooms else [], records
+
+    def report(self):
+        with self.lock:
+            return dict(name=self.name, capacity=self.max_num, timeSlice=self.time_slice, rooms=len(self.engine),
+                        runningNum=len(self.running_pool), waitingNum=len(self.waiting_queue), **self.stats,
+                        tick=self.loop.report(), journal=self.journal.report() if self.journal is not None else None)
+
+    def metrics(self):
+        """
+        本分区的指标（Family列表），带zone标签；队列长度等在这时读取
+        """
+        with self.lock:
+            labels = (('zone', self.name),)
+            gauges = dict(running=len(self.running_pool), waiting=len(self.waiting_queue), rooms=len(self.engine))
+            stats = dict(self.stats)
+        return [self.tick_seconds.collect(zone=self.name), self.queue_wait.collect(zone=self.name),
+                self.enqueued.collect(zone=self.name), self.records_generated.collect(zone=self.name),
+                family('hotel_scheduler_capacity', 'gauge', '同时送风的房间数上限', {labels: self.max_num}),
+                family('hotel_scheduler_running_rooms', 'gauge', '正在送风的房间数', {labels: gauges['running']}),
+                family('hotel_scheduler_waiting_rooms', 'gauge', '等待队列中的房间数', {labels: gauges['waiting']}),
+                family('hotel_scheduler_rooms', 'gauge', '分区中的房间数', {labels: gauges['rooms']}),
+                family('hotel_scheduler_dispatched_total', 'counter', '开始送风的次数', {labels: stats['dispatched']}),
+                family('hotel_scheduler_target_reached_total', 'counter', '到达目标温度而暂停的次数',
+                       {labels: stats['reached']}),
+                family('hotel_scheduler_preemptions_total', 'counter', '时间片用尽而暂停的次数',
+                       {labels: stats['expired']})]
+
+    def start(self):
+        with self.lock:
+            self.last_update = self.clock.time()
+        self.loop.start()
+
+    def stop(self):
+        self.loop.stop()
+        with self.lock:
+            self.record('tick')  # 记下停止的时刻，重启时据此计算停机时长
+
+    def pause(self):
+        self.loop.pause()
+
+    def resume(self):
+        with self.lock:
+            self.last_update = self.clock.time()  # 暂停期间房间状态冻结
+        self.loop.resume()
+
+
+def serve(connection, shards, inherited=()):
+    """
+    子进程的主循环：按顺序处理 (分区名, 方法名, 参数) 请求并返回 (是否成功, 结果或异常)，收到None时退出
+    inherited为fork时继承的父进程一侧的管道，关闭后父进程退出时本进程才能收到EOF
+    """
+    for other in inherited:
+        other.close()
+    shards = {shard.name: shard for shard in shards}
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:  # 父进程已退出
+            break
+        if message is None:
+            break
+        name, method, args, kwargs = message
+        try:
+            result = True, getattr(shards[name], method)(*args, **kwargs)
+        except Exception as error:
+            result = False, error
+        connection.send(result)
+    for shard in shards.values():
+        shard.stop()
+    connection.close()
+
+
+class Channel:
+    """
+    与一个子进程之间的管道，同一时刻只允许一个请求在途
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+
+    def call(self, name, method, *args, **kwargs):
+        with self.lock:
+            self.connection.send((name, method, args, kwargs))
+            ok, result = self.connection.recv()
+        if not ok:
+            raise result
+        return result
+
+
+class RemoteShard:
+    """
+    子进程中分区的代理，方法与SchedulerShard相同，每次调用是一次管道往返
+    """
+
+    def __init__(self, name, capacity, channel):
+        self.name = name
+        self.max_num = capacity
+        self.channel = channel
+
+    def __getattr__(self, method):
+        if method not in SchedulerShard.REMOTE_METHODS:
+            raise AttributeError(method)
+        return functools.partial(self.channel.call, self.name, method)
+
+
+class ShardPool:
+    """
+    把分区分到processes个子进程中运行，每个进程内的各分区仍各自有调度线程
+    子进程用fork创建，必须在本进程启动任何线程和数据库连接之前构造，子进程不会重新导入app
+    """
+
+    def __init__(self, shards, processes):
+        context = multiprocessing.get_context('fork')
+        self.processes = []
+        self.shards = {}
+        self.closed = False
+        for i in range(min(processes, len(shards))):
+            group = shards[i::processes]
+            parent, child = context.Pipe()
+            inherited = [parent] + [channel.connection for _, channel in self.processes]
+            process = context.Process(target=serve, args=(child, group, inherited), name=f'ac-shards-{i}',
+                                      daemon=True)
+            process.start()
+            child.close()
+            channel = Channel(parent)
+            self.processes.append((process, channel))
+            for shard in group:
+                self.shards[shard.name] = RemoteShard(shard.name, shard.max_num, channel)
+
+    def close(self, timeout=5):
+        if self.closed:
+            return
+        self.closed = True
+        for process, channel in self.processes:
+            with channel.lock:
+                try:
+                    channel.connection.send(None)
+                except (BrokenPipeError, OSError):
+                    pass
+            process.join(timeout)
@@ -0,0 +1,240 @@
+import csv
+import json
+import random
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from utils.clock import VirtualClock
+from utils.enums import AcMode, FanSpeed, QueueState
+from utils.scheduling import RoomRow, SchedulerShard
+from utils.thermal import IDLE, PENDING, RUNNING
+
+
+# time为从仿真开始经过的秒数（酒店时间）；action为 on, off, fan, temperature, initial（房间初始温度）
+Event = namedtuple('Event', ['time', 'roomID', 'action', 'value'])
+
+FAN_WORDS = {'高': FanSpeed.HIGH, '中': FanSpeed.MEDIUM, '低': FanSpeed.LOW}
+
+
+def parse_cell(text):
+    """
+    演示表格中的一格，如 '开机'、'关机'、'高'、'24'、'25，中' -> [(action, value)]
+    """
+    actions = []
+    if '开机' in text:
+        actions.append(('on', None))
+    if text[:2].isdigit():
+        actions.append(('temperature', int(text[:2])))
+    for word, fanSpeed in FAN_WORDS.items():
+        if word in text:
+            actions.append(('fan', fanSpeed))
+    if '关机' in text:
+        actions.append(('off', None))
+    return actions
+
+
+def table_trace(table, step=60, room_ids=None, initial=None):
+    """
+    演示表格 -> 事件列表：每行是一个时间步（默认1分钟），每列是一个房间，None表示没有操作
+    initial为各列房间的初始温度
+    """
+    columns = len(table[0]) if table else 0
+    room_ids = list(room_ids or range(1, columns + 1))
+    events = [Event(0, roomID, 'initial', t) for roomID, t in zip(room_ids, initial or ())]
+    for row, cells in enumerate(table):
+        for roomID, cell in zip(room_ids, cells):
+            if cell is not None:
+                events.extend(Event(row * step, roomID, action, value) for action, value in parse_cell(str(cell)))
+    return events
+
+
+def load_trace(path):
+    """
+    读取记录下来的操作序列：CSV（表头 time,roomID,action,value）或每行一个JSON对象
+    """
+    with open(path, newline='') as f:
+        if path.endswith('.csv'):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+    events = []
+    for row in rows:
+        action, value = row['action'], row.get('value')
+        if action == 'fan':
+            value = FanSpeed[value]
+        elif action in ('temperature', 'initial'):
+            value = float(value)
+        events.append(Event(float(row['time']), int(row['roomID']), action, value))
+    return events
+
+
+def synthetic_trace(rooms, hours, seed=0, idle_minutes=90, on_minutes=40, temperatures=(18, 28)):
+    """
+    随机生成的操作序列：每个房间交替处于关机和开机状态，时长服从指数分布，
+    开机时随机选择风速和目标温度，开机期间有一定概率改变一次风速
+    """
+    rng = random.Random(seed)
+    end = hours * 3600
+    events = []
+    for roomID in range(1, rooms + 1):
+        events.append(Event(0, roomID, 'initial', rng.uniform(10, 35)))
+        t = rng.expovariate(1 / (idle_minutes * 60))
+        while t < end:
+            events.append(Event(t, roomID, 'temperature', rng.randint(*temperatures)))
+            events.append(Event(t, roomID, 'fan', rng.choice(list(FanSpeed))))
+            events.append(Event(t, roomID, 'on', None))
+            duration = rng.expovariate(1 / (on_minutes * 60))
+            if rng.random() < 0.3:
+                events.append(Event(t + rng.uniform(0, duration), roomID, 'fan', rng.choice(list(FanSpeed))))
+            t += duration
+            events.append(Event(t, roomID, 'off', None))
+            t += rng.expovariate(1 / (idle_minutes * 60))
+    return sorted(events, key=lambda event: event.time)
+
+
+class Simulation:
+    """
+    用VirtualClock驱动生产环境的SchedulerShard，按节拍推进并回放操作序列，不经过HTTP和数据库
+    统计等待时间、时间片抢占、耗电量和费用，用于根据数据确定同时送风的房间数和时间片
+    boost默认为1：仿真中的一秒就是酒店时间的一秒
+    """
+
+    def __init__(self, capacity=3, time_slice=120, tick=1., rate=1., boost=1., default_temperature=25,
+                 default_fan_speed=FanSpeed.MEDIUM, ac_mode=AcMode.HEAT, start=None):
+        self.clock = VirtualClock(start)
+        self.start = self.clock.time()
+        self.tick = tick
+        self.rate = rate
+        self.default_temperature = default_temperature
+        self.default_fan_speed = default_fan_speed
+        self.ac_mode = ac_mode
+        self.shard = SchedulerShard('simulation', capacity, tick, boost=boost, time_slice=time_slice,
+                                    clock=self.clock)
+        self.engine = self.shard.engine
+        self.records = []
+        self.waits = []  # 每次从等待到开始送风的秒数，包括到达目标温度或时间片用尽后重新排队的
+        self.request_waits = []  # 其中从客人开机到开始送风的部分
+        self.pending_since = {}  # roomID -> (开始等待的时刻, 是否由开机引起)
+        self.abandoned = 0  # 等待中关机的次数
+        self.requests = 0
+        self.ticks = 0
+        self.busy = 0  # 各节拍送风房间数之和
+        self.previous = np.zeros(0, dtype=np.int8)
+
+    @property
+    def elapsed(self):
+        return self.clock.time() - self.start
+
+    def add_room(self, roomID, initialTemperature):
+        self.shard.load([RoomRow(roomID, roomTemperature=initialTemperature, acTemperature=self.default_temperature,
+                                 initialTemperature=initialTemperature, consumption=0., lastConsumption=0.,
+                                 firstRuntime=None, startTimePoint=None, requestTime=None,
+                                 fanSpeed=self.default_fan_speed, acMode=self.ac_mode, queueState=QueueState.IDLE,
+                                 customerSessionID=f'simulation-{roomID}')])
+
+    def apply(self, event):
+        """
+        与 POST /room 相同的处理：只对关机的房间开机，只对开机的房间关机
+        """
+        if event.roomID not in self.engine:
+            self.add_room(event.roomID, event.value if event.action == 'initial' else 25.)
+        if event.action == 'initial':
+            self.shard.set_state(event.roomID, initialTemperature=event.value, roomTemperature=event.value)
+            return
+        state = self.shard.room_state(event.roomID)['queueState']
+        if event.action == 'on' and state == QueueState.IDLE:
+            self.requests += 1
+            self.shard.turn_on(event.roomID)
+        elif event.action == 'off' and state != QueueState.IDLE:
+            self.shard.turn_off(event.roomID)
+        elif event.action == 'fan' and event.value != self.shard.room_state(event.roomID)['fanSpeed']:
+            self.shard.change_fan_speed(event.roomID, event.value)
+        elif event.action == 'temperature':
+            self.shard.set_state(event.roomID, acTemperature=event.value)
+        self.observe()
+
+    def observe(self):
+        """
+        比较队列状态的变化，记录等待时间
+        """
+        n = len(self.engine)
+        state = self.engine.columns['queueState'][:n]
+        previous = self.previous
+        if len(previous) < n:  # 新加入的房间
+            previous = np.concatenate([previous, np.full(n - len(previous), IDLE, dtype=np.int8)])
+        now = self.clock.time()
+        for i in np.flatnonzero(state != previous):
+            roomID = int(self.engine.room_ids[i])
+            if state[i] == PENDING:
+                self.pending_since[roomID] = now, previous[i] == IDLE
+            elif previous[i] == PENDING:
+                since, requested = self.pending_since.pop(roomID, (now, False))
+                if state[i] == RUNNING:
+                    self.waits.append(now - since)
+                    if requested:
+                        self.request_waits.append(now - since)
+                else:
+                    self.abandoned += 1
+        self.previous = state.copy()
+
+    def step(self):
+        self.clock.advance(self.tick)
+        self.shard.update()
+        self.observe()
+        self.ticks += 1
+        self.busy += len(self.shard.running_pool)
+        self.records.extend(self.shard.drain(rooms=False)[1])
+
+    def run(self, events, until=None, callback=None, every=None):
+        """
+        回放按时间排序的事件直到until秒（默认最后一个事件后再运行一个时间片）
+        callback(simulation) 每every秒（默认每个节拍）调用一次，用于打印过程
+        """
+        events = sorted(events, key=lambda event: event.time)
+        if until is None:
+            until = (events[-1].time if events else 0) + self.shard.time_slice
+        every = every or self.tick
+        wall = time.perf_counter()
+        i, next_callback = 0, every
+        while True:
+            while i < len(events) and events[i].time <= self.elapsed + 1e-9:
+                self.apply(events[i])
+                i += 1
+            if self.elapsed >= until - 1e-9:
+                break
+            self.step()
+            if callback is not None and self.elapsed >= next_callback - 1e-9:
+                callback(self)
+                next_callback += every
+        return self.report(time.perf_counter() - wall)
+
+    def rooms(self):
+        """
+        各房间当前的 (温度, 队列状态)，按roomID排序
+        """
+        return {roomID: (state['roomTemperature'], state['queueState'])
+                for roomID, state in sorted((roomID, self.engine.get(roomID)) for roomID in self.engine.index)}
+
+    def report(self, wall=None):
+        n = len(self.engine)
+        consumption = self.engine.columns['consumption'][:n]
+        waits = np.array(self.waits) if self.waits else np.zeros(1)
+        request_waits = np.array(self.request_waits) if self.request_waits else np.zeros(1)
+        stats = self.shard.stats
+        return dict(simulatedSeconds=self.elapsed, wallSeconds=wall,
+                    speedup=self.elapsed / wall if wall else None, rooms=n, capacity=self.shard.max_num,
+                    timeSlice=self.shard.time_slice, requests=self.requests, dispatched=stats['dispatched'],
+                    waitMean=float(waits.mean()), waitP50=float(np.percentile(waits, 50)),
+                    waitP95=float(np.percentile(waits, 95)), waitMax=float(waits.max()),
+                    requestWaitP50=float(np.percentile(request_waits, 50)),
+                    requestWaitP95=float(np.percentile(request_waits, 95)),
+                    requestWaitMax=float(request_waits.max()),
+                    stillWaiting=len(self.shard.waiting_queue), abandoned=self.abandoned,
+                    preemptions=stats['expired'], reachedTarget=stats['reached'],
+                    utilization=self.busy / (self.ticks * self.shard.max_num) if self.ticks else 0.,
+                    energy=float(consumption.sum()), bill=float(consumption.sum()) * self.rate,
+                    records=len(self.records),
+                    perRoom={int(roomID): dict(energy=float(consumption[i]), bill=float(consumption[i]) * self.rate)
+                             for roomID, i in self.engine.index.items()})
@@ -0,0 +1,224 @@
+from datetime import datetime
+
+import numpy as np
+
+from utils.enums import FanSpeed, AcMode, QueueState
+
+
+FAN_SPEEDS = (FanSpeed.LOW, FanSpeed.MEDIUM, FanSpeed.HIGH)
+AC_MODES = (AcMode.HEAT, AcMode.COOL)
+QUEUE_STATES = (QueueState.IDLE, QueueState.PENDING, QueueState.RUNNING)
+IDLE, PENDING, RUNNING = range(3)
+
+SPEED_PER_MINUTE = np.array([1 / 3, 0.5, 1.])  # 每分钟改变的温度，与FAN_SPEEDS一一对应
+
+
+class ThermalEngine:
+    """
+    用NumPy数组保存所有房间的温控状态，每次调度一次性推进全部房间
+    字段名与Room表的列名保持一致，方便直接批量写回数据库
+    """
+    FLOAT_FIELDS = ('roomTemperature', 'acTemperature', 'initialTemperature', 'consumption', 'lastConsumption')
+    INTEGER_FIELDS = ('acTemperature',)  # 按浮点数参与计算，读出时还原为整数
+    TIME_FIELDS = ('firstRuntime', 'startTimePoint', 'requestTime')  # 以时间戳保存，None记为nan
+    ENUM_FIELDS = {'fanSpeed': FAN_SPEEDS, 'acMode': AC_MODES, 'queueState': QUEUE_STATES}
+    OBJECT_FIELDS = ('customerSessionID',)
+    FIELDS = FLOAT_FIELDS + TIME_FIELDS + tuple(ENUM_FIELDS) + OBJECT_FIELDS
+
+    def __init__(self, capacity=64):
+        self.size = 0
+        self.index = {}  # roomID -> 数组下标
+        self.room_ids = np.zeros(capacity, dtype=np.int64)
+        self.dirty = np.zeros(capacity, dtype=bool)
+        self.versions = np.zeros(capacity, dtype=np.int64)  # 每个房间的状态版本号，每次改动加一
+        self.generation = 0  # 全部房间的改动次数，包括房间的增删
+        self.columns = {}
+        for name in self.FLOAT_FIELDS + self.TIME_FIELDS:
+            self.columns[name] = np.full(capacity, np.nan)
+        for name in self.ENUM_FIELDS:
+            self.columns[name] = np.zeros(capacity, dtype=np.int8)
+        for name in self.OBJECT_FIELDS:
+            self.columns[name] = np.full(capacity, None, dtype=object)
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, roomID):
+        return roomID in self.index
+
+    def _reserve(self, capacity):
+        old = len(self.room_ids)
+        if capacity <= old:
+            return
+        capacity = max(capacity, old * 2)
+        self.room_ids = np.resize(self.room_ids, capacity)
+        self.dirty = np.resize(self.dirty, capacity)
+        self.versions = np.resize(self.versions, capacity)
+        for name, column in self.columns.items():
+            self.columns[name] = np.resize(column, capacity)
+
+    @classmethod
+    def _encode(cls, name, value):
+        if name in cls.TIME_FIELDS:
+            return np.nan if value is None else value.timestamp()
+        if name in cls.ENUM_FIELDS:
+            return cls.ENUM_FIELDS[name].index(value)
+        return value
+
+    @classmethod
+    def _decode(cls, name, value):
+        if name in cls.TIME_FIELDS:
+            return None if value != value else datetime.fromtimestamp(value)  # nan != nan
+        if name in cls.ENUM_FIELDS:
+            return cls.ENUM_FIELDS[name][value]
+        if name in cls.FLOAT_FIELDS:
+            if value != value:
+                return None
+            return int(value) if name in cls.INTEGER_FIELDS else float(value)
+        return value
+
+    @classmethod
+    def _encode_column(cls, name, values):
+        if name in cls.TIME_FIELDS:
+            return [np.nan if value is None else value.timestamp() for value in values]
+        if name in cls.ENUM_FIELDS:
+            codes = {value: code for code, value in enumerate(cls.ENUM_FIELDS[name])}
+            return [codes[value] for value in values]
+        if name in cls.FLOAT_FIELDS:
+            return [np.nan if value is None else value for value in values]
+        return values
+
+    def load(self, rows):
+        """
+        批量载入房间，rows为带有roomID及FIELDS各列的对象（ORM实例或查询结果行）
+        按列整体写入数组，恢复上万个房间时不逐个房间调用set
+        """
+        rows = list(rows)
+        if not rows:
+            return
+        positions = np.empty(len(rows), dtype=np.int64)
+        for k, row in enumerate(rows):
+            i = self.index.get(row.roomID)
+            if i is None:
+                self._reserve(self.size + 1)
+                i = self.index[row.roomID] = self.size
+                self.room_ids[i] = row.roomID
+                self.versions[i] = 0
+                self.size += 1
+            positions[k] = i
+        for name in self.FIELDS:
+            column = self.columns[name]
+            values = self._encode_column(name, [getattr(row, name) for row in rows])
+            if column.dtype == object:
+                for i, value in zip(positions.tolist(), values):
+                    column[i] = value
+            else:
+                column[positions] = values
+        self.dirty[positions] = False  # 与数据库一致，无需写回
+        self.versions[positions] += 1
+        self.generation += len(rows)
+
+    def remove(self, roomID):
+        """
+        移除房间，用末尾的房间填补空位
+        """
+        i = self.index.pop(roomID, None)
+        if i is None:
+            return
+        last = self.size - 1
+        if i != last:
+            moved = int(self.room_ids[last])
+            self.room_ids[i] = moved
+            self.dirty[i] = self.dirty[last]
+            self.versions[i] = self.versions[last]
+            for column in self.columns.values():
+                column[i] = column[last]
+            self.index[moved] = i
+        self.size = last
+        self.generation += 1
+
+    def set(self, roomID, **fields):
+        i = self.index[roomID]
+        for name, value in fields.items():
+            self.columns[name][i] = self._encode(name, value)
+        self.dirty[i] = True
+        self.versions[i] += 1
+        self.generation += 1
+
+    def touch(self, roomID):
+        """
+        只增加版本号，用于数据库中非温控字段（如房间名）的修改
+        """
+        self.versions[self.index[roomID]] += 1
+        self.generation += 1
+
+    def version(self, roomID):
+        i = self.index.get(roomID)
+        return None if i is None else int(self.versions[i])
+
+    def get(self, roomID, *names):
+        """
+        读取单个房间的状态，返回与Room列名对应的字典
+        """
+        i = self.index.get(roomID)
+        if i is None:
+            return None
+        return {name: self._decode(name, self.columns[name][i]) for name in names or self.FIELDS}
+
+    def ids(self, mask):
+        return self.room_ids[:self.size][mask].tolist()
+
+    def step(self, elapsed, now, boost, rate, cooling_rate, time_slice):
+        """
+        推进所有房间elapsed秒（真实时间）：
+        运行中的房间向acTemperature变化并计费，其余房间向initialTemperature回温
+        到达目标温度或时间片用尽的房间会被置为PENDING
+        :return: (reached, expired) 两个布尔掩码，分别对应到达目标温度和时间片超时的房间
+        """
+        n = self.size
+        temperature = self.columns['roomTemperature'][:n]
+        target = self.columns['acTemperature'][:n]
+        consumption = self.columns['consumption'][:n]
+        state = self.columns['queueState'][:n]
+
+        running = state == RUNNING
+        diff = target - temperature
+        distance = np.abs(diff)
+        limit = SPEED_PER_MINUTE[self.columns['fanSpeed'][:n]] * elapsed / 60 * boost
+        # 与原先的minimum()一致：距离小于本次可变化量时到达目标，变化量取二者较小值
+        reached = running & ((distance < limit) | (distance == 0))
+        delta = np.where(running, np.minimum(distance, limit), 0.)
+        temperature += np.sign(diff) * delta
+        consumption += delta * rate
+
+        since = now - self.columns['firstRuntime'][:n]
+        expired = running & ~reached & (since > time_slice / boost)
+        state[reached | expired] = PENDING
+
+        idle = state != RUNNING  # 本次被暂停的房间同样开始回温
+        drift = np.clip(self.columns['initialTemperature'][:n] - temperature,
+                        -cooling_rate * elapsed * boost, cooling_rate * elapsed * boost)
+        drift[~idle] = 0.
+        temperature += drift
+
+        changed = running | (drift != 0)
+        self.dirty[:n] |= changed
+        self.versions[:n] += changed
+        self.generation += int(np.count_nonzero(changed))
+        return reached, expired
+
+    def export_dirty(self):
+        """
+        导出有改动的房间并清除标记，每行是一个可直接用于批量UPDATE的字典
+        """
+        n = self.size
+        rows = np.flatnonzero(self.dirty[:n])
+        if len(rows) == 0:
+            return []
+        values = {name: [self._decode(name, v) for v in self.columns[name][rows].tolist()] for name in self.FIELDS}
+        result = [dict(roomID=roomID) for roomID in self.room_ids[rows].tolist()]
+        for name, column in values.items():
+            for row, value in zip(result, column):
+                row[name] = value
+        self.dirty[rows] = False
+        return result